@@ -0,0 +1,83 @@
+"""
+Administration site configuration.
+"""
+
+import urllib.parse
+
+from django.conf import settings
+from django.contrib import admin
+
+import app.models as models
+import app.sharding as sharding
+
+
+def requested_shard(request):
+    """
+    Gets the shard an admin page is looking at, which the changelist carries over to change pages in
+    _changelist_filters.
+    @param request: An HttpRequest object.
+    @return: A database alias.
+    """
+    changelist_filters = urllib.parse.parse_qs(request.GET.get("_changelist_filters", ""))
+    shard = request.GET.get("shard") or changelist_filters.get("shard", [sharding.PRIMARY])[0]
+
+    return shard if shard in settings.BACKLOG_SHARDS else sharding.PRIMARY
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """
+    Lets staff pick which shard's rows to browse. The filtering itself happens in ShardedModelAdmin.get_queryset().
+    """
+    title = "shard"
+    parameter_name = "shard"
+
+    def lookups(self, request, model_admin):
+        return [(shard, shard) for shard in settings.BACKLOG_SHARDS if shard != sharding.PRIMARY]
+
+    def queryset(self, request, queryset):
+        return queryset
+
+
+class ShardedModelAdmin(admin.ModelAdmin):
+    """
+    Admin for models whose rows are spread across shards. Lists, change pages and deletions act on the shard chosen in
+    the sidebar; new rows go to their user's shard.
+    """
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        return [ShardListFilter, *list_filter] if sharding.is_enabled() else list_filter
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).using(requested_shard(request))
+
+
+@admin.register(models.BackloggedGame)
+class BackloggedGameAdmin(ShardedModelAdmin):
+    list_display = ("entry_id", "game_name", "user", "platform_name", "status_id", "date_added", "is_custom")
+    list_filter = ("status_id", "is_custom")
+    search_fields = ("game_name",)
+    raw_id_fields = ("user", "platform")
+
+
+@admin.register(models.AccountDeletion)
+class AccountDeletionAdmin(admin.ModelAdmin):
+    """
+    Shows the progress of account deletions, which are carried out by the process_account_deletions worker.
+    """
+    list_display = ("username", "user_id", "status", "entries_deleted", "covers_deleted", "attempts", "requested_at",
+                    "updated_at", "finished_at")
+    list_filter = ("status",)
+    search_fields = ("username", "=user_id")
+    readonly_fields = [field.name for field in models.AccountDeletion._meta.fields]
+    actions = ["retry"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry(self, request, queryset):
+        num_retried = queryset.exclude(status=models.AccountDeletion.DONE).update(
+            status=models.AccountDeletion.PENDING, attempts=0)
+        self.message_user(request, f"{num_retried} deletion{'' if num_retried == 1 else 's'} queued to be retried.")
+
+    retry.short_description = "Retry selected deletions"
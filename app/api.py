@@ -0,0 +1,455 @@
+"""
+Versioned JSON API for reading and writing backlog entries.
+"""
+
+import base64
+import binascii
+import contextlib
+import datetime
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.utils import timezone
+from django.views.decorators.gzip import gzip_page
+
+import app.helpers as helpers
+import app.models as models
+import app.typeahead as typeahead
+from app.lazy import lazy_import
+
+arrow = lazy_import("arrow")
+resilience = lazy_import("app.resilience")
+
+backlog = models.BackloggedGame.objects
+tombstones = models.BacklogTombstone.objects
+
+ENTRY_FIELDS = ("entry_id", "game_id", "game_name", "cover_url", "platform_id", "platform_name", "status_id",
+                "status_name", "date_added", "is_custom")
+# fields that aren't columns, mapped to the columns their values are derived from
+DERIVED_FIELDS = {"game_id": ("igdb_id", "custom_id"), "cover_url": ("cover_image_id", "custom_cover_url"),
+                  "platform_name": ("platform_id",), "status_name": ("status_id",)}
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 25
+MAX_NOW_PLAYING = helpers.MAX_NOW_PLAYING
+# tombstones older than this are pruned by the prune_tombstones command, so sync tokens older than this can't be honored
+SYNC_RETENTION = datetime.timedelta(days=30)
+# sync tokens point slightly into the past so that writes still in flight when a token is issued aren't skipped
+SYNC_OVERLAP = datetime.timedelta(seconds=5)
+
+
+class ApiError(Exception):
+    """
+    Raised by API views to send a JSON error response.
+    """
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def api_response(data, status: int = 200):
+    """
+    Creates a compact JSON response.
+    @param data: The object to serialize.
+    @param status: The HTTP status code of the response.
+    @return: A JsonResponse object.
+    """
+    return JsonResponse(data, status=status, safe=False, json_dumps_params={"separators": (",", ":")})
+
+
+def serialize_entry(backlogged: models.BackloggedGame, fields=ENTRY_FIELDS):
+    """
+    Converts a backlog entry to a dictionary for the API.
+    @param backlogged: A BackloggedGame object.
+    @param fields: The fields to include.
+    @return: A dictionary containing the requested fields.
+    """
+    return {field: getattr(backlogged, field) for field in fields}
+
+
+def serialize_row(row: dict, fields=ENTRY_FIELDS):
+    """
+    Converts a backlog entry fetched with QuerySet.values() to a dictionary for the API.
+    @param row: A dictionary of column values, including the columns behind each requested derived field.
+    @param fields: The fields to include.
+    @return: A dictionary containing the requested fields.
+    """
+    entry = {}
+
+    for field in fields:
+        if field == "game_id":
+            entry[field] = models.format_game_id(row["igdb_id"], row["custom_id"])
+        elif field == "cover_url":
+            entry[field] = (models.igdb_image_url(row["cover_image_id"], models.IGDB_DEFAULT_COVER_SIZE)
+                            if row["cover_image_id"] else row["custom_cover_url"])
+        elif field == "platform_name":
+            entry[field] = models.Platform.objects.get_name(row["platform_id"])
+        elif field == "status_name":
+            entry[field] = models.BacklogStatus(row["status_id"]).label
+        else:
+            entry[field] = row[field]
+
+    return entry
+
+
+def parse_fields(request):
+    """
+    Reads the sparse field selection from the "fields" query parameter (e.g. ?fields=game_id,status_id).
+    @param request: A Django HttpRequest object.
+    @return: A tuple of field names.
+    """
+    if not request.GET.get("fields"):
+        return ENTRY_FIELDS
+
+    fields = tuple(field.strip() for field in request.GET["fields"].split(","))
+    unknown = [field for field in fields if field not in ENTRY_FIELDS]
+
+    if unknown:
+        raise ApiError(f"Unknown field(s): {', '.join(unknown)}. Available fields: {', '.join(ENTRY_FIELDS)}.")
+
+    return fields
+
+
+def encode_cursor(status_id: int, entry_id: int):
+    """
+    Creates an opaque pagination cursor pointing just past a backlog entry.
+    @param status_id: The entry's status_id.
+    @param entry_id: The entry's entry_id.
+    @return: A URL-safe cursor string.
+    """
+    return base64.urlsafe_b64encode(f"{status_id}:{entry_id}".encode()).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    """
+    Reverses encode_cursor().
+    @param cursor: A cursor string.
+    @return: A tuple containing a status_id and an entry_id.
+    """
+    try:
+        status_id, entry_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode().split(":")
+        return int(status_id), int(entry_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ApiError("Invalid cursor.")
+
+
+def encode_sync_token(moment: datetime.datetime):
+    """
+    Creates an opaque delta sync token.
+    @param moment: The time from which the next sync should report changes.
+    @return: A URL-safe token string.
+    """
+    return base64.urlsafe_b64encode(str(int(moment.timestamp() * 1_000_000)).encode()).decode("ascii")
+
+
+def decode_sync_token(token: str):
+    """
+    Reverses encode_sync_token().
+    @param token: A token string.
+    @return: An aware datetime object.
+    """
+    try:
+        microseconds = int(base64.urlsafe_b64decode(token.encode("ascii")).decode())
+        return datetime.datetime.fromtimestamp(microseconds / 1_000_000, tz=datetime.timezone.utc)
+    except (binascii.Error, UnicodeError, ValueError, OverflowError, OSError):
+        raise ApiError("Invalid sync token.")
+
+
+def parse_body(request):
+    """
+    Parses the JSON body of a request.
+    @param request: A Django HttpRequest object.
+    @return: A dictionary.
+    """
+    try:
+        body = json.loads(request.body or b"{}")
+    except ValueError:
+        raise ApiError("Request body must be valid JSON.")
+
+    if not isinstance(body, dict):
+        raise ApiError("Request body must be a JSON object.")
+
+    return body
+
+
+def parse_platform_id(platform_id):
+    """
+    Validates a platform ID from a request body, before anything (e.g. an IGDB query) is built from it.
+    @param platform_id: The "platform_id" value of a request body.
+    @return: The platform ID as an integer.
+    """
+    try:
+        return int(platform_id)
+    except (TypeError, ValueError):
+        raise ApiError("platform_id must be an integer.")
+
+
+def resolve_platform(platforms: list, platform_id):
+    """
+    Validates a platform choice and looks up the platform's name.
+    @param platforms: A list of platform dictionaries from platform_handler().
+    @param platform_id: The unique identifier for a platform on IGDB.
+    @return: A tuple containing the platform's unique identifier and name.
+    """
+    platform_id = parse_platform_id(platform_id)
+
+    for platform in platforms:
+        if platform["platform_id"] == platform_id:
+            return platform_id, platform["platform_name"]
+
+    raise ApiError(f"Platform {platform_id} isn't available for this game.")
+
+
+def check_now_playing_limit(user_id: int):
+    """
+    Ensures a user has room in their Now Playing for another game, to fail early before calling IGDB. Only
+    now_playing_room() holds that room for the write itself.
+    @param user_id: The ID of a user.
+    """
+    if helpers.get_num_now_playing(user_id) >= MAX_NOW_PLAYING:
+        raise ApiError(f"You can only have up to {MAX_NOW_PLAYING} games in your Now Playing at a time.", status=409)
+
+
+@contextlib.contextmanager
+def now_playing_room(user_id: int, needed: bool = True):
+    """
+    Runs a with block that moves a game into the user's Now Playing while holding a place there for it (see
+    helpers.now_playing_room()).
+    @param user_id: The ID of a user.
+    @param needed: Optional. False if the block doesn't move a game into Now Playing, so there's nothing to hold.
+    """
+    if not needed:
+        yield
+        return
+
+    try:
+        with helpers.now_playing_room(user_id):
+            yield
+    except helpers.NowPlayingLimitError:
+        raise ApiError(f"You can only have up to {MAX_NOW_PLAYING} games in your Now Playing at a time.", status=409)
+
+
+@method_decorator(gzip_page, name="dispatch")
+class ApiView(View):
+    """
+    Base class for API views. Rejects anonymous users and converts ApiErrors (and unavailable upstream services) into
+    JSON error responses.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return api_response({"error": "Authentication required."}, status=401)
+
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except ApiError as error:
+            return api_response({"error": error.message}, status=error.status)
+        except resilience.UpstreamUnavailable as error:
+            response = api_response({"error": "Game data is unavailable right now. Try again later."}, status=503)
+            response["Retry-After"] = int(settings.UPSTREAM_POLICIES[error.service]["RESET_SECONDS"])
+            return response
+
+    def http_method_not_allowed(self, request, *args, **kwargs):
+        return api_response({"error": f"Method {request.method} not allowed."}, status=405)
+
+
+class BacklogCollectionApiView(ApiView):
+    """
+    GET: Lists (and optionally searches or filters) the user's backlog with cursor pagination.
+    POST: Adds an IGDB game to the user's backlog.
+    """
+
+    def get(self, request, *args, **kwargs):
+        fields = parse_fields(request)
+
+        try:
+            limit = max(1, min(int(request.GET.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+        except ValueError:
+            raise ApiError("limit must be an integer.")
+
+        queryset = backlog.filter(user_id=request.user.id)
+
+        if request.GET.get("query"):
+            queryset = queryset.filter(game_name__iregex=helpers.backlog_search_regex(request.GET["query"]))
+        for param in ("platform_id", "status_id"):
+            if request.GET.get(param):
+                try:
+                    queryset = queryset.filter(**{param: int(request.GET[param])})
+                except ValueError:
+                    raise ApiError(f"{param} must be an integer.")
+
+        if request.GET.get("cursor"):
+            status_id, entry_id = decode_cursor(request.GET["cursor"])
+            queryset = queryset.filter(Q(status_id__lt=status_id) | Q(status_id=status_id, entry_id__gt=entry_id))
+
+        # always fetch the cursor columns, even when the client didn't ask for them
+        columns = {"status_id", "entry_id"}
+        for field in fields:
+            columns.update(DERIVED_FIELDS.get(field, (field,)))
+        rows = list(queryset.order_by("-status_id", "entry_id").values(*columns)[:limit + 1])
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["status_id"], rows[-1]["entry_id"])
+
+        return api_response({
+            "results": [serialize_row(row, fields) for row in rows],
+            "next_cursor": next_cursor,
+        })
+
+    def post(self, request, *args, **kwargs):
+        # validated before anything is written, so that a rejected request leaves nothing behind to conflict with
+        fields = parse_fields(request)
+        body = parse_body(request)
+        user_id = request.user.id
+        game_id = str(body.get("game_id", ""))
+
+        if not game_id.isdigit():
+            raise ApiError("game_id must be the IGDB id of a game.")
+
+        if backlog.filter(user_id=user_id, igdb_id=game_id).exists():
+            raise ApiError("This game is already in your backlog.", status=409)
+
+        if body.get("now_playing"):
+            check_now_playing_limit(user_id)
+
+        game_dict = helpers.get_game_info_dict(game_id, mode="igdb", user_id=user_id)
+        platform_id = models.Platform.objects.register(*resolve_platform(game_dict["platforms"],
+                                                                         body.get("platform_id")))
+        status_id = models.BacklogStatus.NOW_PLAYING if body.get("now_playing") else models.BacklogStatus.BACKLOG
+
+        with now_playing_room(user_id, needed=bool(body.get("now_playing"))):
+            backlogged = backlog.create(user_id=user_id,
+                                        igdb_id=game_id, game_name=game_dict["name"],
+                                        cover_image_id=game_dict["cover_image_id"],
+                                        platform_id=platform_id, status_id=status_id,
+                                        date_added=arrow.now().date())
+
+        return api_response(serialize_entry(backlogged, fields), status=201)
+
+
+class BacklogEntryApiView(ApiView):
+    """
+    GET: Gets a single backlog entry.
+    PATCH: Moves an entry to or from Now Playing ("now_playing") and/or changes its platform ("platform_id").
+    DELETE: Removes an entry from the user's backlog.
+    """
+
+    def get_entry(self):
+        try:
+            return backlog.get(user_id=self.request.user.id, **models.game_id_lookup(self.kwargs["game_id"]))
+        except models.BackloggedGame.DoesNotExist:
+            raise ApiError("This game isn't in your backlog.", status=404)
+
+    def get(self, request, *args, **kwargs):
+        return api_response(serialize_entry(self.get_entry(), parse_fields(request)))
+
+    def patch(self, request, *args, **kwargs):
+        fields = parse_fields(request)
+        body = parse_body(request)
+        backlogged = self.get_entry()
+        changed = []
+        moving_in = False
+
+        if "now_playing" in body:
+            now_playing = bool(body["now_playing"])
+            if now_playing and backlogged.status_id != 2:
+                check_now_playing_limit(request.user.id)
+                moving_in = True
+            backlogged.status_id = models.BacklogStatus.NOW_PLAYING if now_playing else models.BacklogStatus.BACKLOG
+            changed.append("status_id")
+
+        if "platform_id" in body:
+            platform_id = parse_platform_id(body["platform_id"])
+            if backlogged.is_custom:
+                platforms = helpers.platform_getter(platform_id)
+            else:
+                platforms = helpers.get_game_info_dict(backlogged.game_id, mode="igdb",
+                                                       user_id=request.user.id)["platforms"]
+
+            backlogged.platform_id = models.Platform.objects.register(*resolve_platform(platforms, platform_id))
+            changed.append("platform")
+
+        if not changed:
+            raise ApiError('Nothing to update; send "now_playing" and/or "platform_id".')
+
+        with now_playing_room(request.user.id, needed=moving_in):
+            backlogged.save(update_fields=changed + ["updated_at"])
+
+        return api_response(serialize_entry(backlogged, fields))
+
+    def delete(self, request, *args, **kwargs):
+        self.get_entry().delete()
+
+        return HttpResponse(status=204)
+
+
+class SyncApiView(ApiView):
+    """
+    GET: Reports the changes to the user's backlog since the sync token passed as "token", plus a new token for the
+    next sync. Without a token, every entry is reported.
+    """
+    # a lagging replica could hand out a token that skips changes it hasn't received yet
+    reads_from = "primary"
+
+    def get(self, request, *args, **kwargs):
+        user_id = request.user.id
+        fields = parse_fields(request)
+        now = timezone.now()
+
+        entries = backlog.filter(user_id=user_id).select_related("customgame")
+        deleted = []
+
+        if request.GET.get("token"):
+            since = decode_sync_token(request.GET["token"])
+            if since < now - SYNC_RETENTION:
+                raise ApiError("This sync token has expired. Sync again without a token.", status=410)
+
+            entries = entries.filter(Q(updated_at__gt=since) | Q(customgame__updated_at__gt=since))
+            deleted = list(tombstones.filter(user_id=user_id, deleted_at__gt=since)
+                           .values_list("entry_id", flat=True).distinct())
+
+        # clients key their copies on entry_id, so it's always included
+        fields = ("entry_id",) + tuple(field for field in fields if field != "entry_id")
+        changed = []
+        for backlogged in entries.order_by("entry_id"):
+            entry = serialize_entry(backlogged, fields)
+            if backlogged.is_custom and backlogged.custom_data:
+                entry["custom"] = {"involved_companies": backlogged.custom_data.involved_companies,
+                                   "summary": backlogged.custom_data.summary}
+            changed.append(entry)
+
+        return api_response({
+            "changed": changed,
+            "deleted": deleted,
+            "token": encode_sync_token(now - SYNC_OVERLAP),
+        })
+
+
+class TypeaheadApiView(ApiView):
+    """
+    GET: Suggests IGDB games whose titles have a word starting with "query", from the local title index (see
+    app.typeahead) rather than IGDB.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = max(1, min(int(request.GET.get("limit", DEFAULT_SUGGESTIONS)), MAX_SUGGESTIONS))
+        except ValueError:
+            raise ApiError("limit must be an integer.")
+
+        suggestions = typeahead.suggest(request.GET.get("query", "")[:200], limit)
+
+        response = api_response({"results": [{"game_id": game_id, "name": name} for game_id, name in suggestions]})
+        # the same prefix is typed again whenever the user backspaces
+        patch_cache_control(response, private=True, max_age=60)
+        return response
@@ -0,0 +1,16 @@
+"""
+URL path converters.
+"""
+
+
+class GameIdConverter:
+    """
+    Matches game ids: IGDB ids (e.g. 1942) and custom game ids (e.g. custom-3f2b8c1e-7d4a-4e5b-9c6d-0a1b2c3d4e5f).
+    """
+    regex = r"[0-9]+|custom-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+
+    def to_python(self, value):
+        return value
+
+    def to_url(self, value):
+        return str(value)
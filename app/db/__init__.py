@@ -0,0 +1,3 @@
+"""
+Database connection pooling.
+"""
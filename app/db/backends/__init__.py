@@ -0,0 +1,3 @@
+"""
+Database backends that take their connections from app.db.pool.
+"""
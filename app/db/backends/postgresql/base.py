@@ -0,0 +1,11 @@
+"""
+PostgreSQL backend with pooled connections.
+"""
+
+from django.db.backends.postgresql import base
+
+from app.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    pass
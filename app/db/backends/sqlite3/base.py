@@ -0,0 +1,11 @@
+"""
+SQLite backend with pooled connections, for exercising the pool without a PostgreSQL server.
+"""
+
+from django.db.backends.sqlite3 import base
+
+from app.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    pass
@@ -0,0 +1,292 @@
+"""
+A bounded, per-process pool of database connections.
+
+Databases opt in by using one of the engines in app.db.backends and may tune the pool with a "POOL" dictionary in
+their settings.DATABASES entry:
+    MAX_SIZE: The most connections the process may hold open at once, in use or idle.
+    MAX_LIFETIME: Seconds after which a connection is closed instead of being reused. None disables recycling.
+    HEALTH_CHECK_INTERVAL: Seconds a connection may sit idle before it's pinged on checkout. 0 pings every checkout.
+    TIMEOUT: Seconds to wait for a connection when all of them are in use before giving up.
+
+Django still "closes" its connection at the end of every request (CONN_MAX_AGE should be 0); with a pooled engine that
+returns the connection to the pool instead.
+"""
+
+import collections
+import os
+import threading
+import time
+
+from django.db import OperationalError
+
+DEFAULT_POOL_OPTIONS = {
+    "MAX_SIZE": 10,
+    "MAX_LIFETIME": 1800,
+    "HEALTH_CHECK_INTERVAL": 30,
+    "TIMEOUT": 10,
+}
+
+
+class PoolTimeout(OperationalError):
+    """
+    Raised when no connection becomes available within the pool's timeout.
+    """
+
+
+class PooledConnection:
+    """
+    A raw database connection along with the times the pool needs to decide whether to reuse it.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.returned_at = self.created_at
+
+
+class ConnectionPool:
+    """
+    Hands out raw DB-API connections, opening new ones until max_size is reached and then waiting for one to be
+    returned. Idle connections are reused most-recently-returned first, so that surplus connections go quiet and age
+    out.
+    """
+
+    def __init__(self, connect, max_size: int, max_lifetime: float = None, health_check_interval: float = 30,
+                 timeout: float = 10):
+        """
+        @param connect: A function that opens a new raw connection.
+        @param max_size: The most connections that may be open at once.
+        @param max_lifetime: Optional. Seconds after which a connection is closed rather than reused.
+        @param health_check_interval: Seconds a connection may sit idle before it's pinged on checkout.
+        @param timeout: Seconds acquire() waits for a connection before raising PoolTimeout.
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        self.idle = collections.deque()
+        self.in_use = {}
+        self.condition = threading.Condition()
+        self.stats = collections.Counter()
+
+    @property
+    def size(self):
+        return len(self.idle) + len(self.in_use)
+
+    def acquire(self):
+        """
+        Checks out a healthy connection, opening one if there's room in the pool.
+        @return: A raw database connection.
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        with self.condition:
+            while True:
+                while self.idle:
+                    pooled = self.idle.pop()
+                    if self.is_reusable(pooled):
+                        return self.check_out(pooled, started if waited else None)
+
+                if self.size < self.max_size:
+                    # reserve the slot so that other threads can't overfill the pool while this one connects
+                    placeholder = object()
+                    self.in_use[id(placeholder)] = placeholder
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection became available within {self.timeout} seconds "
+                                      f"({self.max_size} in use).")
+                waited = True
+                self.condition.wait(remaining)
+
+        try:
+            pooled = PooledConnection(self.connect())
+        except Exception:
+            with self.condition:
+                del self.in_use[id(placeholder)]
+                self.condition.notify()
+            raise
+
+        with self.condition:
+            del self.in_use[id(placeholder)]
+            self.stats["created"] += 1
+            return self.check_out(pooled, started if waited else None)
+
+    def check_out(self, pooled: PooledConnection, wait_started: float = None):
+        self.in_use[id(pooled.connection)] = pooled
+        self.stats["checkouts"] += 1
+        if wait_started is not None:
+            self.stats["waits"] += 1
+            self.stats["wait_ms"] += round((time.monotonic() - wait_started) * 1000)
+
+        return pooled.connection
+
+    def release(self, connection, discard: bool = False):
+        """
+        Returns a connection to the pool.
+        @param connection: A connection from acquire().
+        @param discard: Optional. Whether the connection is broken and should be closed instead of reused.
+        """
+        with self.condition:
+            pooled = self.in_use.pop(id(connection), None)
+            if pooled is None:
+                # not one of ours (e.g. the pool was reset after a fork); just close it
+                self.close(connection, "orphaned")
+            elif discard:
+                self.close(connection, "discarded")
+            elif self.is_expired(pooled):
+                self.close(connection, "recycled")
+            else:
+                pooled.returned_at = time.monotonic()
+                self.idle.append(pooled)
+            self.condition.notify()
+
+    def is_expired(self, pooled: PooledConnection):
+        return self.max_lifetime is not None and time.monotonic() - pooled.created_at >= self.max_lifetime
+
+    def is_reusable(self, pooled: PooledConnection):
+        """
+        Decides whether an idle connection can be handed out again, closing it if not.
+        @param pooled: An idle connection.
+        @return: True if the connection is young enough and responds to a ping when one is due.
+        """
+        if self.is_expired(pooled):
+            self.close(pooled.connection, "recycled")
+            return False
+
+        if time.monotonic() - pooled.returned_at >= self.health_check_interval:
+            self.stats["health_checks"] += 1
+            if not ping(pooled.connection):
+                self.stats["health_check_failures"] += 1
+                self.close(pooled.connection, "unhealthy")
+                return False
+
+        return True
+
+    def close(self, connection, reason: str):
+        self.stats[f"closed_{reason}"] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close_idle(self):
+        """
+        Closes every idle connection, e.g. before the process exits.
+        """
+        with self.condition:
+            while self.idle:
+                self.close(self.idle.pop().connection, "shutdown")
+
+    def metrics(self):
+        """
+        @return: A dictionary of the pool's current size and lifetime counters.
+        """
+        with self.condition:
+            return {"max_size": self.max_size, "in_use": len(self.in_use), "idle": len(self.idle), **self.stats}
+
+
+def ping(connection):
+    """
+    Checks that a raw connection can still run a query.
+    @param connection: A raw DB-API connection.
+    @return: True if the connection is healthy.
+    """
+    if getattr(connection, "closed", 0):
+        return False
+
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        finally:
+            cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(key: tuple, connect, options: dict = None):
+    """
+    Gets the pool for a database, creating it on first use. Pools are never shared across processes, so workers forked
+    after a connection was opened start with their own empty pool.
+    @param key: Identifies the database the pool connects to.
+    @param connect: A function that opens a new raw connection to that database.
+    @param options: Optional. Overrides for DEFAULT_POOL_OPTIONS.
+    @return: A ConnectionPool object.
+    """
+    key = (os.getpid(), *key)
+
+    with pools_lock:
+        if key not in pools:
+            options = {**DEFAULT_POOL_OPTIONS, **(options or {})}
+            pools[key] = ConnectionPool(connect, max_size=options["MAX_SIZE"], max_lifetime=options["MAX_LIFETIME"],
+                                        health_check_interval=options["HEALTH_CHECK_INTERVAL"],
+                                        timeout=options["TIMEOUT"])
+
+        return pools[key]
+
+
+def close_pools():
+    """
+    Closes the idle connections in every pool of this process. django.db.connections.close_all() only returns pooled
+    connections to their pools, so this is what actually closes them, e.g. before gunicorn forks workers from a process
+    that has used the database.
+    """
+    with pools_lock:
+        current = [pool for key, pool in pools.items() if key[0] == os.getpid()]
+
+    for pool in current:
+        pool.close_idle()
+
+
+def pool_metrics():
+    """
+    @return: A dictionary mapping each of this process's databases to its pool's metrics.
+    """
+    with pools_lock:
+        current = [(key[1:], pool) for key, pool in pools.items() if key[0] == os.getpid()]
+
+    return {"/".join(str(part) for part in key if part): pool.metrics() for key, pool in current}
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Makes a Django DatabaseWrapper check its connections out of a ConnectionPool and return them on close.
+    """
+
+    @property
+    def pool(self):
+        settings_dict = self.settings_dict
+        key = (self.alias, settings_dict["HOST"], settings_dict["PORT"], settings_dict["NAME"])
+        conn_params = self.get_connection_params()
+
+        return get_pool(key, lambda: super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params),
+                        settings_dict.get("POOL"))
+
+    def get_new_connection(self, conn_params):
+        return self.pool.acquire()
+
+    def _close(self):
+        if self.connection is None:
+            return
+
+        discard = False
+        try:
+            # never hand the next borrower an open transaction
+            self.connection.rollback()
+        except Exception:
+            discard = True
+
+        self.pool.release(self.connection, discard=discard or (self.errors_occurred and not self.is_usable()))
@@ -0,0 +1,173 @@
+"""
+Account deletion, done in the background so that deleting a large account doesn't tie up a web worker.
+
+DeleteAccountView deactivates the account, which signs the user out everywhere, and records an AccountDeletion. The
+process_account_deletions worker then picks the deletion up and calls process(), which deletes the backlog in batches
+of settings.ACCOUNT_DELETION_BATCH_SIZE entries, removing each batch's custom cover files with bulk storage calls, and
+finally deletes the user. Progress is saved after every batch and shown on the admin site.
+
+Every step can be repeated safely, so a deletion whose worker died (one that's been running without progress for
+settings.ACCOUNT_DELETION_STALE_SECONDS) or that failed is simply picked up again and carries on where it stopped.
+"""
+
+import datetime
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+import app.models as models
+import app.sharding as sharding
+import app.signals as signals
+from app.lazy import lazy_import
+
+cloudinary_api = lazy_import("cloudinary.api")
+cloudinary_storage = lazy_import("cloudinary_storage.storage")
+
+logger = logging.getLogger(__name__)
+
+# the most public IDs Cloudinary deletes in one call
+CLOUDINARY_BATCH_SIZE = 100
+
+
+def request_deletion(user: User):
+    """
+    Deactivates an account and queues it for deletion.
+    @param user: The user whose account to delete.
+    @return: The AccountDeletion object.
+    """
+    with transaction.atomic(using=sharding.PRIMARY):
+        user.is_active = False
+        user.save(update_fields=["is_active"])
+        deletion, _ = models.AccountDeletion.objects.update_or_create(
+            user_id=user.id, defaults={"username": user.username, "status": models.AccountDeletion.PENDING})
+
+    return deletion
+
+
+def claim():
+    """
+    Picks the next deletion to work on: the oldest one that's pending, or running without recent progress. Safe to
+    call from several workers at once, since only one of them can claim a given deletion.
+    @return: The claimed AccountDeletion object, or None if there's nothing to do.
+    """
+    stale = timezone.now() - datetime.timedelta(seconds=settings.ACCOUNT_DELETION_STALE_SECONDS)
+    candidates = (models.AccountDeletion.objects
+                  .filter(Q(status=models.AccountDeletion.PENDING) |
+                          Q(status=models.AccountDeletion.RUNNING, updated_at__lt=stale))
+                  .order_by("requested_at").values_list("id", "status", "updated_at")[:10])
+
+    for deletion_id, status, updated_at in candidates:
+        # matching on the state that was read means another worker claiming it first makes this update miss
+        claimed = models.AccountDeletion.objects.filter(id=deletion_id, status=status, updated_at=updated_at).update(
+            status=models.AccountDeletion.RUNNING, attempts=F("attempts") + 1, updated_at=timezone.now())
+        if claimed:
+            deletion = models.AccountDeletion.objects.get(id=deletion_id)
+            if deletion.started_at is None:
+                deletion.started_at = deletion.updated_at
+                deletion.save(update_fields=["started_at", "updated_at"])
+            return deletion
+
+    return None
+
+
+def delete_files(names):
+    """
+    Deletes files from the default storage, in as few calls as the storage allows: one per CLOUDINARY_BATCH_SIZE files
+    on Cloudinary, one per file otherwise. Files that are already gone are skipped.
+    @param names: The names of the files to delete.
+    """
+    names = [name for name in names if name]
+    if not names:
+        return
+
+    if not isinstance(default_storage, cloudinary_storage.MediaCloudinaryStorage):
+        for name in names:
+            default_storage.delete(name)
+        return
+
+    by_resource_type = {}
+    for name in names:
+        by_resource_type.setdefault(default_storage._get_resource_type(name), []).append(name)
+
+    for resource_type, public_ids in by_resource_type.items():
+        for start in range(0, len(public_ids), CLOUDINARY_BATCH_SIZE):
+            cloudinary_api.delete_resources(public_ids[start:start + CLOUDINARY_BATCH_SIZE],
+                                            resource_type=resource_type, invalidate=True)
+
+
+def delete_batch(user_id: int, shard: str, batch_size: int):
+    """
+    Deletes one batch of a user's backlog entries, along with their custom games and cover files. Covers are deleted
+    before the rows that point at them, so that a batch interrupted halfway is found and finished on the next attempt.
+    @param user_id: The ID of the user.
+    @param shard: The alias of the database holding the user's backlog.
+    @param batch_size: The most entries to delete.
+    @return: The number of entries and the number of cover files deleted.
+    """
+    entry_ids = list(models.BackloggedGame.objects.using(shard).filter(user_id=user_id).order_by("entry_id")
+                     .values_list("entry_id", flat=True)[:batch_size])
+    if not entry_ids:
+        return 0, 0
+
+    covers = [cover for cover in models.CustomGame.objects.using(shard).filter(backlogged_id__in=entry_ids)
+              .values_list("cover_img", flat=True) if cover]
+    delete_files(covers)
+
+    # the counters, statistics and tombstones go with the account, so the per-entry bookkeeping is skipped
+    with signals.bulk_changes(), transaction.atomic(using=shard):
+        models.CustomGame.objects.using(shard).filter(backlogged_id__in=entry_ids).delete()
+        models.BackloggedGame.objects.using(shard).filter(entry_id__in=entry_ids).delete()
+
+    return len(entry_ids), len(covers)
+
+
+def process(deletion: models.AccountDeletion, batch_size: int = None):
+    """
+    Carries out a claimed deletion: deletes the user's backlog in batches, saving progress after each, then the user.
+    If anything fails, the deletion is put back to be retried, or marked as failed after
+    settings.ACCOUNT_DELETION_MAX_ATTEMPTS attempts.
+    @param deletion: An AccountDeletion object from claim().
+    @param batch_size: Optional. Entries to delete per batch (default: settings.ACCOUNT_DELETION_BATCH_SIZE).
+    @return: True if the account was deleted.
+    """
+    batch_size = batch_size or settings.ACCOUNT_DELETION_BATCH_SIZE
+    shard = sharding.shard_for_user(deletion.user_id)
+
+    try:
+        while True:
+            num_entries, num_covers = delete_batch(deletion.user_id, shard, batch_size)
+            if not num_entries:
+                break
+
+            deletion.entries_deleted += num_entries
+            deletion.covers_deleted += num_covers
+            deletion.save(update_fields=["entries_deleted", "covers_deleted", "updated_at"])
+            logger.info("Deleting user %s: %s entries and %s covers deleted", deletion.user_id,
+                        deletion.entries_deleted, deletion.covers_deleted)
+
+        # what's left is small: the counters, statistics and tombstones in the shard (see app.signals), and the user's
+        # rows in the default database
+        user = User.objects.filter(id=deletion.user_id).first()
+        if user:
+            user.delete()
+    except Exception as error:
+        logger.exception("Deleting user %s failed", deletion.user_id)
+        deletion.status = (models.AccountDeletion.FAILED if deletion.attempts >= settings.ACCOUNT_DELETION_MAX_ATTEMPTS
+                           else models.AccountDeletion.PENDING)
+        deletion.last_error = f"{type(error).__name__}: {error}"
+        deletion.save(update_fields=["status", "last_error", "updated_at"])
+        return False
+
+    deletion.status = models.AccountDeletion.DONE
+    deletion.finished_at = timezone.now()
+    deletion.last_error = ""
+    deletion.save(update_fields=["status", "finished_at", "last_error", "updated_at"])
+    logger.info("Deleted user %s (%s entries, %s covers)", deletion.user_id, deletion.entries_deleted,
+                deletion.covers_deleted)
+
+    return True
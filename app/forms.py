@@ -2,11 +2,15 @@
 Forms.
 """
 
-import pytz
 from crispy_forms.helper import FormHelper
 from django import forms
+from django.conf import settings
+from django.urls import reverse_lazy
 
 from app.helpers import platform_getter
+from app.lazy import lazy_import
+
+pytz = lazy_import("pytz")
 
 
 class GameSearchForm(forms.Form):
@@ -25,7 +29,9 @@ class GameSearchForm(forms.Form):
         self.helper.form_show_labels = False
 
         # html attribute assignments
-        self.fields["query"].widget.attrs = {"placeholder": "Search for a game", "class": "form-control"}
+        self.fields["query"].widget.attrs = {"placeholder": "Search for a game", "class": "form-control",
+                                             "autocomplete": "off", "list": "typeaheadSuggestions",
+                                             "data-typeahead-url": reverse_lazy("api-typeahead")}
 
 
 class BacklogSearchForm(forms.Form):
@@ -55,6 +61,61 @@ class BacklogFilterForm(forms.Form):
     sort_option = forms.CharField()
 
 
+class EntryIdsField(forms.Field):
+    """
+    A list of backlog entry IDs, submitted as repeated values (e.g. one per checked checkbox).
+    """
+    widget = forms.MultipleHiddenInput
+
+    def to_python(self, value):
+        try:
+            return [int(entry_id) for entry_id in value or []]
+        except (TypeError, ValueError):
+            raise forms.ValidationError("Invalid backlog entry selection.")
+
+
+class BacklogBulkActionForm(forms.Form):
+    """
+    Facilitates changing several backlog entries at once from the backlog page.
+    """
+    MAX_ENTRIES = 500
+
+    # static fields
+    action = forms.ChoiceField(choices=[("now_playing", "Move to Now Playing"), ("backlog", "Move to backlog"),
+                                        ("platform", "Change platform"), ("remove", "Remove")])
+    entry_ids = EntryIdsField()
+
+    def __init__(self, *args, **kwargs):
+        # kwargs retrieval
+        user_platforms = kwargs.pop("user_platforms", [])
+
+        # super call
+        super().__init__(*args, **kwargs)
+
+        # platform field; limited to platforms already in the user's backlog, which are known without asking IGDB
+        self.fields["platform"] = forms.TypedChoiceField(
+            choices=[(platform["platform_id"], platform["platform_name"]) for platform in user_platforms],
+            coerce=int, required=False)
+
+        # html attribute assignments
+        self.fields["action"].widget.attrs = {"class": "select btn btn-secondary", "id": "bulkAction"}
+        self.fields["platform"].widget.attrs = {"class": "select btn btn-secondary", "id": "bulkPlatform"}
+
+    def clean_entry_ids(self):
+        entry_ids = self.cleaned_data["entry_ids"]
+        if len(entry_ids) > self.MAX_ENTRIES:
+            raise forms.ValidationError(f"You can change up to {self.MAX_ENTRIES} games at a time.")
+
+        return entry_ids
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get("action") == "platform" and not cleaned_data.get("platform"):
+            self.add_error("platform", "Choose a platform.")
+
+        return cleaned_data
+
+
 class GameUpdateForm(forms.Form):
     """
     Faciliates the handling of information about an individual game in a user's backlog, including adding and removing
@@ -149,6 +210,20 @@ class CustomGameForm(forms.Form):
             self.fields["now_playing"].widget.attrs["disabled"] = ""
             self.fields["now_playing"].widget.attrs["style"] = "pointer-events: none;"
 
+    def clean_cover_img(self):
+        """
+        Rejects covers too large to hold in the session between the form and the preview. Covers are stored
+        base64-encoded alongside the rest of the game's details, which are given 16 KB of headroom.
+        """
+        cover_img = self.cleaned_data["cover_img"]
+
+        if cover_img and settings.SESSION_MAX_VALUE_BYTES is not None:
+            max_bytes = (settings.SESSION_MAX_VALUE_BYTES - 16384) * 3 // 4
+            if cover_img.size > max_bytes:
+                raise forms.ValidationError(f"Cover art must be smaller than {max_bytes / 1024 / 1024:.1f} MB.")
+
+        return cover_img
+
 
 class CustomGameSubmit(forms.Form):
     """
@@ -4,41 +4,300 @@ cross-module use.
 """
 
 import base64
+import collections
+import contextlib
 import os
 import re
 import string
 import urllib.parse
 
-import arrow
-import requests
+from django.conf import settings
 from django.core.files.base import ContentFile
+from django.db import router, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.http import HttpRequest, QueryDict
-from igdb.igdbapi_pb2 import GameResult, PlatformResult
-from igdb.wrapper import IGDBWrapper
 
+import app.metrics as metrics
 import app.models as models
-
-
-def igdb_request(endpoint: str, query: str):
+import app.queries as queries
+import app.signals as signals
+import app.stats as stats
+import app.typeahead as typeahead
+from app.lazy import lazy_import
+
+arrow = lazy_import("arrow")
+igdbapi_pb2 = lazy_import("igdb.igdbapi_pb2")
+requests = lazy_import("requests")
+resilience = lazy_import("app.resilience")
+transport = lazy_import("app.transport")
+
+MAX_NOW_PLAYING = 10
+
+# the fields any view showing a single game may need; lookups of a game by ID always ask for all of them, so that every
+# view's lookup is served by the same cache entry
+GAME_FIELDS = frozenset({"name", "url", "cover.image_id", "summary", "platforms.name",
+                         "involved_companies.company.name", "involved_companies.developer",
+                         "involved_companies.publisher"})
+SEARCH_FIELDS = frozenset({"name", "cover.image_id", "platforms"})
+PLATFORM_FIELDS = frozenset({"name"})
+
+
+def igdb_request(query: queries.Query):
     """
     Sends an API request to IGDB (https://api-docs.igdb.com/).
-    @param endpoint: The endpoint to send the request to.
-    @param query: The body of the API request.
-    @return: An object containing the contents of IGDB's response.
+    @param query: The request, including the endpoint to send it to.
+    @return: An object containing the contents of IGDB's response, which may be stale if IGDB is unavailable.
+    @raise app.resilience.UpstreamUnavailable: If IGDB is unavailable and hasn't answered the same request before.
     """
     result_types = {
-        "games": GameResult(),
-        "platforms": PlatformResult()
+        "games": igdbapi_pb2.GameResult(),
+        "platforms": igdbapi_pb2.PlatformResult()
     }
 
-    wrapper = IGDBWrapper(client_id=os.getenv("IGDB_CLIENT_ID"), auth_token=os.getenv("IGDB_AUTH_TOKEN"))
-    results = result_types[endpoint]
-    response = wrapper.api_request(endpoint=f'{endpoint}.pb', query=query)
+    headers = {
+        "Client-ID": os.getenv("IGDB_CLIENT_ID"),
+        "Authorization": f"Bearer {os.getenv('IGDB_AUTH_TOKEN')}"
+    }
+
+    url = f"{settings.IGDB_API_URL}{query.endpoint}.pb"
+    body = str(query)
+
+    def fetch(timeout):
+        response = transport.get_transport().request("POST", url, headers=headers, data=body, timeout=timeout)
+        response.raise_for_status()
+        return response.content
 
-    results.ParseFromString(response)
+    results = result_types[query.endpoint]
+    results.ParseFromString(resilience.call("igdb", fetch, key=f"{url}\n{body}"))
     return results
 
 
+def get_num_now_playing(user_id: int):
+    """
+    Gets the number of games in a user's Now Playing from their denormalized counter, counting them from scratch (and
+    creating the counter) if the user doesn't have one yet.
+    @param user_id: The ID of a user.
+    @return: The number of games in the user's Now Playing.
+    """
+    counters = models.UserBacklogCounter.objects
+
+    try:
+        return counters.get(user_id=user_id).num_now_playing
+    except models.UserBacklogCounter.DoesNotExist:
+        return count_now_playing(user_id)
+
+
+def count_now_playing(user_id: int):
+    """
+    Counts the games in a user's Now Playing from scratch and stores the result in their counter, creating it if need
+    be.
+    @param user_id: The ID of a user.
+    @return: The number of games in the user's Now Playing.
+    """
+    using = router.db_for_write(models.UserBacklogCounter)
+    counters = models.UserBacklogCounter.objects.using(using)
+
+    # the row is committed before counting, so that entries saved from here on adjust it (see app.signals) instead of
+    # missing it; counting with the row locked then serializes the count with those adjustments
+    counters.get_or_create(user_id=user_id)
+    with transaction.atomic(using=using):
+        counter = counters.select_for_update().get(user_id=user_id)
+        counter.num_now_playing = models.BackloggedGame.objects.using(using).filter(
+            user_id=user_id, status_id=models.BacklogStatus.NOW_PLAYING).count()
+        counter.save(update_fields=["num_now_playing"])
+
+    return counter.num_now_playing
+
+
+class NowPlayingLimitError(Exception):
+    """
+    Raised when a change would put more than MAX_NOW_PLAYING games in a user's Now Playing.
+    """
+
+    def __init__(self, num_now_playing: int, num_added: int):
+        super().__init__(f"You can only have up to {MAX_NOW_PLAYING} games in your Now Playing at a time. You have "
+                         f"{num_now_playing} and tried to add {num_added}.")
+
+
+@contextlib.contextmanager
+def now_playing_room(user_id: int, num_added: int = 1):
+    """
+    Makes sure a user has room in their Now Playing for the games moved there in a with block, which runs in a
+    transaction. The user's counter stays locked until the transaction ends, so concurrent requests can't both take the
+    last place; the counter itself is updated by the saves in the block (see app.signals).
+    @param user_id: The ID of a user.
+    @param num_added: Optional. The number of games the block moves into Now Playing.
+    @raise NowPlayingLimitError: If there isn't room, before the block runs.
+    """
+    using = router.db_for_write(models.BackloggedGame)
+    counters = models.UserBacklogCounter.objects.using(using)
+
+    for _ in range(2):
+        with transaction.atomic(using=using):
+            # the same conditional update as bulk_update_backlog(), changing nothing but locking the row
+            if counters.filter(user_id=user_id, num_now_playing__lte=MAX_NOW_PLAYING - num_added).update(
+                    num_now_playing=F("num_now_playing")):
+                yield
+                return
+
+        # either there's no room or the user has no counter yet, which this creates (outside the transaction) so that
+        # there's a row to guard on the second try
+        num_now_playing = get_num_now_playing(user_id)
+        if num_now_playing + num_added > MAX_NOW_PLAYING:
+            break
+
+    raise NowPlayingLimitError(num_now_playing, num_added)
+
+
+def bulk_update_backlog(user_id: int, entry_ids: list, action: str, platform_id: int = None):
+    """
+    Applies one change to several of a user's backlog entries in a single transaction. Either every selected entry is
+    changed or none are.
+    @param user_id: The ID of a user.
+    @param entry_ids: The entry IDs of the user's entries to change. IDs of other users' entries are ignored.
+    @param action: "now_playing" or "backlog" to move the entries to or from Now Playing, "platform" to change their
+    platform, or "remove" to remove them from the backlog.
+    @param platform_id: The new platform for the "platform" action. Must already be registered.
+    @return: The number of entries changed; entries that already had the requested status or platform don't count.
+    """
+    using = router.db_for_write(models.BackloggedGame)
+    entries = models.BackloggedGame.objects.using(using).filter(user_id=user_id, entry_id__in=entry_ids)
+    counters = models.UserBacklogCounter.objects.using(using)
+    now = timezone.now()
+
+    # created first (outside the transaction), so that the limit check below has a row to guard
+    get_num_now_playing(user_id)
+
+    with transaction.atomic(using=using):
+        if action == "remove":
+            removed = list(entries.values_list("entry_id", "igdb_id", "custom_id", "status_id", "platform_id",
+                                               "date_added", "is_custom"))
+            with signals.bulk_changes():
+                entries.delete()
+
+            models.BacklogTombstone.objects.using(using).bulk_create(
+                models.BacklogTombstone(entry_id=entry_id, game_id=models.format_game_id(igdb_id, custom_id),
+                                        user_id=user_id)
+                for entry_id, igdb_id, custom_id, *_ in removed)
+            num_now_playing = sum(status_id == models.BacklogStatus.NOW_PLAYING for *_, status_id, _, _, _ in removed)
+            if num_now_playing:
+                counters.filter(user_id=user_id).update(num_now_playing=F("num_now_playing") - num_now_playing)
+
+            deltas = collections.Counter()
+            for *_, status_id, entry_platform_id, date_added, is_custom in removed:
+                deltas.subtract(stats.entry_keys(entry_platform_id, status_id, date_added, is_custom))
+            stats.adjust(user_id, deltas, using)
+
+            return len(removed)
+
+        if action in ("now_playing", "backlog"):
+            status_id = models.BacklogStatus.NOW_PLAYING if action == "now_playing" else models.BacklogStatus.BACKLOG
+            changed = list(entries.exclude(status_id=status_id).select_for_update())
+            delta = len(changed) if action == "now_playing" else -len(changed)
+
+            if delta > 0:
+                # only succeeds while the user has room, so concurrent requests can't both squeeze in
+                if not counters.filter(user_id=user_id, num_now_playing__lte=MAX_NOW_PLAYING - delta).update(
+                        num_now_playing=F("num_now_playing") + delta):
+                    raise NowPlayingLimitError(get_num_now_playing(user_id), delta)
+            elif delta:
+                counters.filter(user_id=user_id).update(num_now_playing=F("num_now_playing") + delta)
+
+            deltas = collections.Counter({("status", str(status_id)): len(changed)})
+            for entry in changed:
+                deltas[("status", str(entry.status_id))] -= 1
+                entry.status_id, entry.updated_at = status_id, now
+                entry.saved_status_id = status_id
+            models.BackloggedGame.objects.using(using).bulk_update(changed, ["status_id", "updated_at"])
+            stats.adjust(user_id, deltas, using)
+
+            return len(changed)
+
+        if action == "platform":
+            changed = list(entries.exclude(platform_id=platform_id).select_for_update())
+
+            deltas = collections.Counter({("platform", str(platform_id)): len(changed)})
+            for entry in changed:
+                deltas[("platform", str(entry.platform_id))] -= 1
+                entry.platform_id, entry.updated_at = platform_id, now
+                entry.saved_platform_id = platform_id
+            models.BackloggedGame.objects.using(using).bulk_update(changed, ["platform", "updated_at"])
+            stats.adjust(user_id, deltas, using)
+
+            return len(changed)
+
+    raise ValueError(f'Unknown bulk action "{action}".')
+
+
+class BacklogEntryCache:
+    """
+    A request-scoped identity map of a user's backlog entries, so that a game's entry is fetched from the database at
+    most once per request no matter how many places look it up. Misses are remembered too.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.entries = {}
+
+    def get(self, game_id):
+        """
+        Gets a backlog entry.
+        @param game_id: The game's unique identifier.
+        @return: A BackloggedGame object, or None if the game isn't in the user's backlog.
+        """
+        game_id = str(game_id)
+
+        metrics.CACHE_REQUESTS.inc(cache="backlog_entries", result="hit" if game_id in self.entries else "miss")
+        if game_id not in self.entries:
+            try:
+                self.entries[game_id] = models.BackloggedGame.objects.select_related("customgame").get(
+                    user_id=self.user_id, **models.game_id_lookup(game_id))
+            except models.BackloggedGame.DoesNotExist:
+                self.entries[game_id] = None
+
+        return self.entries[game_id]
+
+    def forget(self, game_id):
+        """
+        Drops a cached entry (or miss) after the entry has been created or deleted.
+        @param game_id: The game's unique identifier.
+        """
+        self.entries.pop(str(game_id), None)
+
+
+def get_entry_cache(request: HttpRequest):
+    """
+    Gets the BacklogEntryCache belonging to a request, creating it on first use.
+    @param request: A Django HttpRequest object.
+    @return: A BacklogEntryCache object.
+    """
+    if not hasattr(request, "backlog_entries"):
+        request.backlog_entries = BacklogEntryCache(request.user.id)
+
+    return request.backlog_entries
+
+
+def get_search_query(search: str, offset: int = 0):
+    """
+    Builds the IGDB query for a page of game search results.
+    @param search: The search query, as entered by the user.
+    @param offset: Optional. How many results to skip.
+    @return: A Query object.
+    """
+    return queries.Query("games").search(search).fields(*SEARCH_FIELDS).where(category=0).offset(offset).limit(50)
+
+
+def get_game_info_query(game_id: int, fields=()):
+    """
+    Builds the IGDB query for a single game.
+    @param game_id: The game's unique identifier on IGDB.
+    @param fields: Optional. Fields needed beyond GAME_FIELDS. Views that need fewer fields get them all anyway.
+    @return: A Query object.
+    """
+    return queries.Query("games").fields(*fields).widen(GAME_FIELDS).where(id=int(game_id))
+
+
 def get_search_view_dicts(search: str, user_id: str, offset: int = 0):
     """
     Gets game information dictionaries for AddGameSearchResultsView.
@@ -50,68 +309,64 @@ def get_search_view_dicts(search: str, user_id: str, offset: int = 0):
     """
     game_info_dicts = []
 
-    results = igdb_request(endpoint='games', query=f'search "{search}";'
-                                                   f'fields name, cover.url, platforms;'
-                                                   f'where category = 0;'
-                                                   f'offset {offset};'
-                                                   f'limit 50;')
+    results = igdb_request(get_search_query(search, offset))
+
+    # the statuses of every result already in the user's backlog, in one query
+    game_ids = [game.id for game in results.games]
+    statuses = dict(models.BackloggedGame.objects.filter(user_id=user_id, igdb_id__in=game_ids)
+                    .values_list("igdb_id", "status_id"))
 
     for game in results.games:
-        if game.cover.url and game.platforms:
+        if game.cover.image_id and game.platforms:
             game_dict = {
                 "id": game.id,
                 "name": game.name,
-                "cover_url": f"https:{game.cover.url}".replace("t_thumb", "t_cover_big")
+                "cover_image_id": game.cover.image_id,
+                "cover_url": models.igdb_image_url(game.cover.image_id, models.IGDB_DEFAULT_COVER_SIZE)
             }
 
-            try:
-                backlog = models.BackloggedGame.objects
-                backlogged = backlog.get(game_id=game.id, user_id=user_id)
-            except models.BackloggedGame.DoesNotExist:
-                pass
-            else:
-                game_dict["status_id"] = backlogged.status_id
+            if game.id in statuses:
+                game_dict["status_id"] = statuses[game.id]
 
             game_info_dicts.append(game_dict)
 
+    typeahead.index.add_many((game.id, game.name) for game in results.games)
+
     return game_info_dicts
 
 
-# noinspection PyUnboundLocalVariable
-def get_game_info_dict(game_id: int, mode: str, user_id: int):
+def get_game_info_dict(game_id: int, mode: str, user_id: int, entries: BacklogEntryCache = None):
     """
     Gets game information dictionary for GameInfoView.
     @param game_id: The game's unique identifier.
     @param mode: Defines which kind of game dictionary to get ("igdb" for games on IGDB or
     "custom" for games created by a user).
     @param user_id: The ID of a user.
+    @param entries: Optional. The request's BacklogEntryCache, so the user's entry for the game can be shared with the
+    caller instead of fetched again.
     @return: A dictionary containing information about the game identified by game_id.
     """
 
     game_dict = {}
 
-    try:
-        backlogged = models.BackloggedGame.objects.get(game_id=game_id, user_id=user_id)
-    except models.BackloggedGame.DoesNotExist:
-        pass
-    else:
+    if entries is None:
+        entries = BacklogEntryCache(user_id)
+
+    backlogged = entries.get(game_id)
+    if backlogged:
         game_dict["status_id"] = backlogged.status_id
 
     if mode == "igdb":
-        results = igdb_request(
-            endpoint='games',
-            query=f'fields name, url, cover.url, summary, platforms.name,'
-                  f'involved_companies.company.name, involved_companies.developer,'
-                  f'involved_companies.publisher;'
-                  f'where id = {game_id};'
-        )
+        results = igdb_request(get_game_info_query(game_id))
 
         game = results.games[0]
+        typeahead.index.add(game.id, game.name)
 
         game_dict.update({
             "id": game.id,
             "name": game.name,
-            "cover_url": f"https:{game.cover.url}".replace("t_thumb", "t_cover_big"),
+            "cover_image_id": game.cover.image_id,
+            "cover_url": models.igdb_image_url(game.cover.image_id, models.IGDB_DEFAULT_COVER_SIZE),
             "platforms": [],
             "involved_companies": "",
             "is_custom": False
@@ -131,6 +386,7 @@ def get_game_info_dict(game_id: int, mode: str, user_id: int):
         game_dict.update({
             "id": backlogged.game_id,
             "name": backlogged.game_name,
+            "cover_image_id": "",
             "cover_url": backlogged.cover_url,
             "involved_companies": backlogged.custom_data.involved_companies,
             "is_custom": True,
@@ -149,14 +405,13 @@ def platform_getter(platform_id=None):
     by its value.
     @return: A list of dictionaries containing names and unique identifiers for platforms on IGDB.
     """
+    query = queries.Query("platforms").widen(PLATFORM_FIELDS)
     if platform_id:
-        query = f'fields name;' \
-                f'where id = {platform_id}'
+        query = query.where(id=int(platform_id))
     else:
-        query = 'fields name;' \
-                'limit 500;'
+        query = query.limit(500)
 
-    results = igdb_request(endpoint='platforms', query=query)
+    results = igdb_request(query)
 
     return platform_handler(results.platforms)
 
@@ -331,6 +586,16 @@ def pagination_helper(page: int, last_page: int):
     return page_range
 
 
+def backlog_search_regex(query: str):
+    """
+    Builds the regular expression used to search backlogs by game name. Punctuation and whitespace between the
+    characters of the query are ignored, so "mario kart" also matches "Mario-Kart".
+    @param query: A search query.
+    @return: A regular expression string.
+    """
+    return "\\W*".join(re.escape(character) for character in query)
+
+
 def request_constructor(querydict: QueryDict, excluded=None):
     """
     Constructs request parameter strings from dictionaries.
@@ -354,7 +619,9 @@ def get_local_date(request: HttpRequest, use_api: bool):
     Gets the current date in the user's timezone for BacklogView.
     @param request: A Django HttpRequest object.
     @param use_api: If True, this function will determine the user's timezone by making an API request with the user's
-    IP address to http://ipwhois.app. If False, this function will retrieve the user's timezone from UserTimezoneModel.
+    IP address to ipwhois (http://ipwhois.app, or settings.IPWHOIS_API_URL). If False, this function will retrieve the
+    user's timezone from UserTimezoneModel.
+    If ipwhois is unavailable, UTC is used for now and the API is asked again on the user's next visit.
     @return: A date object representing the user's local date.
     """
     timezones = models.UserTimezone.objects
@@ -368,10 +635,18 @@ def get_local_date(request: HttpRequest, use_api: bool):
         return ip
 
     if use_api:
-        ip_address = get_ip_address()
-        geo_info = requests.get(f"http://ipwhois.app/json/{ip_address}").json()
-        user_timezone = geo_info["timezone"]
-        timezones.create(user_id=request.user.id, timezone=user_timezone)
+        url = f"{settings.IPWHOIS_API_URL}{get_ip_address()}"
+
+        def fetch(timeout):
+            response = transport.get_transport().request("GET", url, timeout=timeout)
+            response.raise_for_status()
+            return response.json()["timezone"]
+
+        try:
+            user_timezone = resilience.call("ipwhois", fetch, key=url)
+            timezones.create(user_id=request.user.id, timezone=user_timezone)
+        except (resilience.UpstreamUnavailable, requests.HTTPError):
+            user_timezone = "UTC"
     else:
         user_timezone = timezones.filter(user_id=request.user.id).values_list("timezone", flat=True)[0]
 
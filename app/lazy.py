@@ -0,0 +1,68 @@
+"""
+Deferred imports for heavy dependencies, so that workers only pay for the modules the requests they serve actually use.
+
+    arrow = lazy_import("arrow")
+
+binds a placeholder module that imports the real one the first time any of its attributes is used. Under gunicorn
+--preload, load_all() imports every deferred module in the master process instead, so that forked workers share them.
+"""
+
+import gc
+import importlib.util
+import sys
+
+# names of the modules deferred with lazy_import()
+deferred = set()
+
+
+def lazy_import(name: str):
+    """
+    Gets a module that is only imported once it's first used. Modules that are already imported are returned as is.
+    @param name: The module's absolute name (e.g. "igdb.igdbapi_pb2").
+    @return: A module object.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    deferred.add(name)
+
+    return module
+
+
+def load_all():
+    """
+    Imports every deferred module now.
+    @return: The names of the modules that were loaded.
+    """
+    for name in sorted(deferred):
+        # any attribute access finishes a LazyLoader import
+        getattr(sys.modules[name], "__dict__")
+
+    return sorted(deferred)
+
+
+def preload():
+    """
+    Imports everything a worker would otherwise import while serving its first requests: the URLconf (and with it
+    every view module), the template tag libraries and all deferred modules. Meant to run in gunicorn's master process
+    before it forks workers.
+    @return: The names of the deferred modules that were loaded.
+    """
+    from django.template import engines
+    from django.urls import get_resolver
+
+    get_resolver().url_patterns
+    # template engines import their tag libraries when they're created
+    engines.all()
+    loaded = load_all()
+
+    # keep the garbage collector from touching (and so un-sharing) the pages of everything loaded so far
+    gc.freeze()
+
+    return loaded
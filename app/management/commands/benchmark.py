@@ -0,0 +1,108 @@
+"""
+Runs Backlogged's offline load test.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+import app.benchmark as benchmark
+
+
+class Command(BaseCommand):
+    help = "Drives the backlog, search, game-info and add-game flows against a throwaway database and a local " \
+           "IGDB stand-in, then reports p50/p95/p99 latency and requests per second."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10,1000,50000",
+                            help="Comma-separated backlog sizes to seed users with.")
+        parser.add_argument("--concurrency", default="1,4,16",
+                            help="Comma-separated numbers of concurrent clients.")
+        parser.add_argument("--requests", type=int, default=100,
+                            help="Requests per flow, backlog size and concurrency level.")
+        parser.add_argument("--flows", default="backlog,search,game-info,add-game",
+                            help="Comma-separated flows to run.")
+        parser.add_argument("--latency", type=float, default=0.0,
+                            help="Milliseconds the IGDB stand-in waits before answering each request.")
+        parser.add_argument("--output", help="Write results to this JSON file for use as a baseline.")
+        parser.add_argument("--compare", help="Compare results to a baseline JSON file written by --output.")
+        parser.add_argument("--tolerance", type=float, default=10.0,
+                            help="Percentage slowdown in p95 latency or throughput that counts as a regression.")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        concurrency_levels = [int(level) for level in options["concurrency"].split(",")]
+        flow_names = options["flows"].split(",")
+
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                baseline = json.load(file)["results"]
+
+        with benchmark.FakeIGDBServer(latency=options["latency"] / 1000) as server, \
+                override_settings(SECURE_SSL_REDIRECT=False,
+                                  STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+                                  **server.upstream_settings):
+            old_name = benchmark.create_benchmark_database()
+            try:
+                results = self.run_benchmark(sizes, concurrency_levels, flow_names, options["requests"])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            "meta": {
+                "requests_per_run": options["requests"],
+                "igdb_latency_ms": options["latency"],
+                "database_vendor": connection.vendor,
+            },
+            "results": results,
+        }
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(f"Wrote baseline to {options['output']}")
+
+        if baseline is not None:
+            comparisons = benchmark.compare_to_baseline(results, baseline, options["tolerance"] / 100)
+            regressions = [comparison for comparison in comparisons if comparison["regressed"]]
+
+            for comparison in comparisons:
+                self.stdout.write(
+                    f"{comparison['flow']:<10} size={comparison['backlog_size']:<6} "
+                    f"c={comparison['concurrency']:<3} p95 {comparison['p95_change']:+.1%} "
+                    f"rps {comparison['rps_change']:+.1%}{'  REGRESSED' if comparison['regressed'] else ''}"
+                )
+
+            if regressions:
+                raise CommandError(f"{len(regressions)} result(s) regressed beyond {options['tolerance']}%.")
+
+    def run_benchmark(self, sizes: list, concurrency_levels: list, flow_names: list, num_requests: int):
+        results = []
+        first_new_game_id = max(sizes) + 1
+
+        self.stdout.write(f"{'flow':<10} {'size':>6} {'c':>3} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+                          f"{'rps':>8} {'errors':>6}")
+
+        for size in sizes:
+            user = benchmark.seed_benchmark_user(size)
+            flows = benchmark.benchmark_flows(size, first_new_game_id)
+
+            for flow_name in flow_names:
+                try:
+                    flow = flows[flow_name]
+                except KeyError:
+                    raise CommandError(f'Unknown flow "{flow_name}". Choose from: {", ".join(flows)}.')
+
+                for concurrency in concurrency_levels:
+                    result = benchmark.run_flow(user, flow, concurrency, num_requests)
+                    result.update({"flow": flow_name, "backlog_size": size, "concurrency": concurrency})
+                    results.append(result)
+
+                    self.stdout.write(f"{flow_name:<10} {size:>6} {concurrency:>3} {result['p50_ms']:>9} "
+                                      f"{result['p95_ms']:>9} {result['p99_ms']:>9} {result['rps']:>8} "
+                                      f"{result['errors']:>6}")
+
+        return results
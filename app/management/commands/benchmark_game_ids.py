@@ -0,0 +1,44 @@
+"""
+Compares the old text game_id column with the typed igdb_id/custom_id columns.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+import app.benchmark as benchmark
+
+
+class Command(BaseCommand):
+    help = "Builds a large backlog table with each game id layout in a throwaway database and reports index size " \
+           "and lookup time for both."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000, help="Backlog entries per table.")
+        parser.add_argument("--lookups", type=int, default=10_000, help="Random lookups to time per table.")
+        parser.add_argument("--output", help="Write results to this JSON file.")
+
+    def handle(self, *args, **options):
+        if connection.vendor not in benchmark.GAME_ID_COLUMN_TYPES:
+            raise CommandError(f"Game id benchmarks aren't supported on {connection.vendor}; run them against "
+                               f"{' or '.join(sorted(benchmark.GAME_ID_COLUMN_TYPES))}.")
+
+        old_name = benchmark.create_benchmark_database()
+        try:
+            results = benchmark.compare_game_id_layouts(options["rows"], options["lookups"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(f"{'layout':<8} {'index bytes':>14} {'lookup us':>10}")
+        for layout, result in results.items():
+            self.stdout.write(f"{layout:<8} {result['index_bytes']:>14} {result['lookup_us']:>10}")
+
+        text, typed = results["text"], results["typed"]
+        if text["index_bytes"] and text["lookup_us"]:
+            self.stdout.write(f"typed vs text: index size {typed['index_bytes'] / text['index_bytes'] - 1:+.0%}, "
+                              f"lookup time {typed['lookup_us'] / text['lookup_us'] - 1:+.0%}")
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump({"rows": options["rows"], "lookups": options["lookups"], "results": results}, file, indent=2)
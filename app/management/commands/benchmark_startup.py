@@ -0,0 +1,38 @@
+"""
+Measures worker boot time and memory with and without deferred imports.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+import app.benchmark as benchmark
+
+
+class Command(BaseCommand):
+    help = "Boots fresh worker processes in each import mode and reports the median boot time, resident memory, " \
+           "private (unshared) memory and number of imported modules."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--modes", default="eager,lazy,preload",
+                            help=f"Comma-separated modes to measure: {', '.join(benchmark.STARTUP_MODES)}.")
+        parser.add_argument("--runs", type=int, default=5, help="Processes to boot per mode.")
+        parser.add_argument("--output", help="Write results to this JSON file.")
+
+    def handle(self, *args, **options):
+        modes = options["modes"].split(",")
+        unknown = [mode for mode in modes if mode not in benchmark.STARTUP_MODES]
+        if unknown:
+            raise CommandError(f'Unknown mode(s) {", ".join(unknown)}. Choose from: '
+                               f'{", ".join(benchmark.STARTUP_MODES)}.')
+
+        results = {}
+        self.stdout.write(f"{'mode':<8} {'boot ms':>9} {'rss kB':>9} {'private kB':>11} {'modules':>8}")
+        for mode in modes:
+            result = results[mode] = benchmark.measure_startup(mode, options["runs"])
+            self.stdout.write(f"{mode:<8} {result['boot_ms']:>9} {result['rss_kb']:>9} {result['private_kb']:>11} "
+                              f"{result['modules']:>8}")
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump({"runs": options["runs"], "results": results}, file, indent=2)
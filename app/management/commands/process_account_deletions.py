@@ -0,0 +1,39 @@
+"""
+Runs the worker that deletes accounts queued by DeleteAccountView (see app.deletion).
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import app.deletion as deletion
+
+
+class Command(BaseCommand):
+    help = "Deletes the accounts users have asked to delete, in batches, picking up deletions that were interrupted. " \
+           "Runs until stopped, or with --once, until there's nothing left to delete."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit once no deletions are waiting.")
+        parser.add_argument("--batch-size", type=int,
+                            help="Backlog entries to delete per batch (default: settings.ACCOUNT_DELETION_BATCH_SIZE).")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            claimed = deletion.claim()
+
+            if claimed is None:
+                if options["once"]:
+                    return
+                time.sleep(settings.ACCOUNT_DELETION_POLL_SECONDS)
+                continue
+
+            self.stdout.write(f"Deleting user {claimed.user_id} ({claimed.username}), attempt {claimed.attempts}")
+            if deletion.process(claimed, options["batch_size"]):
+                self.stdout.write(f"Deleted user {claimed.user_id}: {claimed.entries_deleted} entries and "
+                                  f"{claimed.covers_deleted} covers.")
+            else:
+                self.stderr.write(f"Deleting user {claimed.user_id} failed ({claimed.status}): {claimed.last_error}")
@@ -0,0 +1,25 @@
+"""
+Deletes the backlog tombstones that no sync token can reach any more.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+import app.api as api
+import app.models as models
+
+
+class Command(BaseCommand):
+    help = "Deletes the tombstones of backlog entries deleted longer ago than sync tokens are honored, in every " \
+           "shard. Meant to run periodically (e.g. daily from a scheduler) so that syncs themselves never write."
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - api.SYNC_RETENTION
+        num_pruned = 0
+
+        for shard in settings.BACKLOG_SHARDS:
+            num_deleted, _ = models.BacklogTombstone.objects.using(shard).filter(deleted_at__lt=cutoff).delete()
+            num_pruned += num_deleted
+
+        self.stdout.write(f"Pruned {num_pruned} tombstones older than {cutoff:%Y-%m-%d %H:%M}.")
@@ -0,0 +1,86 @@
+"""
+Moves users' backlogs between shards.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+import app.models as models
+import app.sharding as sharding
+
+
+class Command(BaseCommand):
+    help = "Moves one user's backlog to a given shard, or moves the largest backlogs off the fullest shard until " \
+           "every shard is within --tolerance of the average."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, help="The ID of a single user to move.")
+        parser.add_argument("--to", help="The shard to move --user to.")
+        parser.add_argument("--tolerance", type=float, default=10.0,
+                            help="Percentage above the average shard size that counts as balanced.")
+        parser.add_argument("--max-moves", type=int, default=100, help="The most users to move in one run.")
+        parser.add_argument("--dry-run", action="store_true", help="Print the moves without making them.")
+
+    def handle(self, *args, **options):
+        if not sharding.is_enabled():
+            raise CommandError("Sharding is off; set SHARD_DATABASE_URLS to add shards.")
+
+        if options["user"] is not None:
+            if not options["to"]:
+                raise CommandError("--user needs --to.")
+            moves = [(options["user"], sharding.shard_for_user(options["user"]), options["to"])]
+        else:
+            moves = self.plan_moves(options["tolerance"] / 100, options["max_moves"])
+
+        for user_id, source, target in moves:
+            if options["dry_run"]:
+                self.stdout.write(f"would move user {user_id} from {source} to {target}")
+                continue
+
+            try:
+                num_entries = sharding.move_user(user_id, target)
+            except sharding.ShardingError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f"moved user {user_id} ({num_entries} entries) from {source} to {target}")
+
+        if not moves:
+            self.stdout.write("Shards are already balanced.")
+
+    @staticmethod
+    def plan_moves(tolerance: float, max_moves: int):
+        """
+        Greedily picks users to move from the fullest shard to the emptiest one.
+        @param tolerance: The fraction above the average shard size that counts as balanced.
+        @param max_moves: The most moves to plan.
+        @return: A list of (user ID, source shard, target shard) tuples.
+        """
+        sizes = sharding.shard_sizes()
+        average = sum(sizes.values()) / len(sizes)
+        users = {
+            shard: list(models.BackloggedGame.objects.using(shard).values("user_id")
+                        .annotate(num_entries=Count("entry_id")).order_by("-num_entries")
+                        .values_list("user_id", "num_entries"))
+            for shard in settings.BACKLOG_SHARDS
+        }
+
+        moves = []
+        while len(moves) < max_moves:
+            source = max(sizes, key=sizes.get)
+            target = min(sizes, key=sizes.get)
+            if sizes[source] <= average * (1 + tolerance) or not users[source]:
+                break
+
+            # the biggest backlog that doesn't just make the target the new fullest shard
+            gap = sizes[source] - sizes[target]
+            candidates = [(user_id, num_entries) for user_id, num_entries in users[source] if num_entries < gap]
+            if not candidates:
+                break
+
+            user_id, num_entries = candidates[0]
+            users[source].remove((user_id, num_entries))
+            sizes[source] -= num_entries
+            sizes[target] += num_entries
+            moves.append((user_id, source, target))
+
+        return moves
@@ -0,0 +1,75 @@
+"""
+Builds or checks the per-user backlog statistics kept by app.stats.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import app.models as models
+import app.stats as stats
+
+
+class Command(BaseCommand):
+    help = "Builds every user's backlog statistics from their backlog (e.g. to backfill users who've never opened " \
+           "their stats page), or with --check, reports users whose statistics have drifted from their backlog."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, action="append", dest="users",
+                            help="The ID of a user to rebuild or check; can be given more than once. Defaults to "
+                                 "every user with a backlog or statistics.")
+        parser.add_argument("--check", action="store_true",
+                            help="Only compare statistics with backlogs, and fail if any differ.")
+        parser.add_argument("--fix", action="store_true",
+                            help="With --check, rebuild the users whose statistics differ.")
+        parser.add_argument("--missing", action="store_true", help="Only build statistics for users who have none.")
+
+    def handle(self, *args, **options):
+        num_users = num_built = num_drifted = 0
+
+        for shard in settings.BACKLOG_SHARDS:
+            built = set(models.BacklogStat.objects.using(shard).filter(dimension=stats.TOTAL[0])
+                        .values_list("user_id", flat=True)) if options["missing"] else set()
+
+            for user_id in self.get_user_ids(shard, options["users"]):
+                num_users += 1
+
+                if not options["check"]:
+                    if user_id not in built:
+                        stats.build(user_id, shard)
+                        num_built += 1
+                    continue
+
+                differences = stats.check(user_id, shard)
+                if differences:
+                    num_drifted += 1
+                    details = ", ".join(f"{' '.join(filter(None, key))} is {stored}, should be {actual}"
+                                        for key, (stored, actual) in sorted(differences.items()))
+                    self.stdout.write(f"user {user_id} in {shard}: {details}")
+                    if options["fix"]:
+                        stats.build(user_id, shard)
+
+        if not options["check"]:
+            self.stdout.write(f"Built statistics for {num_built} of {num_users} users.")
+            return
+
+        self.stdout.write(f"Checked {num_users} users; {num_drifted} had drifted"
+                          f"{' and were rebuilt' if options['fix'] and num_drifted else ''}.")
+        if num_drifted and not options["fix"]:
+            raise CommandError("Some users' statistics don't match their backlogs; rerun with --fix to rebuild them.")
+
+    @staticmethod
+    def get_user_ids(shard: str, user_ids=None):
+        """
+        Lists the users with a backlog or statistics in a shard.
+        @param shard: The alias of a database in settings.BACKLOG_SHARDS.
+        @param user_ids: Optional. Only these users.
+        @return: A sorted list of user IDs.
+        """
+        found = set()
+        for model in (models.BackloggedGame, models.BacklogStat):
+            queryset = model.objects.using(shard)
+            if user_ids:
+                queryset = queryset.filter(user_id__in=user_ids)
+            found.update(queryset.values_list("user_id", flat=True).distinct())
+
+        return sorted(found)
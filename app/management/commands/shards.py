@@ -0,0 +1,43 @@
+"""
+Reports on the shards users' backlogs are spread across.
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+import app.models as models
+import app.sharding as sharding
+
+
+class Command(BaseCommand):
+    help = "Prints how many users and backlog entries each shard holds, or which shard holds a given user's backlog."
+
+    def add_arguments(self, parser):
+        parser.add_argument("users", nargs="*", help="Usernames or IDs of users to locate.")
+
+    def handle(self, *args, **options):
+        if options["users"]:
+            for identifier in options["users"]:
+                self.locate(identifier)
+            return
+
+        directory_counts = {shard: models.UserShard.objects.filter(shard=shard).count()
+                            for shard in settings.BACKLOG_SHARDS}
+        # users without a directory row have their backlog in the default database
+        directory_counts[sharding.PRIMARY] += User.objects.count() - models.UserShard.objects.count()
+
+        self.stdout.write(f"{'shard':<12} {'users':>8} {'entries':>10}")
+        for shard, num_entries in sharding.shard_sizes().items():
+            self.stdout.write(f"{shard:<12} {directory_counts.get(shard, 0):>8} {num_entries:>10}")
+
+    def locate(self, identifier: str):
+        lookup = {"id": int(identifier)} if identifier.isdigit() else {"username": identifier}
+        try:
+            user = User.objects.get(**lookup)
+        except User.DoesNotExist:
+            raise CommandError(f'No user "{identifier}".')
+
+        shard = sharding.shard_for_user(user.id)
+        num_entries = models.BackloggedGame.objects.using(shard).filter(user_id=user.id).count()
+        self.stdout.write(f"{user.username} (id {user.id}): {num_entries} entries in {shard}")
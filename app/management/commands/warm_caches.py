@@ -0,0 +1,50 @@
+"""
+Warms the upstream response caches with the data most pages need, e.g. after a deploy.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import app.warmup as warmup
+
+
+class Command(BaseCommand):
+    help = "Prefills the upstream caches with the platform list, the latest GitHub release, and the IGDB data for " \
+           "the games and searches popular in recent backlog activity, then reports what was warmed and how long it " \
+           "took."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--games", type=int, help="Popular games to warm (default: settings.WARM_CACHES_GAMES).")
+        parser.add_argument("--searches", type=int,
+                            help="Searches to warm (default: settings.WARM_CACHES_NUM_SEARCHES).")
+        parser.add_argument("--days", type=int,
+                            help="Days of backlog activity to find popular games in (default: "
+                                 "settings.WARM_CACHES_DAYS).")
+        parser.add_argument("--workers", type=int, help="Concurrent requests (default: settings.WARM_CACHES_WORKERS).")
+        parser.add_argument("--rate", type=float,
+                            help="Requests started per second (default: settings.WARM_CACHES_RATE).")
+        parser.add_argument("--max-seconds", type=float,
+                            help="Seconds after which requests not yet started are skipped (default: "
+                                 "settings.WARM_CACHES_MAX_SECONDS).")
+
+    def handle(self, *args, **options):
+        if "locmem" in settings.CACHES[settings.UPSTREAM_CACHE_ALIAS]["BACKEND"]:
+            self.stderr.write("The upstream cache is in-process, so this only checks that warming works; set "
+                              "UPSTREAM_CACHE_BACKEND to a shared cache for it to warm the caches workers use.")
+
+        start = time.perf_counter()
+        results = warmup.warm_caches(options["games"], options["searches"], options["days"], options["workers"],
+                                     options["rate"], options["max_seconds"])
+        elapsed = time.perf_counter() - start
+
+        for result in results:
+            outcome = f"failed: {result.error}" if result.error else result.detail
+            self.stdout.write(f"{result.seconds * 1000:>8.0f} ms  {result.name}  ({outcome})")
+
+        failed = sum(1 for result in results if result.error)
+        self.stdout.write(f"Warmed {len(results) - failed} of {len(results)} cache entries in {elapsed:.1f}s.")
+
+        if failed == len(results):
+            raise CommandError("Nothing could be warmed.")
@@ -0,0 +1,246 @@
+"""
+Opt-in memory profiling with tracemalloc, for finding out what makes workers' memory grow.
+
+With settings.MEMORY_PROFILING on, MemoryProfilingMiddleware starts tracing allocations when a worker loads it, and
+measures the peak memory of a sample (settings.MEMORY_PROFILING_SAMPLE_RATE) of requests, by view. Staff can take heap
+snapshots of the worker serving them from MemoryProfileView, and see which modules hold the most memory or grew the
+most between two snapshots. Allocations are attributed to the innermost module of the app that led to them, so that
+e.g. memory held by protobuf objects shows up under the helper that parsed them; allocations made outside of any app
+code are attributed to the package that made them.
+
+Everything here is per process: each worker traces, samples and keeps snapshots of its own memory. Tracing slows
+allocations down and takes memory of its own, so it should only be turned on while investigating.
+"""
+
+import collections
+import functools
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+
+import app.metrics as metrics
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(APP_DIR)
+
+# allocations made by tracemalloc itself and by the import system, which aren't worth looking at
+IGNORED = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*"),
+           tracemalloc.Filter(False, "<unknown>"))
+
+# a heap snapshot of this process
+Snapshot = collections.namedtuple("Snapshot", ["label", "taken_at", "snapshot", "traced"])
+# the memory attributed to one module: its size and number of blocks, how much each grew, and its largest sites
+Group = collections.namedtuple("Group", ["module", "size", "count", "size_diff", "count_diff", "sites"])
+
+snapshots = collections.OrderedDict()
+# the peak memory of sampled requests, by view: [number of requests, total of their peaks, largest peak, its path]
+peaks = {}
+lock = threading.Lock()
+
+
+def is_tracing():
+    return tracemalloc.is_tracing()
+
+
+def start():
+    """
+    Starts tracing this process's allocations, if settings.MEMORY_PROFILING is on.
+    @return: True if allocations are being traced.
+    """
+    if settings.MEMORY_PROFILING and not tracemalloc.is_tracing():
+        tracemalloc.start(settings.MEMORY_PROFILING_FRAMES)
+
+    return tracemalloc.is_tracing()
+
+
+def get_rss():
+    """
+    @return: The resident set size of this process in bytes, or None where it can't be read (outside of Linux).
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_status():
+    """
+    @return: A dictionary with whether allocations are being traced ("tracing") and, in bytes, this process's resident
+    memory ("rss"), the traced memory in use ("traced") and at its peak ("traced_peak"), and the memory tracing itself
+    takes ("overhead").
+    """
+    traced, traced_peak = tracemalloc.get_traced_memory()
+    return {"tracing": tracemalloc.is_tracing(), "rss": get_rss(), "traced": traced, "traced_peak": traced_peak,
+            "overhead": tracemalloc.get_tracemalloc_memory()}
+
+
+def take_snapshot(label: str = None):
+    """
+    Takes a heap snapshot of this process, dropping the oldest one if settings.MEMORY_PROFILING_SNAPSHOTS are already
+    kept (snapshots take a lot of memory themselves).
+    @param label: Optional. A name for the snapshot; defaults to the time it was taken.
+    @return: The Snapshot object.
+    """
+    snapshot = Snapshot(label or time.strftime("%H:%M:%S"), time.time(), tracemalloc.take_snapshot().filter_traces(
+        IGNORED), tracemalloc.get_traced_memory()[0])
+
+    with lock:
+        snapshots.pop(snapshot.label, None)
+        snapshots[snapshot.label] = snapshot
+        while len(snapshots) > settings.MEMORY_PROFILING_SNAPSHOTS:
+            snapshots.popitem(last=False)
+
+    return snapshot
+
+
+def clear():
+    with lock:
+        snapshots.clear()
+        peaks.clear()
+
+
+def get_snapshots():
+    with lock:
+        return list(snapshots.values())
+
+
+@functools.lru_cache(maxsize=None)
+def get_import_roots():
+    return sorted({os.path.abspath(entry or os.curdir) for entry in sys.path}, key=len, reverse=True)
+
+
+@functools.lru_cache(maxsize=4096)
+def module_name(filename: str):
+    """
+    Works out which module a source file is, from the import paths.
+    @param filename: A frame's filename.
+    @return: The module's dotted name (e.g. "django.forms.widgets"), or the filename if it isn't on an import path.
+    """
+    path = os.path.abspath(filename)
+    for root in get_import_roots():
+        if path.startswith(root + os.sep):
+            name = os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, ".")
+            return name[:-len(".__init__")] if name.endswith(".__init__") else name
+
+    return filename
+
+
+def attribute(traceback):
+    """
+    Decides who to hold responsible for an allocation: the innermost frame in the app if there is one, otherwise the
+    package (e.g. "google.protobuf") of the frame that allocated. Modules imported by the app are responsible for what
+    they allocate while being imported.
+    @param traceback: A tracemalloc.Traceback, oldest frame first.
+    @return: The module to group the allocation under, and a description of where it happened.
+    """
+    allocator = traceback[-1]
+    allocated_in = f"{module_name(allocator.filename)}:{allocator.lineno}"
+
+    for frame in reversed(traceback):
+        if frame.filename.startswith("<frozen importlib"):
+            break
+        if frame.filename.startswith(APP_DIR + os.sep):
+            module = module_name(frame.filename)
+            site = f"{os.path.relpath(frame.filename, BASE_DIR)}:{frame.lineno}"
+            return module, site if frame == allocator else f"{site} via {module_name(allocator.filename)}"
+
+    return ".".join(module_name(allocator.filename).split(".")[:2]), allocated_in
+
+
+def group_by_module(statistics, limit: int = None, sites_per_module: int = 3):
+    """
+    Adds up allocations by the module they're attributed to (see attribute()).
+    @param statistics: Statistic objects from Snapshot.statistics("traceback"), or StatisticDiff objects from
+    Snapshot.compare_to(..., "traceback").
+    @param limit: Optional. The most modules to return.
+    @param sites_per_module: Optional. The most allocation sites to list for each module.
+    @return: A list of Group objects, ordered by growth for diffs and by size otherwise, largest first.
+    """
+    totals = collections.defaultdict(lambda: [0, 0, 0, 0, collections.Counter()])
+
+    for statistic in statistics:
+        module, site = attribute(statistic.traceback)
+        size_diff, count_diff = getattr(statistic, "size_diff", 0), getattr(statistic, "count_diff", 0)
+
+        total = totals[module]
+        total[0] += statistic.size
+        total[1] += statistic.count
+        total[2] += size_diff
+        total[3] += count_diff
+        total[4][site] += size_diff if hasattr(statistic, "size_diff") else statistic.size
+
+    is_diff = any(hasattr(statistic, "size_diff") for statistic in statistics)
+    groups = [Group(module, size, count, size_diff, count_diff, sites.most_common(sites_per_module))
+              for module, (size, count, size_diff, count_diff, sites) in totals.items()]
+    groups.sort(key=lambda group: -(group.size_diff if is_diff else group.size))
+
+    return groups[:limit]
+
+
+def report(snapshot: Snapshot, baseline: Snapshot = None, limit: int = None):
+    """
+    Summarizes a snapshot, or what changed since an earlier one.
+    @param snapshot: A Snapshot object.
+    @param baseline: Optional. An earlier Snapshot object to compare it with.
+    @param limit: Optional. The most modules to list (default: settings.MEMORY_PROFILING_TOP).
+    @return: A list of Group objects.
+    """
+    if baseline:
+        statistics = snapshot.snapshot.compare_to(baseline.snapshot, "traceback")
+    else:
+        statistics = snapshot.snapshot.statistics("traceback")
+
+    return group_by_module(statistics, limit or settings.MEMORY_PROFILING_TOP)
+
+
+def should_sample():
+    return tracemalloc.is_tracing() and random.random() < settings.MEMORY_PROFILING_SAMPLE_RATE
+
+
+def begin_sample():
+    """
+    Starts measuring a request's peak memory. The peak is process-wide, so with threaded workers, requests handled at
+    the same time add to each other's.
+    @return: The memory in use, to pass to end_sample().
+    """
+    tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def end_sample(start: int, view: str, path: str):
+    """
+    Records a sampled request's peak memory.
+    @param start: The value returned by begin_sample().
+    @param view: The name of the view that handled the request.
+    @param path: The request's path.
+    @return: The most memory the request had allocated at once, in bytes.
+    """
+    peak = max(tracemalloc.get_traced_memory()[1] - start, 0)
+    metrics.HTTP_REQUEST_PEAK_MEMORY.observe(peak, view=view)
+
+    with lock:
+        summary = peaks.setdefault(view, [0, 0, 0, ""])
+        summary[0] += 1
+        summary[1] += peak
+        if peak >= summary[2]:
+            summary[2], summary[3] = peak, path
+
+    return peak
+
+
+def get_peaks():
+    """
+    @return: A list of (view, number of sampled requests, average peak, largest peak, path of the largest) tuples,
+    largest peak first.
+    """
+    with lock:
+        summaries = [(view, num_requests, total // num_requests, largest, path)
+                     for view, (num_requests, total, largest, path) in peaks.items()]
+
+    return sorted(summaries, key=lambda summary: -summary[3])
@@ -0,0 +1,422 @@
+"""
+An in-process metrics registry, exported in the Prometheus text format by MetricsView.
+
+Each process keeps its own counters, gauges and histograms. When settings.METRICS_DIR is set (which it must be when
+running several gunicorn workers), every process also writes a snapshot of its metrics to a file in that directory at
+most every settings.METRICS_FLUSH_SECONDS, and a scrape, whichever worker serves it, adds up the snapshots of every
+process. Snapshots of workers that have exited are folded into an archive file by gunicorn's child_exit hook (see
+archive_process()), so that counters never go backwards; their gauges are dropped.
+
+Values that are kept elsewhere (session cache counters, connection pool sizes) are copied into the registry by
+collectors just before each snapshot.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+
+# upper bounds, in seconds, of the default histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ARCHIVE_FILE = "archive.json"
+
+
+class Metric:
+    """
+    A named metric with zero or more labels. Each combination of label values holds its own value.
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        """
+        @param name: The metric's name (e.g. "backlogged_upstream_request_duration_seconds").
+        @param documentation: A one-line description, exported as the metric's HELP text.
+        @param labels: Optional. The names of the metric's labels.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        registry.register(self)
+
+    def key(self, labels: dict):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {self.labels}, not {tuple(labels)}.")
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def snapshot(self):
+        """
+        @return: A JSON-serializable copy of the metric's definition and values.
+        """
+        with self.lock:
+            values = [[list(key), value] for key, value in self.values.items()]
+
+        return {"type": self.type, "help": self.documentation, "labels": list(self.labels), "values": values}
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g. a number of requests.
+    """
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """
+        Sets the counter's total. Only meant for collectors that mirror a counter kept elsewhere.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, e.g. a number of open connections. Only the gauges of running processes are
+    exported.
+    """
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, e.g. request durations, counted into cumulative buckets.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        @param buckets: Optional. The buckets' upper bounds, in ascending order.
+        """
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labels)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        bucket = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+
+        with self.lock:
+            # one count per bucket plus one for values above the last bound, then the sum of all observed values
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def set(self, counts, total: float, **labels):
+        """
+        Sets the histogram's bucket counts and sum. Only meant for collectors that mirror a histogram kept elsewhere.
+        @param counts: The number of values in each bucket, plus one for values above the last bound.
+        @param total: The sum of all observed values.
+        """
+        if len(counts) != len(self.buckets) + 1:
+            raise ValueError(f"{self.name} has {len(self.buckets) + 1} buckets, not {len(counts)}.")
+
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = [*counts, total]
+
+    def snapshot(self):
+        return {**super().snapshot(), "buckets": list(self.buckets)}
+
+
+class Registry:
+    """
+    The metrics and collectors of one process.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.flushed_at = 0
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"A metric named {metric.name} is already registered.")
+
+        self.metrics[metric.name] = metric
+
+    def collector(self, function):
+        """
+        Registers a function that copies values kept elsewhere into metrics. Collectors run before every snapshot.
+        Usable as a decorator.
+        """
+        self.collectors.append(function)
+        return function
+
+    def snapshot(self):
+        """
+        @return: A JSON-serializable snapshot of every metric in this process.
+        """
+        for collect in self.collectors:
+            collect()
+
+        return {"pid": os.getpid(), "metrics": {name: metric.snapshot() for name, metric in self.metrics.items()}}
+
+    def flush(self, force: bool = False):
+        """
+        Writes this process's snapshot to settings.METRICS_DIR, unless it was written within the last
+        settings.METRICS_FLUSH_SECONDS. Does nothing when METRICS_DIR isn't set.
+        @param force: Optional. Whether to write the snapshot however recently it was last written.
+        """
+        if not settings.METRICS_DIR:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.flushed_at < settings.METRICS_FLUSH_SECONDS:
+                return
+            self.flushed_at = now
+
+        write_snapshot(os.path.join(settings.METRICS_DIR, f"{os.getpid()}.json"), self.snapshot())
+
+    def reset(self):
+        """
+        Zeroes every metric of this process.
+        """
+        for metric in self.metrics.values():
+            with metric.lock:
+                metric.values.clear()
+
+        with self.lock:
+            self.flushed_at = 0
+
+
+registry = Registry()
+
+
+def reset():
+    """
+    Zeroes this process's metrics, along with the session counters that collect_sessions() copies into them. Called in
+    each gunicorn worker right after it's forked (see gunicorn.conf.py): whatever the master recorded before forking,
+    e.g. while warming caches, would otherwise be counted once per worker.
+    """
+    import app.sessions as sessions
+
+    registry.reset()
+    sessions.metrics.reset()
+
+
+def write_snapshot(path: str, snapshot: dict):
+    # written to a temporary file and renamed, so that readers never see a partial snapshot
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(snapshot, file, separators=(",", ":"))
+    os.replace(temporary_path, path)
+
+
+def read_snapshots():
+    """
+    Reads the snapshots of every process, using this process's live metrics instead of its file.
+    @return: A list of (snapshot, whether its process is still running) pairs.
+    """
+    snapshots = [(registry.snapshot(), True)]
+    if not settings.METRICS_DIR:
+        return snapshots
+
+    for filename in os.listdir(settings.METRICS_DIR):
+        if not filename.endswith(".json") or filename == f"{os.getpid()}.json":
+            continue
+
+        try:
+            with open(os.path.join(settings.METRICS_DIR, filename)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+
+        snapshots.append((snapshot, filename != ARCHIVE_FILE and is_running(snapshot["pid"])))
+
+    return snapshots
+
+
+def is_running(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def merge(snapshots):
+    """
+    Adds up the metrics of several processes. Counters and histograms are summed across all of them; gauges only
+    across running processes.
+    @param snapshots: A list of (snapshot, whether its process is still running) pairs.
+    @return: A snapshot-shaped dictionary of the merged metrics.
+    """
+    merged = {}
+
+    for snapshot, running in snapshots:
+        for name, metric in snapshot["metrics"].items():
+            if metric["type"] == "gauge" and not running:
+                continue
+
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"]:
+                key = tuple(key)
+                if metric["type"] == "histogram":
+                    total = target["values"].setdefault(key, [0] * len(value))
+                    for i, count in enumerate(value):
+                        total[i] += count
+                else:
+                    target["values"][key] = target["values"].get(key, 0) + value
+
+    return {"metrics": {name: {**metric, "values": [[list(key), value] for key, value in metric["values"].items()]}
+                        for name, metric in merged.items()}}
+
+
+def archive_process(directory: str, pid: int):
+    """
+    Folds an exited process's snapshot into the archive, so that its counters live on without its file. Called from
+    gunicorn's child_exit hook, which runs in the master process (where Django may not be set up).
+    @param directory: The metrics directory (settings.METRICS_DIR).
+    @param pid: The ID of the exited process.
+    """
+    path = os.path.join(directory, f"{pid}.json")
+    archive_path = os.path.join(directory, ARCHIVE_FILE)
+
+    try:
+        with open(path) as file:
+            snapshots = [(json.load(file), False)]
+    except (OSError, ValueError):
+        return
+
+    try:
+        with open(archive_path) as file:
+            snapshots.append((json.load(file), False))
+    except (OSError, ValueError):
+        pass
+
+    write_snapshot(archive_path, {"pid": 0, **merge(snapshots)})
+    os.remove(path)
+
+
+def clear(directory: str):
+    """
+    Deletes every snapshot in the metrics directory, e.g. when the server starts.
+    @param directory: The metrics directory (settings.METRICS_DIR).
+    """
+    os.makedirs(directory, exist_ok=True)
+    for filename in os.listdir(directory):
+        if filename.endswith((".json", ".tmp")):
+            os.remove(os.path.join(directory, filename))
+
+
+def format_value(value: float):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def format_labels(names, values, extra: tuple = None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def exposition(snapshot: dict):
+    """
+    Renders metrics in the Prometheus text exposition format.
+    @param snapshot: A snapshot-shaped dictionary, such as the result of merge().
+    @return: A string.
+    """
+    lines = []
+
+    for name, metric in sorted(snapshot["metrics"].items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+
+        for key, value in sorted(metric["values"]):
+            if metric["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip([*metric["buckets"], math.inf], value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(metric['labels'], key, ('le', format_value(bound)))} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{format_labels(metric['labels'], key)} {format_value(value[-1])}")
+                lines.append(f"{name}_count{format_labels(metric['labels'], key)} {cumulative}")
+            else:
+                lines.append(f"{name}{format_labels(metric['labels'], key)} {format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+# Metrics
+
+HTTP_REQUEST_DURATION = Histogram("backlogged_http_request_duration_seconds",
+                                  "Time taken to handle requests, by view.", labels=("view", "method", "status"))
+HTTP_REQUEST_QUERIES = Histogram("backlogged_http_request_queries", "Database queries run per request, by view.",
+                                 labels=("view",), buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200))
+UPSTREAM_REQUEST_DURATION = Histogram("backlogged_upstream_request_duration_seconds",
+                                      "Time taken by outbound HTTP requests, by service and outcome.",
+                                      labels=("service", "outcome"))
+CACHE_REQUESTS = Counter("backlogged_cache_requests_total", "Cache lookups, by cache and result.",
+                         labels=("cache", "result"))
+SESSION_WRITES = Counter("backlogged_session_writes_total", "Session saves, by result.", labels=("result",))
+DB_POOL_CONNECTIONS = Gauge("backlogged_db_pool_connections", "Pooled database connections, by database and state.",
+                            labels=("database", "state"))
+DB_POOL_EVENTS = Counter("backlogged_db_pool_events_total",
+                         "Connection pool events (created, checkouts, waits, timeouts, closes), by database.",
+                         labels=("database", "event"))
+UPSTREAM_FALLBACKS = Counter("backlogged_upstream_fallbacks_total",
+                             "Upstream calls answered without the service (stale or unavailable), by service.",
+                             labels=("service", "result"))
+UPSTREAM_CIRCUIT_STATE = Gauge("backlogged_upstream_circuit_state",
+                               "1 for the current state of each upstream service's circuit breaker.",
+                               labels=("service", "state"))
+DB_POOL_WAIT = Counter("backlogged_db_pool_wait_seconds_total",
+                       "Time spent waiting for a pooled connection, by database.", labels=("database",))
+SLOW_QUERIES = Counter("backlogged_slow_queries_total",
+                       "Database queries slower than settings.SLOW_QUERY_THRESHOLD_MS, by view and database.",
+                       labels=("view", "database"))
+SESSION_PAYLOAD_BYTES = Histogram("backlogged_session_payload_bytes", "Serialized size of the sessions written.",
+                                  buckets=(1024, 4096, 16384, 65536, 262144, 1048576))
+HTTP_REQUEST_PEAK_MEMORY = Histogram("backlogged_http_request_peak_memory_bytes",
+                                     "Peak memory allocated by sampled requests while memory profiling, by view.",
+                                     labels=("view",), buckets=tuple(2 ** power for power in range(16, 29, 2)))
+
+
+@registry.collector
+def collect_sessions():
+    import app.sessions as sessions
+
+    counters = sessions.metrics.snapshot()
+    CACHE_REQUESTS.set(counters["cache_hits"], cache="sessions", result="hit")
+    CACHE_REQUESTS.set(counters["cache_misses"], cache="sessions", result="miss")
+    SESSION_WRITES.set(counters["saves"], result="saved")
+    SESSION_WRITES.set(counters["skipped_saves"], result="skipped")
+    SESSION_WRITES.set(counters["rejected_saves"], result="rejected")
+    SESSION_PAYLOAD_BYTES.set(counters["payload_bytes"]["buckets"], counters["payload_bytes"]["sum"])
+
+
+@registry.collector
+def collect_pools():
+    from app.db.pool import pool_metrics
+
+    for database, stats in pool_metrics().items():
+        for state in ("in_use", "idle"):
+            DB_POOL_CONNECTIONS.set(stats[state], database=database, state=state)
+        DB_POOL_WAIT.set(stats.get("wait_ms", 0) / 1000, database=database)
+        for event, count in stats.items():
+            if event not in ("max_size", "in_use", "idle", "wait_ms"):
+                DB_POOL_EVENTS.set(count, database=database, event=event)
@@ -2,7 +2,59 @@
 Custom middleware.
 """
 
-from django.shortcuts import redirect
+import contextlib
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.shortcuts import redirect, render
+
+import app.memory as memory
+import app.metrics as metrics
+import app.querylog as querylog
+import app.routers as routers
+import app.sharding as sharding
+from app.lazy import lazy_import
+
+resilience = lazy_import("app.resilience")
+
+
+@contextlib.contextmanager
+def wrapping_queries(wrapper):
+    """
+    Runs the queries made inside the block through an execute wrapper, on every database connection.
+    @param wrapper: A connection execute wrapper.
+    """
+    with contextlib.ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(wrapper))
+        yield
+
+
+def stream_within(content, context, finish=None):
+    """
+    Wraps a streaming response's content so that each chunk is produced inside a context, e.g. the execute wrapper of
+    the middleware that returned the response. Without this, what a streamed response does after the middleware has
+    returned (such as the queries of a QuerySet.iterator()) goes unseen.
+    @param content: The response's streaming_content.
+    @param context: A function that returns a new context manager, entered around the reading of each chunk.
+    @param finish: Optional. A function called once the content has been read, or the response closed before then.
+    @return: A generator of the same chunks.
+    """
+    content = iter(content)
+    done = object()
+
+    try:
+        while True:
+            with context():
+                chunk = next(content, done)
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        if finish:
+            finish()
 
 
 class HerokuRedirectMiddleware:
@@ -23,3 +75,193 @@ class HerokuRedirectMiddleware:
             return redirect(redirect_url, permanent=True)
 
         return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets safe (GET and HEAD) requests read from a replica database, unless the browser wrote something within the last
+    settings.REPLICA_PIN_SECONDS. Requests that write set a short-lived cookie that pins the browser's following
+    requests to the primary, so that users always read their own writes however far behind the replicas are.
+
+    Views can override this with a reads_from attribute or the app.routers.reads_from() decorator.
+    """
+    pin_cookie = "replica_pin"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        pinned = self.pin_cookie in request.COOKIES
+        routers.begin_request(use_replica=request.method in ("GET", "HEAD") and not pinned)
+
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = routers.end_request()
+
+        if wrote or request.method not in ("GET", "HEAD", "OPTIONS"):
+            response.set_cookie(self.pin_cookie, "1", max_age=settings.REPLICA_PIN_SECONDS, httponly=True,
+                                samesite="Lax", secure=settings.SESSION_COOKIE_SECURE)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        target = getattr(view_func, "reads_from", None) or getattr(getattr(view_func, "view_class", None),
+                                                                   "reads_from", None)
+
+        if target == "primary":
+            routers.state.use_replica = False
+        elif target == "replica":
+            routers.state.use_replica = request.method in ("GET", "HEAD")
+
+
+class ShardRoutingMiddleware:
+    """
+    Sends the backlog queries made while handling a request to the signed-in user's shard (see app.sharding).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sharding.begin_request(lambda: request.user.id if request.user.is_authenticated else None)
+
+        try:
+            return self.get_response(request)
+        finally:
+            sharding.end_request()
+
+
+class MetricsMiddleware:
+    """
+    Records each request's latency and number of database queries in app.metrics, labelled with the name of the view
+    that handled it. Streamed responses are recorded once their content has been sent, including the queries made to
+    produce it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        num_queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal num_queries
+            num_queries += 1
+            return execute(sql, params, many, context)
+
+        def record():
+            duration = time.perf_counter() - start
+            resolver_match = getattr(request, "resolver_match", None)
+            view = resolver_match.view_name if resolver_match else "unresolved"
+
+            metrics.HTTP_REQUEST_DURATION.observe(duration, view=view, method=request.method,
+                                                  status=f"{response.status_code // 100}xx")
+            metrics.HTTP_REQUEST_QUERIES.observe(num_queries, view=view)
+            metrics.registry.flush()
+
+        start = time.perf_counter()
+        with wrapping_queries(count_query):
+            response = self.get_response(request)
+
+        if response.streaming:
+            response.streaming_content = stream_within(response.streaming_content,
+                                                       lambda: wrapping_queries(count_query), record)
+        else:
+            record()
+
+        return response
+
+
+class MemoryProfilingMiddleware:
+    """
+    Traces the worker's allocations and measures the peak memory of a sample of requests while settings.MEMORY_PROFILING
+    is on (see app.memory). Otherwise it takes itself out of the middleware chain.
+    """
+
+    def __init__(self, get_response):
+        if not memory.start():
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not memory.should_sample():
+            return self.get_response(request)
+
+        start = memory.begin_sample()
+        response = self.get_response(request)
+
+        resolver_match = getattr(request, "resolver_match", None)
+        memory.end_sample(start, resolver_match.view_name if resolver_match else "unresolved", request.path)
+
+        return response
+
+
+class SlowQueryLogMiddleware:
+    """
+    Records the slow queries of a sample of requests, with the view that ran them (see app.querylog), including those
+    made while a streamed response's content is sent. Takes itself out of the middleware chain while
+    settings.SLOW_QUERY_LOG is off.
+    """
+
+    def __init__(self, get_response):
+        if not querylog.is_enabled():
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not querylog.should_sample():
+            return self.get_response(request)
+
+        with self.logging_queries(request):
+            response = self.get_response(request)
+
+        if response.streaming:
+            view = request.resolver_match.view_name if getattr(request, "resolver_match", None) else None
+            response.streaming_content = stream_within(response.streaming_content,
+                                                       lambda: self.logging_queries(request, view))
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        querylog.set_view(request.resolver_match.view_name)
+
+    @contextlib.contextmanager
+    def logging_queries(self, request, view: str = None):
+        """
+        Records the slow queries made inside the block as the request's.
+        @param request: The request.
+        @param view: Optional. The name of the view handling the request, if it's been resolved already.
+        """
+        querylog.begin_request(request.method, request.path)
+        if view:
+            querylog.set_view(view)
+
+        try:
+            with wrapping_queries(querylog.time_query):
+                yield
+        finally:
+            querylog.end_request()
+
+
+class UpstreamUnavailableMiddleware:
+    """
+    Answers requests that needed IGDB while it was unavailable (and had no stale response to fall back on) with an
+    HTTP 503 Service Unavailable page, instead of a server error.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, resilience.UpstreamUnavailable):
+            return None
+
+        response = render(request, "meta/unavailable.html", {"service": exception.service}, status=503)
+        response["Retry-After"] = int(settings.UPSTREAM_POLICIES[exception.service]["RESET_SECONDS"])
+        return response
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_auto_20210101_2302'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BacklogTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_id', models.IntegerField()),
+                ('game_id', models.CharField(max_length=1024)),
+                ('user_id', models.IntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='backloggedgame',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='customgame',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='backloggedgame',
+            index=models.Index(fields=['user', 'updated_at'], name='app_backlog_user_id_490bdf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backlogtombstone',
+            index=models.Index(fields=['user_id', 'deleted_at'], name='app_backlog_user_id_d23d3a_idx'),
+        ),
+    ]
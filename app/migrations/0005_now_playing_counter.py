@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-19 12:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('app', '0004_delta_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserBacklogCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='auth.user')),
+                ('num_now_playing', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
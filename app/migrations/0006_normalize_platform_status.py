@@ -0,0 +1,87 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_platforms(apps, schema_editor):
+    """
+    Creates a Platform for every platform that appears in a backlog, and makes status_id agree with status_name.
+    """
+    BackloggedGame = apps.get_model("app", "BackloggedGame")
+    Platform = apps.get_model("app", "Platform")
+
+    platform_names = dict(BackloggedGame.objects.values_list("platform_id", "platform_name").distinct())
+    Platform.objects.bulk_create(
+        [Platform(platform_id=platform_id, name=name) for platform_id, name in platform_names.items()]
+    )
+
+    BackloggedGame.objects.filter(status_name="Now Playing").update(status_id=2)
+    BackloggedGame.objects.exclude(status_name="Now Playing").update(status_id=1)
+
+
+def restore_names(apps, schema_editor):
+    """
+    Copies platform and status names back onto backlog entries.
+    """
+    BackloggedGame = apps.get_model("app", "BackloggedGame")
+    Platform = apps.get_model("app", "Platform")
+
+    for platform in Platform.objects.all():
+        BackloggedGame.objects.filter(platform_id=platform.platform_id).update(platform_name=platform.name)
+
+    BackloggedGame.objects.filter(status_id=2).update(status_name="Now Playing")
+    BackloggedGame.objects.exclude(status_id=2).update(status_name="backlog")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_now_playing_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Platform',
+            fields=[
+                ('platform_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=1024)),
+            ],
+        ),
+        migrations.RunPython(populate_platforms, migrations.RunPython.noop),
+        migrations.RenameField(
+            model_name='backloggedgame',
+            old_name='platform_id',
+            new_name='platform',
+        ),
+        migrations.AlterField(
+            model_name='backloggedgame',
+            name='platform',
+            field=models.ForeignKey(db_column='platform_id', on_delete=django.db.models.deletion.PROTECT, to='app.platform'),
+        ),
+        migrations.AlterField(
+            model_name='backloggedgame',
+            name='status_id',
+            field=models.IntegerField(choices=[(1, 'backlog'), (2, 'Now Playing')], default=1),
+        ),
+        # defaults only exist so that the columns can be re-added when this migration is reversed
+        migrations.AlterField(
+            model_name='backloggedgame',
+            name='platform_name',
+            field=models.CharField(default='', max_length=1024),
+        ),
+        migrations.AlterField(
+            model_name='backloggedgame',
+            name='status_name',
+            field=models.CharField(default='', max_length=1024),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, restore_names),
+        migrations.RemoveField(
+            model_name='backloggedgame',
+            name='platform_name',
+        ),
+        migrations.RemoveField(
+            model_name='backloggedgame',
+            name='status_name',
+        ),
+    ]
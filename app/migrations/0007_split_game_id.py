@@ -0,0 +1,84 @@
+# Generated by Django 3.2.25 on 2026-10-19 13:40
+
+from django.db import migrations, models
+from django.db.models.functions import Cast
+import uuid
+
+
+def split_game_ids(apps, schema_editor):
+    """
+    Moves IGDB ids into igdb_id and custom game UUIDs ("custom-<uuid>") into custom_id.
+    """
+    BackloggedGame = apps.get_model("app", "BackloggedGame")
+
+    BackloggedGame.objects.filter(game_id__regex=r"^[0-9]+$").update(igdb_id=Cast("game_id", models.IntegerField()))
+
+    batch = []
+    for entry in BackloggedGame.objects.filter(game_id__startswith="custom-").only("entry_id", "game_id").iterator():
+        entry.custom_id = uuid.UUID(entry.game_id[len("custom-"):])
+        batch.append(entry)
+        if len(batch) >= 1000:
+            BackloggedGame.objects.bulk_update(batch, ["custom_id"])
+            batch = []
+    BackloggedGame.objects.bulk_update(batch, ["custom_id"])
+
+
+def join_game_ids(apps, schema_editor):
+    """
+    Reverses split_game_ids().
+    """
+    BackloggedGame = apps.get_model("app", "BackloggedGame")
+
+    BackloggedGame.objects.filter(igdb_id__isnull=False).update(game_id=Cast("igdb_id", models.CharField()))
+
+    batch = []
+    for entry in BackloggedGame.objects.filter(custom_id__isnull=False).only("entry_id", "custom_id").iterator():
+        entry.game_id = f"custom-{entry.custom_id}"
+        batch.append(entry)
+        if len(batch) >= 1000:
+            BackloggedGame.objects.bulk_update(batch, ["game_id"])
+            batch = []
+    BackloggedGame.objects.bulk_update(batch, ["game_id"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_normalize_platform_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backloggedgame',
+            name='igdb_id',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backloggedgame',
+            name='custom_id',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.RunPython(split_game_ids, join_game_ids),
+        # the default only exists so that the column can be re-added when this migration is reversed
+        migrations.AlterField(
+            model_name='backloggedgame',
+            name='game_id',
+            field=models.CharField(default='', max_length=1024),
+        ),
+        migrations.RemoveField(
+            model_name='backloggedgame',
+            name='game_id',
+        ),
+        migrations.AddIndex(
+            model_name='backloggedgame',
+            index=models.Index(condition=models.Q(('igdb_id__isnull', False)), fields=['user', 'igdb_id'], name='backloggedgame_igdb_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backloggedgame',
+            index=models.Index(condition=models.Q(('custom_id__isnull', False)), fields=['user', 'custom_id'], name='backloggedgame_custom_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='backloggedgame',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('custom_id__isnull', True), ('igdb_id__isnull', False)), models.Q(('custom_id__isnull', False), ('igdb_id__isnull', True)), _connector='OR'), name='backloggedgame_exactly_one_game_id'),
+        ),
+    ]
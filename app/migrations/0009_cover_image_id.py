@@ -0,0 +1,74 @@
+# Generated by Django 3.2.25 on 2026-10-19 15:20
+
+import re
+
+from django.db import migrations, models
+
+IGDB_IMAGE_URL = re.compile(r"^https?://images\.igdb\.com/igdb/image/upload/t_[a-z0-9_]+/(?P<image_id>[A-Za-z0-9_]+)\.")
+
+
+def extract_image_ids(apps, schema_editor):
+    """
+    Replaces the cover URLs stored for IGDB games with their IGDB image ids.
+    """
+    BackloggedGame = apps.get_model("app", "BackloggedGame")
+    entries = BackloggedGame.objects.using(schema_editor.connection.alias)
+
+    batch = []
+    for entry in entries.filter(is_custom=False).only("entry_id", "custom_cover_url").iterator():
+        match = IGDB_IMAGE_URL.match(entry.custom_cover_url)
+        if match:
+            entry.cover_image_id, entry.custom_cover_url = match["image_id"], ""
+            batch.append(entry)
+        if len(batch) >= 1000:
+            entries.bulk_update(batch, ["cover_image_id", "custom_cover_url"])
+            batch = []
+    entries.bulk_update(batch, ["cover_image_id", "custom_cover_url"])
+
+
+def restore_cover_urls(apps, schema_editor):
+    """
+    Reverses extract_image_ids().
+    """
+    BackloggedGame = apps.get_model("app", "BackloggedGame")
+    entries = BackloggedGame.objects.using(schema_editor.connection.alias)
+
+    batch = []
+    for entry in entries.exclude(cover_image_id="").only("entry_id", "cover_image_id").iterator():
+        entry.custom_cover_url = f"https://images.igdb.com/igdb/image/upload/t_cover_big/{entry.cover_image_id}.jpg"
+        batch.append(entry)
+        if len(batch) >= 1000:
+            entries.bulk_update(batch, ["custom_cover_url"])
+            batch = []
+    entries.bulk_update(batch, ["custom_cover_url"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_sharding'),
+    ]
+
+    operations = [
+        # the column keeps its name; only the model field is renamed
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='backloggedgame',
+                    old_name='cover_url',
+                    new_name='custom_cover_url',
+                ),
+                migrations.AlterField(
+                    model_name='backloggedgame',
+                    name='custom_cover_url',
+                    field=models.URLField(blank=True, db_column='cover_url', default=''),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='backloggedgame',
+            name='cover_image_id',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.RunPython(extract_image_ids, restore_cover_urls),
+    ]
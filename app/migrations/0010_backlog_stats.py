@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0009_cover_image_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BacklogStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(max_length=16)),
+                ('value', models.CharField(max_length=32)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='backlogstat',
+            constraint=models.UniqueConstraint(fields=('user', 'dimension', 'value'), name='backlogstat_unique_key'),
+        ),
+    ]
@@ -2,8 +2,107 @@
 Database models.
 """
 
+import uuid
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, router, transaction
+
+import app.metrics as metrics
+
+
+class BacklogStatus(models.IntegerChoices):
+    """
+    The statuses a backlog entry can have.
+    """
+    BACKLOG = 1, "backlog"
+    NOW_PLAYING = 2, "Now Playing"
+
+
+class PlatformManager(models.Manager):
+    """
+    Manager for Platform that keeps a process-wide cache of platform names. Platforms are few and almost never
+    renamed, so each worker loads the whole table on its first miss and serves names from memory afterwards.
+    """
+    names = {}
+
+    def get_name(self, platform_id):
+        """
+        Gets a platform's display name.
+        @param platform_id: The unique identifier for a platform on IGDB.
+        @return: The name of the platform, or an empty string if it isn't known.
+        """
+        platform_id = int(platform_id)
+
+        metrics.CACHE_REQUESTS.inc(cache="platform_names", result="hit" if platform_id in self.names else "miss")
+        if platform_id not in self.names:
+            self.names.update(self.values_list("platform_id", "name"))
+
+        return self.names.get(platform_id, "")
+
+    def register(self, platform_id, name: str):
+        """
+        Records a platform's name so that backlog entries can refer to the platform by id alone.
+        @param platform_id: The unique identifier for a platform on IGDB.
+        @param name: The name of the platform.
+        @return: The platform's unique identifier as an integer.
+        """
+        platform_id = int(platform_id)
+
+        if self.names.get(platform_id) != name:
+            self.update_or_create(platform_id=platform_id, defaults={"name": name})
+            self.names[platform_id] = name
+
+        return platform_id
+
+
+class Platform(models.Model):
+    """
+    Model for game platforms.
+    """
+    platform_id = models.IntegerField(primary_key=True)  # the unique identifier for a platform on IGDB
+    name = models.CharField(max_length=1024)  # the name of the platform
+
+    objects = PlatformManager()
+
+
+# IGDB image sizes, mapped to their width in pixels (https://api-docs.igdb.com/#images); thumb is a square crop
+IGDB_IMAGE_SIZES = {"thumb": 90, "cover_small": 90, "cover_small_2x": 180, "cover_big": 264, "cover_big_2x": 528}
+IGDB_DEFAULT_COVER_SIZE = "cover_big"
+
+
+def igdb_image_url(image_id: str, size: str):
+    """
+    Builds a link to an image on IGDB.
+    @param image_id: The image's IGDB image id (e.g. "co1wyy").
+    @param size: One of IGDB_IMAGE_SIZES.
+    @return: A URL.
+    """
+    return f"https://images.igdb.com/igdb/image/upload/t_{size}/{image_id}.jpg"
+
+
+def game_id_lookup(game_id):
+    """
+    Converts a game identifier as it appears in URLs (an IGDB id, or "custom-" followed by a UUID for custom games) to
+    keyword arguments for filtering BackloggedGame.
+    @param game_id: The game's unique identifier.
+    @return: A dictionary containing either igdb_id or custom_id.
+    """
+    game_id = str(game_id)
+
+    if game_id.startswith("custom-"):
+        return {"custom_id": uuid.UUID(game_id[len("custom-"):])}
+    else:
+        return {"igdb_id": int(game_id)}
+
+
+def format_game_id(igdb_id, custom_id):
+    """
+    Reverses game_id_lookup().
+    @param igdb_id: The game's unique identifier on IGDB, or None.
+    @param custom_id: The custom game's UUID, or None.
+    @return: A string containing the game's unique identifier.
+    """
+    return str(igdb_id) if igdb_id is not None else f"custom-{custom_id}"
 
 
 class BackloggedGame(models.Model):
@@ -11,16 +110,77 @@ class BackloggedGame(models.Model):
     Model for all games in user backlogs.
     """
     entry_id = models.AutoField(primary_key=True)  # uniquely identifies the backlog entry in the database
-    game_id = models.CharField(max_length=1024)  # the game's unique identifier
+    igdb_id = models.IntegerField(null=True, blank=True)  # the game's unique identifier on IGDB
+    custom_id = models.UUIDField(null=True, blank=True)  # the unique identifier of a custom game
     game_name = models.CharField(max_length=1024)  # the game's name
-    cover_url = models.URLField()  # a link to an image of the game's over art
-    platform_id = models.IntegerField()  # the unique identifier for a platform on IGDB
-    platform_name = models.CharField(max_length=1024)  # the name of a platform
-    status_id = models.IntegerField(default=0)  # the game's status; 1 = backlog, 2 = Now Playing
-    status_name = models.CharField(max_length=1024)  # the name corresponding to status_id
+    cover_image_id = models.CharField(max_length=64, blank=True,
+                                      default="")  # the IGDB image id of the game's cover art; empty for custom games
+    custom_cover_url = models.URLField(blank=True, default="",
+                                       db_column="cover_url")  # a link to a custom game's cover art
+    platform = models.ForeignKey(Platform, on_delete=models.PROTECT, db_column="platform_id",
+                                 db_constraint=False)  # the platform the user has the game on
+    status_id = models.IntegerField(choices=BacklogStatus.choices,
+                                    default=BacklogStatus.BACKLOG)  # the game's status; 1 = backlog, 2 = Now Playing
     date_added = models.DateField()  # the date the game was added; YYYY-MM-DD
     is_custom = models.BooleanField(default=False)  # indicates whether the game is a custom game
-    user = models.ForeignKey(User, on_delete=models.CASCADE)  # the id of the user who added the game
+    # the id of the user who added the game; users and platforms live in the default database, which backlogs may be
+    # sharded away from (see app.sharding), so neither foreign key is enforced by the database
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    updated_at = models.DateTimeField(auto_now=True)  # when the entry was last changed; used for delta sync
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "updated_at"]),
+            # partial, so that each index only holds the rows that use its column
+            models.Index(fields=["user", "igdb_id"], name="backloggedgame_igdb_id_idx",
+                         condition=models.Q(igdb_id__isnull=False)),
+            models.Index(fields=["user", "custom_id"], name="backloggedgame_custom_id_idx",
+                         condition=models.Q(custom_id__isnull=False)),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(igdb_id__isnull=False, custom_id__isnull=True) |
+                models.Q(igdb_id__isnull=True, custom_id__isnull=False),
+                name="backloggedgame_exactly_one_game_id"
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remembered so that app.signals can tell when the game's status or platform changes
+        instance.saved_status_id = instance.__dict__.get("status_id")
+        instance.saved_platform_id = instance.__dict__.get("platform_id")
+        return instance
+
+    def save(self, *args, **kwargs):
+        # the entry and the counters that app.signals keeps in step with it are written together or not at all
+        with transaction.atomic(using=kwargs.get("using") or router.db_for_write(type(self), instance=self)):
+            super().save(*args, **kwargs)
+
+    @property
+    def game_id(self):
+        return format_game_id(self.igdb_id, self.custom_id)
+
+    @property
+    def cover_url(self):
+        return self.cover(IGDB_DEFAULT_COVER_SIZE)
+
+    def cover(self, size: str):
+        """
+        Gets a link to the game's cover art.
+        @param size: The IGDB image size to link to (see IGDB_IMAGE_SIZES). Custom covers only come in one size.
+        @return: A URL.
+        """
+        return igdb_image_url(self.cover_image_id, size) if self.cover_image_id else self.custom_cover_url
+
+    @property
+    def platform_name(self):
+        return Platform.objects.get_name(self.platform_id)
+
+    @property
+    def status_name(self):
+        return self.get_status_id_display()
 
     @property
     def custom_data(self):
@@ -38,7 +198,55 @@ class CustomGame(models.Model):
     involved_companies = models.CharField(max_length=1024, default=None)
     summary = models.CharField(max_length=3000, default=None)
     cover_img = models.ImageField(upload_to="Backlogged Custom Games/")
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class UserBacklogCounter(models.Model):
+    """
+    Model for denormalized per-user backlog counts, kept up to date by app.signals.
+    """
+    user = models.OneToOneField(User, primary_key=True, on_delete=models.CASCADE,
+                                db_constraint=False)  # the id of a user
+    num_now_playing = models.IntegerField(default=0)  # the number of games in the user's Now Playing
+
+
+class BacklogStat(models.Model):
+    """
+    Model for per-user backlog statistics: how many entries a user has with each status, on each platform, added in each
+    month, and from IGDB or custom. Kept up to date incrementally by app.stats.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)  # the id of a user
+    dimension = models.CharField(max_length=16)  # what's counted: "total", "status", "platform", "month" or "source"
+    value = models.CharField(max_length=32)  # e.g. a status or platform ID, "YYYY-MM", or "igdb"/"custom"
+    count = models.IntegerField(default=0)  # the number of the user's entries with that value
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "dimension", "value"], name="backlogstat_unique_key"),
+        ]
+
+
+class BacklogTombstone(models.Model):
+    """
+    Model for records of deleted backlog entries, so that delta sync clients learn about deletions.
+    """
+    entry_id = models.IntegerField()  # the entry_id of the deleted BackloggedGame
+    game_id = models.CharField(max_length=1024)  # the game_id of the deleted BackloggedGame
+    user_id = models.IntegerField()  # the id of the entry's user; not a foreign key, see app.signals
+    deleted_at = models.DateTimeField(auto_now_add=True)  # when the entry was deleted
+
+    class Meta:
+        indexes = [models.Index(fields=["user_id", "deleted_at"])]
+
+
+class UserShard(models.Model):
+    """
+    Model for the directory of which database holds each user's backlog. Always stored in the default database; users
+    without a row have their backlog there too.
+    """
+    user = models.OneToOneField(User, primary_key=True, on_delete=models.CASCADE)  # the id of a user
+    shard = models.CharField(max_length=100)  # the alias of the database holding the user's backlog
 
 
 class UserTimezone(models.Model):
@@ -47,3 +255,27 @@ class UserTimezone(models.Model):
     """
     user = models.ForeignKey(User, on_delete=models.CASCADE)  # an id of a user
     timezone = models.CharField(max_length=1024)  # a time zone (e.g. America/New_York)
+
+
+class AccountDeletion(models.Model):
+    """
+    Model for requests to delete an account, worked through in batches by app.deletion. Stored in the default database,
+    and kept once the account is gone as a record of the deletion.
+    """
+    PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+    STATUSES = [(PENDING, "Pending"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    user_id = models.IntegerField(unique=True)  # the id of the deactivated user; not a foreign key, as they're deleted
+    username = models.CharField(max_length=150)  # the user's username, for the admin site
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    requested_at = models.DateTimeField(auto_now_add=True)  # when the user asked for their account to be deleted
+    started_at = models.DateTimeField(null=True, blank=True)  # when a worker first picked the deletion up
+    updated_at = models.DateTimeField(auto_now=True)  # when a worker last made progress; stale means it died
+    finished_at = models.DateTimeField(null=True, blank=True)  # when the account was gone
+    entries_deleted = models.IntegerField(default=0)  # backlog entries deleted so far
+    covers_deleted = models.IntegerField(default=0)  # custom cover files deleted so far
+    attempts = models.IntegerField(default=0)  # how many times a worker has picked the deletion up
+    last_error = models.TextField(blank=True, default="")  # why the last attempt failed
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "updated_at"])]
@@ -0,0 +1,152 @@
+"""
+A builder for IGDB API queries (https://api-docs.igdb.com/#apicalypse-1).
+
+    Query("games").search(text).fields("name", "cover.image_id").where(category=0).limit(50)
+
+Queries render to a canonical string: clauses in a fixed order, fields sorted and deduplicated, conditions sorted and
+values escaped. Queries that ask IGDB for the same thing therefore render identically and share a cache entry (see
+app.resilience), and search text from users can't break out of its string.
+"""
+
+import copy
+import re
+
+FIELD_PATTERN = re.compile(r"^(\*|[a-z_]+(\.[a-z_]+)*(\.\*)?)$")
+
+
+def escape(text: str):
+    """
+    Makes text safe to put in a double-quoted Apicalypse string.
+    @param text: Any string.
+    @return: The string with backslashes and double quotes escaped and control characters removed.
+    """
+    text = "".join(character for character in text if character >= " ")
+    return text.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def render_value(value):
+    """
+    Renders a value for a where clause.
+    @param value: A boolean, number, string, None, or a collection of them (matched as "any of").
+    @return: The value in Apicalypse syntax.
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return f'"{escape(value)}"'
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return f"({','.join(render_value(item) for item in sorted(set(value)))})"
+
+    raise TypeError(f"Can't use a {type(value).__name__} in an IGDB query.")
+
+
+def check_field(field: str):
+    if not FIELD_PATTERN.match(field):
+        raise ValueError(f'"{field}" isn\'t a valid IGDB field.')
+
+    return field
+
+
+class Query:
+    """
+    An IGDB API query. Every method returns a new Query, leaving the one it was called on unchanged.
+    """
+
+    def __init__(self, endpoint: str):
+        """
+        @param endpoint: The endpoint the query is for (e.g. "games").
+        """
+        self.endpoint = endpoint
+        self.field_set = frozenset()
+        self.search_text = None
+        self.conditions = {}
+        self.sort_clause = None
+        self.limit_value = None
+        self.offset_value = None
+
+    def clone(self, **changes):
+        query = copy.copy(self)
+        query.__dict__.update(changes)
+        return query
+
+    def fields(self, *fields: str):
+        """
+        Adds fields to the query, e.g. "name" or "cover.image_id" for a field of a related object.
+        """
+        return self.clone(field_set=self.field_set | {check_field(field) for field in fields})
+
+    def widen(self, *field_sets):
+        """
+        Adds whole sets of fields to the query, so that queries made by related views for fewer fields ask IGDB for
+        the same superset and are served from a single cache entry.
+        @param field_sets: Iterables of fields.
+        """
+        return self.fields(*(field for field_set in field_sets for field in field_set))
+
+    def search(self, text: str):
+        """
+        Searches for text, as typed by a user. Runs of whitespace are collapsed.
+        """
+        return self.clone(search_text=" ".join(text.split()))
+
+    def where(self, **conditions):
+        """
+        Filters the results, e.g. where(id=1942) or where(id=[1942, 1020], category=0). Conditions are combined with
+        "and".
+        """
+        # values are rendered straight away, so that one that can't be used fails here rather than when sent
+        return self.clone(conditions={**self.conditions, **{check_field(field): render_value(value)
+                                                            for field, value in conditions.items()}})
+
+    def sort(self, field: str, descending: bool = False):
+        return self.clone(sort_clause=f"{check_field(field)} {'desc' if descending else 'asc'}")
+
+    def limit(self, limit: int):
+        return self.clone(limit_value=int(limit))
+
+    def offset(self, offset: int):
+        return self.clone(offset_value=int(offset))
+
+    def canonical_fields(self):
+        """
+        @return: The query's fields in sorted order, without those implied by others (e.g. "platforms", the IDs of a
+        game's platforms, is implied by "platforms.name", since expanded objects always include their IDs).
+        """
+        def is_implied(field):
+            parent, _, name = field.rpartition(".")
+            # "*" is every field of the object itself, "cover.*" every field of its cover
+            if name != "*" and (f"{parent}.*" if parent else "*") in self.field_set:
+                return True
+            return any(other.startswith(f"{field}.") for other in self.field_set)
+
+        return sorted(field for field in self.field_set if not is_implied(field))
+
+    def __str__(self):
+        clauses = []
+        if self.search_text is not None:
+            clauses.append(f'search "{escape(self.search_text)}"')
+        clauses.append(f"fields {','.join(self.canonical_fields()) or '*'}")
+        if self.conditions:
+            conditions = sorted(self.conditions.items())
+            clauses.append("where " + " & ".join(f"{field} = {value}" for field, value in conditions))
+        if self.sort_clause:
+            clauses.append(f"sort {self.sort_clause}")
+        if self.limit_value is not None:
+            clauses.append(f"limit {self.limit_value}")
+        if self.offset_value is not None:
+            clauses.append(f"offset {self.offset_value}")
+
+        return "".join(f"{clause};" for clause in clauses)
+
+    def __repr__(self):
+        return f"<Query {self.endpoint}: {self}>"
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and (self.endpoint, str(self)) == (other.endpoint, str(other))
+
+    def __hash__(self):
+        return hash((self.endpoint, str(self)))
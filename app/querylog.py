@@ -0,0 +1,235 @@
+"""
+A log of slow database queries, for finding out which query made a page slow and why.
+
+SlowQueryLogMiddleware times the queries of a sample of requests (settings.SLOW_QUERY_SAMPLE_RATE) with a connection
+execute wrapper. Queries that take longer than settings.SLOW_QUERY_THRESHOLD_MS are recorded with the view that ran
+them, the line in the app that made them, their bound parameters and, for SELECTs, the database's plan for them
+(EXPLAIN, or EXPLAIN ANALYZE with settings.SLOW_QUERY_EXPLAIN = "analyze"). The same statement is explained at most
+once every settings.SLOW_QUERY_EXPLAIN_INTERVAL seconds, so a query that's slow on every request doesn't double the
+load it puts on the database.
+
+Parameters are redacted for statements that write, whose parameters are users' data, and for any statement on a table
+in REDACTED_TABLES, whose parameters can be session keys and credentials; those statements aren't explained either,
+since a plan can show the values it filtered on.
+
+Records go to the "app.querylog" logger as JSON, and into a per-process ring buffer of the latest
+settings.SLOW_QUERY_BUFFER_SIZE, which staff can read from SlowQueryLogView.
+"""
+
+import collections
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import DatabaseError, NotSupportedError, transaction
+
+import app.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(APP_DIR)
+# code that runs every query, and so is never where one comes from
+SKIPPED_PATHS = (os.path.abspath(__file__), os.path.join(APP_DIR, "middleware.py"),
+                 os.path.join(APP_DIR, "db") + os.sep)
+# the most characters of a parameter's representation to keep
+MAX_PARAM_LENGTH = 200
+# tables holding sessions and credentials, whose queries' parameters are never recorded
+REDACTED_TABLES = ("django_session", "auth_user")
+REDACTED_TABLES_PATTERN = re.compile(rf"\b(?:{'|'.join(REDACTED_TABLES)})\b")
+REDACTED = "[redacted]"
+
+records = collections.deque(maxlen=settings.SLOW_QUERY_BUFFER_SIZE)
+# when each statement was last explained, by its normalized SQL
+explained_at = {}
+lock = threading.Lock()
+state = threading.local()
+
+
+def is_enabled():
+    return settings.SLOW_QUERY_LOG
+
+
+def should_sample():
+    return settings.SLOW_QUERY_LOG and random.random() < settings.SLOW_QUERY_SAMPLE_RATE
+
+
+def normalize(sql: str):
+    """
+    @return: The statement with its literal values replaced, so that the same query for different rows compares equal.
+    """
+    return re.sub(r"\b\d+\b", "?", re.sub(r"'(?:[^']|'')*'", "'?'", sql))
+
+
+def should_redact(sql: str):
+    """
+    @return: Whether a query's parameters must be left out of its record: those of statements other than SELECTs, and
+    of statements on a table in REDACTED_TABLES.
+    """
+    return sql.lstrip()[:6].upper() != "SELECT" or REDACTED_TABLES_PATTERN.search(sql) is not None
+
+
+def format_params(params, redact: bool = False):
+    """
+    Makes a query's parameters safe to log and serialize as JSON.
+    @param params: A sequence or mapping of parameters, or None.
+    @param redact: Optional. Whether to replace every parameter with a placeholder (see should_redact()).
+    @return: A list or dictionary of JSON values, with long values cut short.
+    """
+    def format_param(param):
+        if redact:
+            return REDACTED
+        if param is None or isinstance(param, (bool, int, float)):
+            return param
+        text = param if isinstance(param, str) else repr(param)
+        return text if len(text) <= MAX_PARAM_LENGTH else f"{text[:MAX_PARAM_LENGTH]}..."
+
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: format_param(value) for key, value in params.items()}
+    return [format_param(param) for param in params]
+
+
+def find_source():
+    """
+    @return: The innermost line of the app's code on the stack (e.g. "app/views.py:120 in get_context_data"), or None
+    if the query didn't come from the app.
+    """
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(APP_DIR + os.sep) and not filename.startswith(SKIPPED_PATHS):
+            return f"{os.path.relpath(filename, BASE_DIR)}:{frame.lineno} in {frame.name}"
+
+    return None
+
+
+def explain(connection, sql: str, params):
+    """
+    Asks the database how it runs a query, at most once per settings.SLOW_QUERY_EXPLAIN_INTERVAL for each statement.
+    Only SELECTs are explained, since EXPLAIN ANALYZE runs the query again.
+    @param connection: The connection the query ran on.
+    @param sql: The query, with placeholders.
+    @param params: The query's parameters.
+    @return: The plan as text, or None if the query wasn't explained.
+    """
+    if settings.SLOW_QUERY_EXPLAIN == "off" or sql.lstrip()[:6].upper() != "SELECT":
+        return None
+
+    key = (connection.alias, normalize(sql))
+    now = time.monotonic()
+    with lock:
+        if now - explained_at.get(key, -settings.SLOW_QUERY_EXPLAIN_INTERVAL) < settings.SLOW_QUERY_EXPLAIN_INTERVAL:
+            return None
+        explained_at[key] = now
+        if len(explained_at) > 10 * settings.SLOW_QUERY_BUFFER_SIZE:
+            explained_at.clear()
+
+    options = {"analyze": True} if settings.SLOW_QUERY_EXPLAIN == "analyze" else {}
+    try:
+        prefix = connection.ops.explain_query_prefix(**options)
+    except ValueError:
+        # a database that can't ANALYZE, e.g. SQLite
+        prefix = connection.ops.explain_query_prefix()
+    except NotSupportedError:
+        return None
+
+    state.explaining = True
+    try:
+        # in a savepoint, so that a failed EXPLAIN doesn't break the transaction the query ran in
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(f"{prefix} {sql}", params)
+            rows = cursor.fetchall()
+    except DatabaseError as error:
+        return f"Couldn't explain the query: {error}"
+    finally:
+        state.explaining = False
+
+    return "\n".join(row[0] if len(row) == 1 else " ".join(str(column) for column in row) for row in rows)
+
+
+def record(connection, sql: str, params, duration: float):
+    """
+    Records a slow query in the ring buffer and the log.
+    @param connection: The connection the query ran on.
+    @param sql: The query, with placeholders.
+    @param params: The query's parameters.
+    @param duration: How long the query took, in seconds.
+    @return: The record, as a dictionary.
+    """
+    request = getattr(state, "request", None)
+    redact = should_redact(sql)
+    entry = {
+        "time": time.time(),
+        "duration_ms": round(duration * 1000, 1),
+        "database": connection.alias,
+        "view": getattr(state, "view", None) or "unresolved",
+        "method": request[0] if request else None,
+        "path": request[1] if request else None,
+        "source": find_source(),
+        "sql": sql,
+        "params": format_params(params, redact),
+        "plan": None if redact else explain(connection, sql, params),
+    }
+
+    with lock:
+        records.append(entry)
+    metrics.SLOW_QUERIES.inc(view=entry["view"], database=connection.alias)
+    logger.warning("slow_query %s", json.dumps(entry), extra={"slow_query": entry})
+
+    return entry
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    A connection execute wrapper that records the queries that take longer than settings.SLOW_QUERY_THRESHOLD_MS.
+    """
+    if getattr(state, "explaining", False):
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    result = execute(sql, params, many, context)
+    duration = time.perf_counter() - start
+
+    if duration * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS and not many:
+        try:
+            record(context["connection"], sql, params, duration)
+        except Exception:
+            # recording must never break the request whose query it's recording
+            logger.exception("Couldn't record a slow query")
+
+    return result
+
+
+def begin_request(method: str, path: str):
+    state.request = (method, path)
+    state.view = None
+
+
+def set_view(view: str):
+    state.view = view
+
+
+def end_request():
+    state.request = None
+    state.view = None
+
+
+def get_records():
+    """
+    @return: The recorded slow queries of this process, latest first.
+    """
+    with lock:
+        return list(reversed(records))
+
+
+def clear():
+    with lock:
+        records.clear()
+        explained_at.clear()
@@ -0,0 +1,227 @@
+"""
+Timeouts, circuit breakers and stale fallbacks for the upstream services (IGDB, GitHub and ipwhois).
+
+Each service has a policy in settings.UPSTREAM_POLICIES:
+    TIMEOUT: Seconds to wait for a connection and for a response, as [connect, read] or [both].
+    FAILURE_THRESHOLD: Consecutive failed or slow calls after which the service's breaker opens.
+    SLOW_CALL_SECONDS: Calls that take longer than this count as failures, even if they succeed.
+    RESET_SECONDS: How long an open breaker fails calls straight away before letting a trial call through.
+    FRESH_SECONDS: How long a successful response is reused for the same request without calling the service again.
+    STALE_SECONDS: How long a successful response is kept as a fallback for when the service can't be reached.
+
+Responses are cached in settings.UPSTREAM_CACHE_ALIAS. While a breaker is open, call() doesn't contact the service at
+all: it returns the last good response for the same request if one is cached, or raises UpstreamUnavailable for the
+caller to degrade however suits it. Breakers are kept per process; state changes are logged to the "app.resilience"
+logger and exported by app.metrics.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+
+import app.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class UpstreamUnavailable(requests.RequestException):
+    """
+    Raised when an upstream service can't be reached (or its breaker is open) and there's no stale response to fall
+    back on.
+    """
+
+    def __init__(self, service: str, reason: str):
+        super().__init__(f"{service} is unavailable: {reason}")
+        self.service = service
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of one upstream service. Opens after FAILURE_THRESHOLD consecutive failures, stays open for
+    RESET_SECONDS, then lets a single trial call through: if it succeeds the breaker closes, otherwise it opens again.
+    """
+
+    def __init__(self, service: str, failure_threshold: int, reset_seconds: float):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Decides whether a call may go ahead.
+        @return: True if the service may be called.
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.transition(HALF_OPEN, "trying a call")
+                return True
+
+            # open, or half-open with the trial call still in flight
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.transition(CLOSED, "trial call succeeded")
+
+    def record_failure(self, reason: str):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.transition(OPEN, f"trial call failed ({reason})")
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self.transition(OPEN, f"{self.failures} consecutive failures, the last one {reason}")
+
+    def transition(self, state: str, reason: str):
+        level = logging.WARNING if state == OPEN else logging.INFO
+        logger.log(level, "Circuit breaker for %s %s -> %s: %s", self.service, self.state, state, reason)
+
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get_policy(service: str):
+    return settings.UPSTREAM_POLICIES[service]
+
+
+def get_breaker(service: str):
+    """
+    Gets a service's circuit breaker, creating it on first use.
+    @param service: A key of settings.UPSTREAM_POLICIES.
+    @return: A CircuitBreaker object.
+    """
+    with breakers_lock:
+        if service not in breakers:
+            policy = get_policy(service)
+            breakers[service] = CircuitBreaker(service, policy["FAILURE_THRESHOLD"], policy["RESET_SECONDS"])
+
+        return breakers[service]
+
+
+def get_timeout(service: str):
+    """
+    @param service: A key of settings.UPSTREAM_POLICIES.
+    @return: The service's timeout, in the form requests expects.
+    """
+    timeout = get_policy(service)["TIMEOUT"]
+    return tuple(timeout) if len(timeout) > 1 else timeout[0]
+
+
+def cache_key(service: str, key: str):
+    return f"upstream:{service}:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def call(service: str, fetch, key: str = None):
+    """
+    Calls an upstream service through its circuit breaker. Only connection errors, timeouts, 5xx responses and slow
+    calls count towards opening the breaker; other errors (e.g. a 4xx response) are raised to the caller as they are.
+    @param service: A key of settings.UPSTREAM_POLICIES.
+    @param fetch: A function that makes the call with the timeout it's passed (see get_timeout()) and returns a
+    cacheable result. It should raise an exception (e.g. from Response.raise_for_status()) if the call failed.
+    @param key: Optional. Identifies the request (e.g. its URL and body), so that its result can be reused while it's
+    fresh and stand in while the service is unavailable. Without a key, the service is called every time and there's
+    no stale fallback.
+    @return: The result of fetch(), or a cached result.
+    """
+    policy = get_policy(service)
+    breaker = get_breaker(service)
+    cache = caches[settings.UPSTREAM_CACHE_ALIAS]
+
+    if key is not None and policy["FRESH_SECONDS"]:
+        cached = cache.get(cache_key(service, key))
+        metrics.CACHE_REQUESTS.inc(cache=f"upstream_{service}", result="miss" if cached is None else "hit")
+        if cached is not None and time.time() - cached[1] < policy["FRESH_SECONDS"]:
+            return cached[0]
+
+    if not breaker.allow():
+        return fallback(service, key, "circuit open")
+
+    # a call that ends without reaching an outcome (e.g. a worker timeout during a trial call) counts as a failure,
+    # so that a half-open breaker is never left waiting on it
+    failure = "interrupted"
+    start = time.monotonic()
+    try:
+        result = fetch(get_timeout(service))
+        elapsed = time.monotonic() - start
+        failure = f"took {elapsed:.1f}s" if elapsed > policy["SLOW_CALL_SECONDS"] else None
+    except requests.RequestException as error:
+        if not is_outage(error):
+            # e.g. a 404: the service answered, it's the request it refused
+            failure = None
+            raise
+        failure = type(error).__name__
+        return fallback(service, key, str(error))
+    except Exception:
+        # e.g. a response that can't be parsed: let the caller see what went wrong, but the service did answer
+        failure = None
+        raise
+    finally:
+        if failure is None:
+            breaker.record_success()
+        else:
+            breaker.record_failure(failure)
+
+    if key is not None:
+        # stored with the time it was fetched, so that it can go on serving as a fallback once it's no longer fresh
+        cache.set(cache_key(service, key), (result, time.time()), policy["STALE_SECONDS"])
+
+    return result
+
+
+def is_outage(error: requests.RequestException):
+    """
+    @param error: An exception raised by a call to a service.
+    @return: True if the error means the service is down or struggling (a connection error, a timeout or a 5xx
+    response), rather than that it refused the request.
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    return False
+
+
+def fallback(service: str, key: str, reason: str):
+    """
+    Gets the last good result of a request to a service that can't be reached.
+    @return: The stale result.
+    """
+    if key is not None:
+        cached = caches[settings.UPSTREAM_CACHE_ALIAS].get(cache_key(service, key))
+        if cached is not None:
+            metrics.UPSTREAM_FALLBACKS.inc(service=service, result="stale")
+            return cached[0]
+
+    metrics.UPSTREAM_FALLBACKS.inc(service=service, result="unavailable")
+    raise UpstreamUnavailable(service, reason)
+
+
+@metrics.registry.collector
+def collect_breakers():
+    with breakers_lock:
+        current = list(breakers.values())
+
+    for breaker in current:
+        for state in (CLOSED, OPEN, HALF_OPEN):
+            metrics.UPSTREAM_CIRCUIT_STATE.set(int(breaker.state == state), service=breaker.service, state=state)
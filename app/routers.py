@@ -0,0 +1,134 @@
+"""
+Database routing.
+
+ShardRouter sends backlog models to the shard holding their user's backlog (see app.sharding). Everything else goes
+through ReplicaRouter, which splits it between the primary database ("default") and its read replicas
+(settings.REPLICA_DATABASES). Reads only go to a replica while ReplicaRoutingMiddleware says the current request may use
+one. Outside requests (e.g. management commands) they go to the primary. While migrate runs, both routers send every
+query to the database being migrated.
+"""
+
+import random
+import threading
+
+from django.conf import settings
+
+import app.sharding as sharding
+
+PRIMARY = "default"
+
+state = threading.local()
+
+
+def reads_from(target: str):
+    """
+    Overrides where a view's reads go. Use as a decorator on function views, or set a reads_from attribute on
+    class-based views instead.
+    @param target: "primary" to never read from a replica, or "replica" to read from one even while the user is pinned
+    to the primary after a write.
+    @return: A decorator.
+    """
+    if target not in ("primary", "replica"):
+        raise ValueError(f'Unknown read target "{target}"; expected "primary" or "replica".')
+
+    def decorator(view_func):
+        view_func.reads_from = target
+        return view_func
+
+    return decorator
+
+
+def begin_request(use_replica: bool):
+    """
+    Sets whether reads made while handling the current request may go to a replica.
+    @param use_replica: True to allow replica reads.
+    """
+    state.use_replica = use_replica
+    state.wrote = False
+
+
+def end_request():
+    """
+    Forgets the current request's routing state.
+    @return: True if the request wrote to the primary.
+    """
+    wrote = getattr(state, "wrote", False)
+    state.use_replica = False
+    state.wrote = False
+
+    return wrote
+
+
+def begin_migration(using: str):
+    """
+    Sends every query to the database being migrated until end_migration(), so that data migrations that use default
+    managers (rather than schema_editor.connection.alias) act on that database, whichever shard or replica it is.
+    @param using: The alias of the database being migrated.
+    """
+    state.migrating = using
+
+
+def end_migration():
+    state.migrating = None
+
+
+class ShardRouter:
+    """
+    Sends queries for sharded models to the right shard, and keeps the shard directory on the primary. Does nothing
+    when there's only one shard.
+    """
+
+    def db_for_model(self, model, **hints):
+        if getattr(state, "migrating", None):
+            return state.migrating
+
+        if not sharding.is_enabled():
+            return None
+
+        if model._meta.label_lower == "app.usershard":
+            return PRIMARY
+
+        if not sharding.is_sharded(model):
+            return None
+
+        instance = hints.get("instance")
+        if instance is not None and sharding.is_sharded(type(instance)):
+            # new rows always go to their user's shard, however their _state.db was filled in
+            if instance._state.db and not instance._state.adding:
+                return instance._state.db
+            return sharding.shard_for_user(instance.user_id)
+        elif instance is not None and instance._meta.label_lower == "auth.user":
+            return sharding.shard_for_user(instance.pk)
+
+        return sharding.current_shard()
+
+    db_for_read = db_for_model
+    db_for_write = db_for_model
+
+
+class ReplicaRouter:
+    """
+    Sends writes to the primary and, where allowed, reads to a randomly chosen replica. Once a request writes, the rest
+    of its reads go to the primary so that it sees its own writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        if getattr(state, "migrating", None):
+            return state.migrating
+
+        if getattr(state, "use_replica", False) and not getattr(state, "wrote", False) and settings.REPLICA_DATABASES:
+            return random.choice(settings.REPLICA_DATABASES)
+
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        if getattr(state, "migrating", None):
+            return state.migrating
+
+        state.wrote = True
+
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary, so objects read from any of them may be related
+        return True
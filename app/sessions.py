@@ -0,0 +1,135 @@
+"""
+Backlogged's session engine: sessions are read from a cache (settings.SESSION_CACHE_ALIAS) in front of the database,
+are only written back when their contents change, and are kept within a size budget.
+
+settings.SESSION_MAX_VALUE_BYTES limits the serialized size of any one session key and settings.SESSION_MAX_BYTES
+limits the serialized size of a whole session. Either can be None to disable the limit.
+"""
+
+import hashlib
+import threading
+
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.core.exceptions import SuspiciousOperation
+
+
+class SessionTooLarge(SuspiciousOperation):
+    """
+    Raised when a session key or a whole session is larger than its size limit.
+    """
+
+
+class SessionMetrics:
+    """
+    Process-wide counters for session cache usage, writes and payload sizes, exported by app.metrics.
+    """
+    # upper bounds, in bytes, of the payload size histogram buckets (those of metrics.SESSION_PAYLOAD_BYTES)
+    buckets = (1024, 4096, 16384, 65536, 262144, 1048576)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {"cache_hits": 0, "cache_misses": 0, "saves": 0, "skipped_saves": 0, "rejected_saves": 0}
+            self.payload_bytes = {"count": 0, "sum": 0, "max": 0, "buckets": [0] * (len(self.buckets) + 1)}
+
+    def increment(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def observe_payload(self, num_bytes: int):
+        """
+        Records the size of a session payload that was written.
+        @param num_bytes: The size of the serialized session in bytes.
+        """
+        with self.lock:
+            self.payload_bytes["count"] += 1
+            self.payload_bytes["sum"] += num_bytes
+            self.payload_bytes["max"] = max(self.payload_bytes["max"], num_bytes)
+            bucket = next((i for i, bound in enumerate(self.buckets) if num_bytes <= bound), len(self.buckets))
+            self.payload_bytes["buckets"][bucket] += 1
+
+    def snapshot(self):
+        """
+        @return: A copy of the current counters and payload size statistics.
+        """
+        with self.lock:
+            return {**self.counters, "payload_bytes": {**self.payload_bytes,
+                                                       "buckets": list(self.payload_bytes["buckets"])}}
+
+
+metrics = SessionMetrics()
+
+
+class SessionStore(CachedDBStore):
+    """
+    Cached, database-backed sessions that skip writes when nothing changed and refuse to grow past their size limits.
+    """
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._loaded_digest = None
+
+    def load(self):
+        try:
+            data = self._cache.get(self.cache_key)
+        except Exception:
+            data = None
+        metrics.increment("cache_misses" if data is None else "cache_hits")
+
+        if data is None:
+            session = self._get_session_from_db()
+            if session:
+                data = self.decode(session.session_data)
+                self._cache.set(self.cache_key, data, self.get_expiry_age(expiry=session.expire_date))
+            else:
+                data = {}
+
+        self._loaded_digest = self.digest(self.serializer().dumps(data))
+
+        return data
+
+    def save(self, must_create=False):
+        payload = self.serializer().dumps(self._get_session(no_load=must_create))
+
+        if not must_create and self.session_key and self.digest(payload) == self._loaded_digest:
+            metrics.increment("skipped_saves")
+            return
+
+        try:
+            self.check_size(payload)
+        except SessionTooLarge:
+            metrics.increment("rejected_saves")
+            raise
+
+        super().save(must_create)
+        self._loaded_digest = self.digest(payload)
+        metrics.increment("saves")
+        metrics.observe_payload(len(payload))
+
+    def check_size(self, payload: bytes):
+        """
+        Makes sure the session is within settings.SESSION_MAX_BYTES and each of its keys is within
+        settings.SESSION_MAX_VALUE_BYTES.
+        @param payload: The serialized session.
+        """
+        max_bytes = settings.SESSION_MAX_BYTES
+        max_value_bytes = settings.SESSION_MAX_VALUE_BYTES
+
+        if max_bytes is not None and len(payload) > max_bytes:
+            raise SessionTooLarge(f"Session is {len(payload)} bytes; the limit is {max_bytes}.")
+
+        if max_value_bytes is not None and len(payload) > max_value_bytes:
+            serializer = self.serializer()
+            for key, value in self._session.items():
+                value_bytes = len(serializer.dumps(value))
+                if value_bytes > max_value_bytes:
+                    raise SessionTooLarge(f'Session key "{key}" is {value_bytes} bytes; the limit is '
+                                          f'{max_value_bytes}.')
+
+    @staticmethod
+    def digest(payload: bytes):
+        return hashlib.blake2b(payload, digest_size=16).digest()
@@ -0,0 +1,184 @@
+"""
+Sharding of users' backlogs across databases.
+
+settings.BACKLOG_SHARDS lists the database aliases backlogs may live in. Each user's backlog (their BackloggedGame,
+CustomGame, UserBacklogCounter, BacklogStat and BacklogTombstone rows) lives entirely in one of them, as recorded in the
+UserShard directory. Everything else, including the directory and users themselves, lives in the default database.
+
+app.routers.ShardRouter sends queries for sharded models to:
+    1. the database an instance was loaded from or is being saved for, looked up from its user_id;
+    2. the shard selected with using_shard_of(), e.g. by management commands;
+    3. the shard of the user making the current request (see ShardRoutingMiddleware).
+"""
+
+import contextlib
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+import app.models as models
+
+PRIMARY = "default"
+
+# lowercase model names of the models that are stored in each user's shard
+SHARDED_MODELS = {"backloggedgame", "customgame", "userbacklogcounter", "backlogstat", "backlogtombstone"}
+
+state = threading.local()
+
+
+class ShardingError(Exception):
+    """
+    Raised when a sharded query can't be routed, or a user can't be moved between shards.
+    """
+
+
+def is_enabled():
+    return len(settings.BACKLOG_SHARDS) > 1
+
+
+def is_sharded(model):
+    return model._meta.app_label == "app" and model._meta.model_name in SHARDED_MODELS
+
+
+def shard_for_user(user_id: int):
+    """
+    Looks up which database holds a user's backlog. Lookups are remembered until the end of the current request.
+    @param user_id: The ID of a user.
+    @return: A database alias.
+    """
+    if not is_enabled():
+        return PRIMARY
+
+    cache = getattr(state, "shards", None)
+    if cache is not None and user_id in cache:
+        return cache[user_id]
+
+    shard = models.UserShard.objects.using(PRIMARY).filter(user_id=user_id).values_list("shard", flat=True).first()
+    shard = shard or PRIMARY
+    if cache is not None:
+        cache[user_id] = shard
+
+    return shard
+
+
+def assign_shard(user_id: int):
+    """
+    Picks the shard for a new user's backlog and records it in the directory.
+    @param user_id: The ID of a user with no backlog yet.
+    @return: A database alias.
+    """
+    shard = settings.BACKLOG_SHARDS[user_id % len(settings.BACKLOG_SHARDS)]
+    models.UserShard.objects.using(PRIMARY).update_or_create(user_id=user_id, defaults={"shard": shard})
+
+    return shard
+
+
+def current_shard():
+    """
+    Determines the shard for a sharded query that has no instance to go by.
+    @return: A database alias.
+    """
+    if getattr(state, "shard", None):
+        return state.shard
+
+    get_user_id = getattr(state, "get_user_id", None)
+    user_id = get_user_id() if get_user_id else None
+    if user_id is None:
+        raise ShardingError("Can't tell which shard to query outside of a signed-in request; use "
+                            "app.sharding.using_shard_of() or QuerySet.using().")
+
+    return shard_for_user(user_id)
+
+
+@contextlib.contextmanager
+def using_shard_of(user_id: int):
+    """
+    Sends sharded queries without an instance to go by to a user's shard for the duration of a with block.
+    @param user_id: The ID of a user.
+    """
+    previous = getattr(state, "shard", None)
+    state.shard = shard_for_user(user_id)
+    try:
+        yield state.shard
+    finally:
+        state.shard = previous
+
+
+def begin_request(get_user_id):
+    """
+    Sets up shard routing for the current request.
+    @param get_user_id: A function returning the ID of the signed-in user, or None. Only called once a sharded query
+    needs it.
+    """
+    state.get_user_id = get_user_id
+    state.shards = {}
+
+
+def end_request():
+    state.get_user_id = None
+    state.shards = None
+
+
+def move_user(user_id: int, target: str):
+    """
+    Moves a user's backlog to another shard. Entries are copied to the target, the directory is switched over, and
+    then the originals are deleted. Writes the user makes to the old shard between the copy and the switch are lost,
+    so users should be moved while they're inactive.
+
+    Entry IDs are only unique within a shard, so copied entries get new ones; tombstones are left for the old IDs so
+    that delta sync clients replace their copies.
+    @param user_id: The ID of a user.
+    @param target: The alias of the database to move the backlog to.
+    @return: The number of backlog entries moved.
+    """
+    if target not in settings.BACKLOG_SHARDS:
+        raise ShardingError(f'"{target}" isn\'t one of the shards in settings.BACKLOG_SHARDS.')
+
+    source = shard_for_user(user_id)
+    if source == target:
+        return 0
+
+    entries = list(models.BackloggedGame.objects.using(source).filter(user_id=user_id).select_related("customgame"))
+    tombstones = [models.BacklogTombstone(entry_id=entry_id, game_id=game_id, user_id=user_id)
+                  for entry_id, game_id in models.BacklogTombstone.objects.using(source).filter(user_id=user_id)
+                  .values_list("entry_id", "game_id")]
+
+    with transaction.atomic(using=target):
+        for entry in entries:
+            old_entry_id, game_id, custom_game = entry.entry_id, entry.game_id, entry.custom_data
+
+            entry.entry_id = None
+            entry._state.adding = True
+            entry.save(using=target)
+
+            if custom_game:
+                custom_game.backlogged = entry
+                custom_game.save(using=target, force_insert=True)
+
+            tombstones.append(models.BacklogTombstone(entry_id=old_entry_id, game_id=game_id, user_id=user_id))
+
+        models.BacklogTombstone.objects.using(target).bulk_create(tombstones)
+        # recounted on first use in the new shard
+        models.UserBacklogCounter.objects.using(target).filter(user_id=user_id).delete()
+        models.BacklogStat.objects.using(target).filter(user_id=user_id).delete()
+
+    models.UserShard.objects.using(PRIMARY).update_or_create(user_id=user_id, defaults={"shard": target})
+    if getattr(state, "shards", None) is not None:
+        state.shards[user_id] = target
+
+    with transaction.atomic(using=source):
+        models.BackloggedGame.objects.using(source).filter(user_id=user_id).delete()
+        models.BacklogTombstone.objects.using(source).filter(user_id=user_id).delete()
+        models.UserBacklogCounter.objects.using(source).filter(user_id=user_id).delete()
+        models.BacklogStat.objects.using(source).filter(user_id=user_id).delete()
+
+    return len(entries)
+
+
+def shard_sizes():
+    """
+    Counts the backlog entries in each shard.
+    @return: A dictionary mapping each shard's alias to its number of backlog entries.
+    """
+    return {shard: models.BackloggedGame.objects.using(shard).count() for shard in settings.BACKLOG_SHARDS}
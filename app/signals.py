@@ -0,0 +1,145 @@
+"""
+Signal receivers.
+"""
+
+import collections
+import contextlib
+import threading
+
+from django.contrib.auth.models import User
+from django.db.models import F
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_migrate
+from django.dispatch import receiver
+
+import app.models as models
+import app.routers as routers
+import app.sharding as sharding
+import app.stats as stats
+
+state = threading.local()
+
+
+@contextlib.contextmanager
+def bulk_changes():
+    """
+    Turns off the per-entry bookkeeping done when backlog entries are deleted (counters, statistics and tombstones) for
+    the duration of a with block, for callers that delete entries in bulk and do that bookkeeping themselves in a few
+    queries.
+    """
+    previous = getattr(state, "bulk", False)
+    state.bulk = True
+    try:
+        yield
+    finally:
+        state.bulk = previous
+
+
+def adjust_now_playing_counter(user_id: int, delta: int, using: str):
+    """
+    Adds delta to a user's Now Playing counter. Users without a counter row yet are skipped; their counter is counted
+    from scratch the first time it's read (see helpers.get_num_now_playing()).
+    @param user_id: The ID of a user.
+    @param delta: The change in the number of games in the user's Now Playing.
+    @param using: The alias of the database holding the user's backlog.
+    """
+    if delta:
+        models.UserBacklogCounter.objects.using(using).filter(user_id=user_id).update(
+            num_now_playing=F("num_now_playing") + delta)
+
+
+@receiver(post_save, sender=models.BackloggedGame)
+def update_counters_on_save(sender, instance, created, **kwargs):
+    """
+    Keeps the user's Now Playing counter and backlog statistics in step with new entries and status or platform
+    changes.
+    """
+    saved_status_id = getattr(instance, "saved_status_id", None)
+    saved_platform_id = getattr(instance, "saved_platform_id", None)
+
+    adjust_now_playing_counter(instance.user_id, (instance.status_id == 2) - (saved_status_id == 2), instance._state.db)
+
+    deltas = collections.Counter()
+    if created:
+        deltas.update(stats.entry_keys(instance.platform_id, instance.status_id, instance.date_added,
+                                       instance.is_custom))
+    else:
+        for dimension, saved, current in (("status", saved_status_id, instance.status_id),
+                                          ("platform", saved_platform_id, instance.platform_id)):
+            if saved is not None and saved != current:
+                deltas[(dimension, str(saved))] -= 1
+                deltas[(dimension, str(current))] += 1
+    stats.adjust(instance.user_id, deltas, instance._state.db)
+
+    instance.saved_status_id = instance.status_id
+    instance.saved_platform_id = instance.platform_id
+
+
+@receiver(post_delete, sender=models.BackloggedGame)
+def update_counters_on_delete(sender, instance, **kwargs):
+    """
+    Keeps the user's Now Playing counter and backlog statistics in step with removed entries.
+    """
+    if getattr(state, "bulk", False):
+        return
+
+    adjust_now_playing_counter(instance.user_id, -(instance.status_id == 2), instance._state.db)
+    stats.adjust(instance.user_id, {key: -1 for key in stats.entry_keys(instance.platform_id, instance.status_id,
+                                                                          instance.date_added, instance.is_custom)},
+                 instance._state.db)
+
+
+@receiver(post_delete, sender=models.BackloggedGame)
+def record_backlog_tombstone(sender, instance, **kwargs):
+    """
+    Leaves a tombstone for every deleted backlog entry so that delta sync clients can drop it too. This also runs for
+    entries deleted by a cascade, which is why BacklogTombstone.user_id can't be a foreign key.
+    """
+    if getattr(state, "bulk", False):
+        return
+
+    models.BacklogTombstone.objects.using(instance._state.db).create(entry_id=instance.entry_id,
+                                                                     game_id=instance.game_id, user_id=instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def assign_new_user_shard(sender, instance, created, **kwargs):
+    """
+    Decides which shard a new user's backlog goes in.
+    """
+    if created and sharding.is_enabled():
+        sharding.assign_shard(instance.id)
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_backlog(sender, instance, **kwargs):
+    """
+    Deletes a user's backlog from its shard, since cascades from the default database don't reach other databases.
+    """
+    instance.backlog_shard = sharding.shard_for_user(instance.id)
+
+    if instance.backlog_shard != sharding.PRIMARY:
+        models.BackloggedGame.objects.using(instance.backlog_shard).filter(user_id=instance.id).delete()
+        models.UserBacklogCounter.objects.using(instance.backlog_shard).filter(user_id=instance.id).delete()
+        models.BacklogStat.objects.using(instance.backlog_shard).filter(user_id=instance.id).delete()
+
+
+@receiver(post_delete, sender=User)
+def delete_user_tombstones(sender, instance, **kwargs):
+    """
+    Removes the tombstones left behind when a deleted user's backlog was cascade-deleted.
+    """
+    shard = getattr(instance, "backlog_shard", sharding.PRIMARY)
+    models.BacklogTombstone.objects.using(shard).filter(user_id=instance.id).delete()
+
+
+@receiver(pre_migrate)
+def route_to_migrated_database(sender, using, **kwargs):
+    """
+    Sends the queries of data migrations to the database being migrated (see app.routers.begin_migration()).
+    """
+    routers.begin_migration(using)
+
+
+@receiver(post_migrate)
+def stop_routing_to_migrated_database(sender, **kwargs):
+    routers.end_migration()
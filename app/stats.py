@@ -0,0 +1,159 @@
+"""
+Per-user backlog statistics, kept in BacklogStat rows that are adjusted on every backlog write (see app.signals and
+helpers.bulk_update_backlog()), so that the stats page reads a few rows per user however large their backlog is.
+
+Every user whose statistics have been built has a ("total", "") row. Users without one haven't been counted yet: writes
+leave them alone, and their statistics are built from scratch the first time they're read, or by the
+rebuild_backlog_stats command.
+"""
+
+import collections
+import datetime
+import functools
+import operator
+
+from django.db import router, transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Value, When
+
+import app.models as models
+
+TOTAL = ("total", "")
+
+
+def entry_keys(platform_id: int, status_id: int, date_added, is_custom: bool):
+    """
+    Lists the statistics a backlog entry counts towards.
+    @param platform_id: The entry's platform.
+    @param status_id: The entry's status.
+    @param date_added: The date the entry was added, as a date or a "YYYY-MM-DD" string.
+    @param is_custom: Whether the entry is a custom game.
+    @return: A list of (dimension, value) pairs.
+    """
+    return [TOTAL, ("status", str(status_id)), ("platform", str(platform_id)), ("month", str(date_added)[:7]),
+            ("source", "custom" if is_custom else "igdb")]
+
+
+def matching(keys):
+    return functools.reduce(operator.or_, (Q(dimension=dimension, value=value) for dimension, value in keys))
+
+
+def adjust(user_id: int, deltas: dict, using: str):
+    """
+    Applies changes to a user's statistics, normally in a single query. Users whose statistics haven't been built yet
+    are skipped.
+    @param user_id: The ID of a user.
+    @param deltas: A dictionary mapping (dimension, value) pairs to changes in their counts.
+    @param using: The alias of the database holding the user's backlog.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    stats = models.BacklogStat.objects.using(using).filter(user_id=user_id)
+    # the total is always matched, even when it doesn't change, to find out whether the user has statistics at all
+    keys = set(deltas) | {TOTAL}
+
+    def apply(keys):
+        change = Case(*(When(dimension=dimension, value=value, then=Value(deltas.get((dimension, value), 0)))
+                        for dimension, value in keys), default=Value(0), output_field=IntegerField())
+        return stats.filter(matching(keys)).update(count=F("count") + change)
+
+    num_updated = apply(keys)
+    # nothing updated means there's no total either, so the user doesn't have statistics yet
+    if num_updated in (0, len(keys)):
+        return
+
+    existing = set(stats.filter(matching(keys)).values_list("dimension", "value"))
+
+    # the first entry on a new platform or in a new month
+    missing = keys - existing
+    models.BacklogStat.objects.using(using).bulk_create(
+        [models.BacklogStat(user_id=user_id, dimension=dimension, value=value) for dimension, value in missing],
+        ignore_conflicts=True)
+    apply(missing)
+
+
+def count(user_id: int, using: str):
+    """
+    Counts a user's statistics from their backlog, in one query.
+    @param user_id: The ID of a user.
+    @param using: The alias of the database holding the user's backlog.
+    @return: A Counter mapping (dimension, value) pairs to counts.
+    """
+    counts = collections.Counter({TOTAL: 0})
+    groups = (models.BackloggedGame.objects.using(using).filter(user_id=user_id)
+              .values_list("platform_id", "status_id", "date_added", "is_custom")
+              .annotate(num_entries=Count("entry_id")).order_by())
+
+    for platform_id, status_id, date_added, is_custom, num_entries in groups:
+        for key in entry_keys(platform_id, status_id, date_added, is_custom):
+            counts[key] += num_entries
+
+    return counts
+
+
+def build(user_id: int, using: str):
+    """
+    Replaces a user's statistics with ones counted from their backlog.
+    @param user_id: The ID of a user.
+    @param using: The alias of the database holding the user's backlog.
+    @return: A Counter mapping (dimension, value) pairs to counts.
+    """
+    with transaction.atomic(using=using):
+        counts = count(user_id, using)
+        models.BacklogStat.objects.using(using).filter(user_id=user_id).delete()
+        models.BacklogStat.objects.using(using).bulk_create(
+            models.BacklogStat(user_id=user_id, dimension=dimension, value=value, count=num_entries)
+            for (dimension, value), num_entries in counts.items() if num_entries or (dimension, value) == TOTAL)
+
+    return counts
+
+
+def check(user_id: int, using: str):
+    """
+    Compares a user's statistics with their backlog.
+    @param user_id: The ID of a user.
+    @param using: The alias of the database holding the user's backlog.
+    @return: A dictionary mapping each (dimension, value) pair that's wrong to its (stored, actual) counts. Empty if
+    the statistics are right or haven't been built yet.
+    """
+    stored = dict(((dimension, value), num_entries) for dimension, value, num_entries in
+                  models.BacklogStat.objects.using(using).filter(user_id=user_id)
+                  .values_list("dimension", "value", "count"))
+    if TOTAL not in stored:
+        return {}
+
+    actual = count(user_id, using)
+    return {key: (stored.get(key, 0), actual.get(key, 0)) for key in set(stored) | set(actual)
+            if stored.get(key, 0) != actual.get(key, 0)}
+
+
+def get_user_stats(user_id: int):
+    """
+    Gets a user's statistics for the stats page, building them first if they haven't been built yet.
+    @param user_id: The ID of a user.
+    @return: A dictionary with the user's number of entries ("total"), and lists of (label, count) pairs for
+    "statuses", "platforms" (most used first), "months" (oldest first, labelled with the month's first day) and
+    "sources".
+    """
+    counts = collections.Counter({(dimension, value): num_entries for dimension, value, num_entries in
+                                  models.BacklogStat.objects.filter(user_id=user_id)
+                                  .values_list("dimension", "value", "count")})
+    if TOTAL not in counts:
+        counts = build(user_id, router.db_for_write(models.BacklogStat))
+
+    def dimension(name):
+        return [(value, num_entries) for (key, value), num_entries in counts.items() if key == name and num_entries > 0]
+
+    statuses = dict(models.BacklogStatus.choices)
+
+    return {
+        "total": counts[TOTAL],
+        "statuses": [(statuses.get(int(value), value), num_entries) for value, num_entries in
+                     sorted(dimension("status"), key=lambda item: int(item[0]))],
+        "platforms": [(models.Platform.objects.get_name(int(value)), num_entries) for value, num_entries in
+                      sorted(dimension("platform"), key=lambda item: -item[1])],
+        "months": [(datetime.date(int(value[:4]), int(value[5:7]), 1), num_entries) for value, num_entries in
+                   sorted(dimension("month"))],
+        "sources": [(label, counts[("source", value)]) for value, label in (("igdb", "IGDB"), ("custom", "Custom"))],
+    }
@@ -5,9 +5,17 @@ Custom template tags and filters.
 import os
 
 from django import template
-from github import Github
-from github.GithubException import UnknownObjectException
-from markdown2 import markdown
+from django.conf import settings
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+import app.models as models
+from app.lazy import lazy_import
+
+markdown2 = lazy_import("markdown2")
+requests = lazy_import("requests")
+resilience = lazy_import("app.resilience")
+transport = lazy_import("app.transport")
 
 register = template.Library()
 
@@ -27,17 +35,60 @@ def get_latest_github_release(mode: str):
     Gets the tag name or description of the most recent release from Backlogged's GitHub repository
     (https://github.com/backlogged/backlogged).
     @param mode: "tag" or "body".
-    @return: A string containing the tag name or body.
+    @return: A string containing the tag name or body (possibly stale), or an empty string if there's no release or
+    GitHub is unavailable.
     """
-    github = Github(os.getenv("GITHUB_TOKEN"))
-    repo = github.get_repo("backlogged/backlogged")
+    headers = {"Accept": "application/vnd.github.v3+json"}
+    if os.getenv("GITHUB_TOKEN"):
+        headers["Authorization"] = f"token {os.getenv('GITHUB_TOKEN')}"
+
+    url = f"{settings.GITHUB_API_URL}/repos/backlogged/backlogged/releases/latest"
+
+    def fetch(timeout):
+        response = transport.get_transport().request("GET", url, headers=headers, timeout=timeout)
+        if response.status_code == 404:
+            return {}
+
+        response.raise_for_status()
+        return response.json()
 
     try:
-        release = repo.get_latest_release()
-    except UnknownObjectException:
+        release = resilience.call("github", fetch, key=url)
+    except (resilience.UpstreamUnavailable, requests.HTTPError):
+        # e.g. a 403 once the rate limit is used up, which doesn't count against the breaker
+        return ""
+
+    if not release:
         return ""
+
+    if mode == "tag":
+        return release["tag_name"]
+    elif mode == "body":
+        return markdown2.markdown(release["body"])
+
+
+@register.simple_tag(name="cover_attrs")
+def get_cover_attrs(image_id: str, fallback_url: str, display_width: int, lazy: bool = True):
+    """
+    Builds the src, srcset, sizes and loading attributes of an <img> showing a game's cover art, so that browsers
+    download the smallest IGDB variant that's sharp at the cover's displayed width and their screen's pixel density.
+    @param image_id: The cover's IGDB image id, or an empty string for custom games.
+    @param fallback_url: The cover's URL, used when there's no image id.
+    @param display_width: The width the cover is displayed at, in CSS pixels.
+    @param lazy: Optional. Whether the browser should wait to load the cover until it's about to be scrolled into view.
+    @return: The attributes as safe HTML.
+    """
+    if image_id:
+        cover_widths = {size: width for size, width in models.IGDB_IMAGE_SIZES.items() if size.startswith("cover")}
+        src_size = min((size for size, width in cover_widths.items() if width >= display_width),
+                       key=cover_widths.get, default=models.IGDB_DEFAULT_COVER_SIZE)
+        srcset = ", ".join(f"{models.igdb_image_url(image_id, size)} {width}w" for size, width in cover_widths.items())
+        attrs = format_html('src="{}" srcset="{}" sizes="{}px"', models.igdb_image_url(image_id, src_size), srcset,
+                            display_width)
     else:
-        if mode == "tag":
-            return release.tag_name
-        elif mode == "body":
-            return markdown(release.body)
+        attrs = format_html('src="{}"', fallback_url)
+
+    if lazy:
+        attrs += mark_safe(' loading="lazy" decoding="async"')
+
+    return attrs
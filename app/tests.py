@@ -1,3 +1,1600 @@
-from django.test import TestCase
+"""
+Tests for the app.
 
-# Create your tests here.
+ViewPerformanceTests are performance regression tests for every view in app.views. Each view is requested by users
+with realistic backlog sizes while app.benchmark.FakeIGDBServer stands in for IGDB, GitHub and ipwhois. A test fails
+when a request runs more database queries than pinned in BUDGETS, or when its fastest of TIMED_RUNS runs takes longer
+than its latency budget. The failure message lists the captured SQL, the queries that were repeated (the signature of
+an N+1), and a diff against the same request made by the user with the smallest backlog, which shows queries whose
+number grows with the backlog.
+
+Latency budgets are generous wall-clock limits for a developer machine; set PERFORMANCE_LATENCY_SCALE to scale them on
+slower hardware (e.g. PERFORMANCE_LATENCY_SCALE=3 in CI).
+"""
+
+import collections
+import datetime
+import difflib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from unittest import mock
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.db.utils import ConnectionHandler
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import app.api as api
+import app.benchmark as benchmark
+import app.db.pool as pool
+import app.deletion as deletion
+import app.helpers as helpers
+import app.memory as memory
+import app.metrics as metrics
+import app.models as models
+import app.querylog as querylog
+import app.resilience as resilience
+import app.routers as routers
+import app.sessions as sessions
+import app.sharding as sharding
+import app.stats as stats
+import app.transport as transport
+import app.typeahead as typeahead
+import app.views as views
+import app.warmup as warmup
+from app.middleware import ReplicaRoutingMiddleware
+from app.queries import Query
+
+# the backlog sizes of the test users: someone who just signed up, a typical user and a heavy one
+BACKLOG_SIZES = (5, 150, 1000)
+# each request is made once to warm up process-wide caches, then timed this many times
+TIMED_RUNS = 3
+LATENCY_SCALE = float(os.getenv("PERFORMANCE_LATENCY_SCALE", 1))
+
+# the most queries each request may run, and its latency budget in milliseconds, by test name; query counts must not
+# grow with the size of the user's backlog
+BUDGETS = {
+    "home": (1, 50),
+    "signup": (0, 100),
+    "signin": (0, 100),
+    "backlog": (7, 150),
+    "backlog-search": (7, 150),
+    "backlog-sort": (7, 150),
+    "backlog-filter-platform": (7, 150),
+    "backlog-view-all": (7, 400),
+    "backlog-bulk-action": (6, 100),
+    "backlog-stats": (3, 50),
+    "add-game": (1, 50),
+    "add-game-search": (3, 150),
+    "add-custom-game": (2, 100),
+    "custom-game-preview": (1, 50),
+    "edit-custom-game": (2, 100),
+    "game-info": (3, 100),
+    "game-info-custom": (3, 100),
+    "game-info-move": (11, 100),
+    "settings": (1, 50),
+    "change-username": (2, 50),
+    "change-password": (1, 50),
+    "change-time-zone": (2, 400),
+    "delete-account": (1, 50),
+    "admin": (1, 50),
+    "about": (1, 50),
+    "changelog": (1, 50),
+    "licenses": (1, 50),
+    "metrics": (0, 50),
+    "memory-profile": (1, 50),
+    "slow-query-log": (1, 50),
+}
+
+CUSTOM_GAME_FORM = {"game_name": "My Game", "involved_companies": "Me", "summary": "A summary of my game. " * 5,
+                    "platform": "6,PC (Microsoft Windows)"}
+
+
+def normalize_sql(sql: str):
+    """
+    Replaces the literal values in a query with placeholders, so that the same query made for different rows compares
+    equal.
+    @param sql: A captured SQL statement.
+    @return: The statement with its literals replaced.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "'?'", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    return re.sub(r"\((?:\?, )+\?\)", "(?, ...)", sql)
+
+
+def add_test_database(alias: str):
+    """
+    Adds a second SQLite database to the running tests, e.g. to stand in for a replica or a shard, and creates its
+    tables. It's a separate database rather than a test mirror of the default one, so a read shows where it went.
+    @param alias: The alias to add to django.db.connections.
+    @return: A function that drops the database again.
+    """
+    directory = tempfile.TemporaryDirectory()
+    name = os.path.join(directory.name, f"{alias}.sqlite3")
+    connections.databases[alias] = {**connections["default"].settings_dict, "NAME": name,
+                                    "TEST": {**connections["default"].settings_dict["TEST"], "NAME": name,
+                                             "MIRROR": None}}
+    old_name = connections[alias].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+    def remove():
+        connections[alias].creation.destroy_test_db(old_name, verbosity=0)
+        connections[alias].close()
+        del connections[alias]
+        del connections.databases[alias]
+        directory.cleanup()
+
+    return remove
+
+
+class ViewPerformanceTests(TestCase):
+    """
+    Pins the query count and latency of every view in app.views.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.upstream = benchmark.FakeIGDBServer().start()
+        cls.settings_override = override_settings(
+            SECURE_SSL_REDIRECT=False,
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+            DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage",
+            **cls.upstream.upstream_settings,
+        )
+        cls.settings_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        cls.upstream.stop()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = {}
+        cls.custom_game_ids = {}
+
+        for backlog_size in BACKLOG_SIZES:
+            user = benchmark.seed_benchmark_user(backlog_size)
+            backlogged = models.BackloggedGame.objects.create(
+                user=user, custom_id=uuid.uuid4(), game_name="My Game", custom_cover_url="https://example.com/c.png",
+                platform_id=6, date_added="2022-01-01", is_custom=True)
+            models.CustomGame.objects.create(backlogged=backlogged, user=user, involved_companies="Me",
+                                             summary="A summary of my game.", cover_img="Backlogged Custom Games/c.png")
+
+            cls.users[backlog_size] = user
+            cls.custom_game_ids[backlog_size] = backlogged.game_id
+
+    def measure(self, client: Client, method: str, path: str, data: dict = None, before=None):
+        """
+        Makes a request once to warm up, then TIMED_RUNS more times.
+        @param client: The Client to make the request with.
+        @param method: "get" or "post".
+        @param path: The path to request.
+        @param data: Optional. Query parameters or form data.
+        @param before: Optional. A function called with the client before every run, e.g. to put data in the session.
+        @return: The queries run by the first timed run, and the fastest run's duration in milliseconds.
+        """
+        queries, fastest = None, None
+
+        for run in range(TIMED_RUNS + 1):
+            if before:
+                before(client)
+
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = getattr(client, method)(path, data or {})
+                if response.streaming:
+                    # streamed pages run queries while they're read
+                    b"".join(response.streaming_content)
+                elapsed = (time.perf_counter() - start) * 1000
+
+            self.assertLess(response.status_code, 400, f"{method.upper()} {path} failed with {response.status_code}.")
+
+            if run == 1:
+                queries = [query["sql"] for query in captured.captured_queries]
+            if run >= 1:
+                fastest = elapsed if fastest is None else min(fastest, elapsed)
+
+        return queries, fastest
+
+    def assertWithinBudget(self, name: str, method: str, path, data=None, before=None, signed_in: bool = True):
+        """
+        Requests a view as every test user and checks each request against the view's budget.
+        @param name: The test's key in BUDGETS.
+        @param method: "get" or "post".
+        @param path: The path to request, or a function that takes a backlog size and returns one.
+        @param data: Optional. Query parameters or form data, or a function that takes a backlog size and returns them.
+        @param before: Optional. See measure().
+        @param signed_in: Optional. False to request the view once, without signing in.
+        """
+        max_queries, budget_ms = BUDGETS[name]
+        budget_ms *= LATENCY_SCALE
+
+        results = {}
+        for backlog_size in BACKLOG_SIZES if signed_in else (0,):
+            client = Client()
+            if signed_in:
+                client.force_login(self.users[backlog_size])
+
+            results[backlog_size] = self.measure(client, method, path(backlog_size) if callable(path) else path,
+                                                 data(backlog_size) if callable(data) else data, before)
+
+        baseline_size = min(results)
+        failures = []
+        for backlog_size, (queries, elapsed) in results.items():
+            if len(queries) <= max_queries and elapsed <= budget_ms:
+                continue
+
+            normalized = [normalize_sql(sql) for sql in queries]
+            repeated = [(count, sql) for sql, count in collections.Counter(normalized).most_common() if count > 1]
+            diff = difflib.unified_diff([normalize_sql(sql) for sql in results[baseline_size][0]], normalized,
+                                        fromfile=f"backlog of {baseline_size}", tofile=f"backlog of {backlog_size}",
+                                        lineterm="")
+
+            failures.append(
+                f"{name} with a backlog of {backlog_size}: {len(queries)} queries (budget {max_queries}), "
+                f"{elapsed:.1f}ms (budget {budget_ms:.0f}ms)\n"
+                + "\n".join(f"  {i}. {sql}" for i, sql in enumerate(queries, start=1))
+                + "\nQueries run more than once:\n" + "\n".join(f"  {count}x {sql}" for count, sql in repeated)
+                + "\nDiff against the smallest backlog:\n" + "\n".join(diff)
+            )
+
+        if failures:
+            self.fail("\n\n".join(failures))
+
+    # Meta
+
+    def test_home(self):
+        self.assertWithinBudget("home", "get", "/")
+
+    def test_admin(self):
+        self.assertWithinBudget("admin", "get", "/admin/")
+
+    def test_about(self):
+        self.assertWithinBudget("about", "get", "/about/")
+
+    def test_changelog(self):
+        self.assertWithinBudget("changelog", "get", "/about/changelog")
+
+    def test_licenses(self):
+        self.assertWithinBudget("licenses", "get", "/about/licenses/")
+
+    @override_settings(METRICS_ALLOWED_IPS=["127.0.0.1"])
+    def test_metrics(self):
+        self.assertWithinBudget("metrics", "get", "/metrics", signed_in=False)
+
+    def test_memory_profile(self):
+        User.objects.filter(id__in=[user.id for user in self.users.values()]).update(is_staff=True)
+        self.assertWithinBudget("memory-profile", "get", "/metrics/memory/")
+
+    def test_slow_query_log(self):
+        User.objects.filter(id__in=[user.id for user in self.users.values()]).update(is_staff=True)
+        self.assertWithinBudget("slow-query-log", "get", "/metrics/queries/")
+
+    # Account Registration
+
+    def test_signup(self):
+        self.assertWithinBudget("signup", "get", "/signup/", signed_in=False)
+
+    def test_signin(self):
+        self.assertWithinBudget("signin", "get", "/login/", signed_in=False)
+
+    # Account Settings
+
+    def test_settings(self):
+        self.assertWithinBudget("settings", "get", "/settings/")
+
+    def test_change_username(self):
+        self.assertWithinBudget("change-username", "get", "/settings/change-username/")
+
+    def test_change_password(self):
+        self.assertWithinBudget("change-password", "get", "/settings/change-password/")
+
+    def test_change_time_zone(self):
+        self.assertWithinBudget("change-time-zone", "get", "/settings/change-time-zone")
+
+    def test_delete_account(self):
+        self.assertWithinBudget("delete-account", "get", "/settings/delete-account/")
+
+    # Viewing/Editing Games
+
+    def test_backlog(self):
+        self.assertWithinBudget("backlog", "get", "/backlog/")
+
+    def test_backlog_search(self):
+        self.assertWithinBudget("backlog-search", "get", "/backlog/", {"query": "game 1"})
+
+    def test_backlog_sort(self):
+        self.assertWithinBudget("backlog-sort", "get", "/backlog/", {"sort_option": "alphabetic"})
+
+    def test_backlog_filter_platform(self):
+        self.assertWithinBudget("backlog-filter-platform", "get", "/backlog/", {"sort_option": 48})
+
+    def test_backlog_view_all(self):
+        self.assertWithinBudget("backlog-view-all", "get", "/backlog/", {"view": "all"})
+
+    def test_backlog_bulk_action(self):
+        def data(backlog_size):
+            entry_ids = models.BackloggedGame.objects.filter(user=self.users[backlog_size]) \
+                .values_list("entry_id", flat=True)[:30]
+            return {"action": "platform", "platform": 48, "entry_ids": list(entry_ids)}
+
+        self.assertWithinBudget("backlog-bulk-action", "post", "/backlog/", data)
+
+    def test_backlog_stats(self):
+        self.assertWithinBudget("backlog-stats", "get", "/backlog/stats/")
+
+    def test_game_info(self):
+        self.assertWithinBudget("game-info", "get", "/backlog/games/id=3/")
+
+    def test_game_info_custom(self):
+        self.assertWithinBudget("game-info-custom", "get",
+                                lambda backlog_size: f"/backlog/games/id={self.custom_game_ids[backlog_size]}/")
+
+    def test_game_info_move(self):
+        self.assertWithinBudget("game-info-move", "post", "/backlog/games/id=3/", {"update_mode": "move"})
+
+    def test_edit_custom_game(self):
+        self.assertWithinBudget(
+            "edit-custom-game", "get",
+            lambda backlog_size: f"/backlog/games/edit-custom-game/id={self.custom_game_ids[backlog_size]}")
+
+    # Adding Games
+
+    def test_add_game(self):
+        self.assertWithinBudget("add-game", "get", "/backlog/games/add-game/")
+
+    def test_add_game_search(self):
+        self.assertWithinBudget("add-game-search", "get", "/backlog/games/add-game/search/", {"query": "benchmark"})
+
+    def test_add_custom_game(self):
+        self.assertWithinBudget("add-custom-game", "get", "/backlog/games/add-game/custom/")
+
+    def test_custom_game_preview(self):
+        self.assertWithinBudget("custom-game-preview", "get", "/backlog/games/add-game/custom/preview",
+                                before=lambda client: client.post("/backlog/games/add-game/custom/", CUSTOM_GAME_FORM))
+
+
+class QueryTests(SimpleTestCase):
+    """
+    Checks that app.queries renders equivalent queries identically and escapes what users type.
+    """
+
+    def test_field_and_condition_order(self):
+        self.assertEqual(str(Query("games").fields("url", "name").where(id=3, category=0)),
+                         str(Query("games").where(category=0).fields("name", "url", "name").where(id=3)))
+        self.assertEqual(str(Query("games").fields("name").where(id=3).limit(10)),
+                         "fields name;where id = 3;limit 10;")
+
+    def test_implied_fields(self):
+        self.assertEqual(Query("games").fields("platforms", "platforms.name", "cover.*", "cover.image_id", "*", "name")
+                         .canonical_fields(), ["*", "cover.*", "platforms.name"])
+
+    def test_widen(self):
+        widened = Query("games").fields("name").widen({"name", "summary"}).where(id=3)
+        self.assertEqual(widened, Query("games").fields("summary", "name").where(id=3))
+        self.assertEqual(widened, Query("games").fields("summary").widen({"name", "summary"}).where(id=3))
+
+    def test_search_escaping(self):
+        query = Query("games").search('  zelda";  fields *; where id = 1;\\\n').fields("name")
+        self.assertEqual(str(query), 'search "zelda\\"; fields *; where id = 1;\\\\";fields name;')
+
+    def test_values(self):
+        query = Query("games").where(id=[3, 1, 3], name='A "B"', checksum=None, franchise=True)
+        self.assertEqual(str(query), 'fields *;where checksum = null & franchise = true & id = (1,3) & '
+                                     'name = "A \\"B\\"";')
+
+    def test_invalid_fields(self):
+        with self.assertRaises(ValueError):
+            Query("games").fields("name; where id = 1")
+        with self.assertRaises(TypeError):
+            Query("games").where(id=object())
+
+
+class BacklogStatsTests(TestCase):
+    """
+    Checks that the statistics kept by app.stats stay equal to counts of the backlog through every kind of write.
+    """
+
+    def setUp(self):
+        self.user = benchmark.seed_benchmark_user(20)
+        stats.build(self.user.id, "default")
+
+    def assertStatsMatchBacklog(self):
+        self.assertEqual(stats.check(self.user.id, "default"), {})
+
+    def test_single_writes(self):
+        entry = models.BackloggedGame.objects.create(user=self.user, igdb_id=500, game_name="New Game", platform_id=6,
+                                                     date_added="2020-02-29")
+        self.assertStatsMatchBacklog()
+
+        entry.status_id = models.BacklogStatus.NOW_PLAYING
+        entry.save()
+        entry = models.BackloggedGame.objects.get(entry_id=entry.entry_id)
+        entry.platform_id = 48
+        entry.save()
+        self.assertStatsMatchBacklog()
+
+        entry.delete()
+        self.assertStatsMatchBacklog()
+
+    def test_bulk_writes(self):
+        entry_ids = list(models.BackloggedGame.objects.filter(user=self.user).values_list("entry_id", flat=True))
+
+        helpers.bulk_update_backlog(self.user.id, entry_ids[10:15], "now_playing")
+        helpers.bulk_update_backlog(self.user.id, entry_ids[:8], "backlog")
+        helpers.bulk_update_backlog(self.user.id, entry_ids[5:], "platform", platform_id=48)
+        self.assertStatsMatchBacklog()
+
+        helpers.bulk_update_backlog(self.user.id, entry_ids[::3], "remove")
+        self.assertStatsMatchBacklog()
+
+    def test_user_stats(self):
+        user_stats = stats.get_user_stats(self.user.id)
+
+        self.assertEqual(user_stats["total"], 20)
+        self.assertEqual(dict(user_stats["statuses"]), {"backlog": 15, "Now Playing": 5})
+        self.assertEqual(dict(user_stats["sources"]), {"IGDB": 20, "Custom": 0})
+        self.assertEqual(sum(num_entries for _, num_entries in user_stats["platforms"]), 20)
+        self.assertEqual(sum(num_entries for _, num_entries in user_stats["months"]), 20)
+
+
+class AccountDeletionTests(TestCase):
+    """
+    Checks that accounts queued by DeleteAccountView are deleted completely by app.deletion, even when interrupted.
+    """
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage",
+                                              MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = benchmark.seed_benchmark_user(20)
+        backlogged = models.BackloggedGame.objects.create(user=self.user, custom_id=uuid.uuid4(), game_name="My Game",
+                                                          platform_id=6, date_added="2022-01-01", is_custom=True)
+        self.custom_game = models.CustomGame(backlogged=backlogged, user=self.user, involved_companies="Me",
+                                             summary="A summary of my game.")
+        self.custom_game.cover_img.save("cover.png", ContentFile(b"cover"))
+
+        self.client.force_login(self.user)
+        self.client.post("/settings/delete-account/", {"password": "benchmark"})
+
+    def test_request(self):
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertEqual(self.client.get("/backlog/").status_code, 302)
+        self.assertEqual(models.AccountDeletion.objects.get(user_id=self.user.id).status,
+                         models.AccountDeletion.PENDING)
+
+    def test_process(self):
+        # the second batch fails, and the next attempt carries on from there
+        with mock.patch.object(deletion, "delete_files", side_effect=[None, OSError("storage unavailable")]), \
+                self.assertLogs("app.deletion", "ERROR"):
+            claimed = deletion.claim()
+            self.assertFalse(deletion.process(claimed, batch_size=7))
+        self.assertEqual((claimed.status, claimed.entries_deleted), (models.AccountDeletion.PENDING, 7))
+
+        claimed = deletion.claim()
+        self.assertEqual(claimed.attempts, 2)
+        self.assertTrue(deletion.process(claimed, batch_size=7))
+        self.assertIsNone(deletion.claim())
+
+        self.assertEqual((claimed.status, claimed.entries_deleted, claimed.covers_deleted),
+                         (models.AccountDeletion.DONE, 21, 1))
+        self.assertFalse(default_storage.exists(self.custom_game.cover_img.name))
+        self.assertFalse(User.objects.filter(id=self.user.id).exists())
+        for model in (models.BackloggedGame, models.CustomGame, models.BacklogTombstone, models.BacklogStat):
+            self.assertFalse(model.objects.filter(user_id=self.user.id).exists(), model.__name__)
+
+
+class MemoryProfilingTests(TestCase):
+    """
+    Checks that app.memory attributes growth between heap snapshots to the module in the app responsible for it.
+    """
+
+    def setUp(self):
+        settings_override = override_settings(MEMORY_PROFILING=True, MEMORY_PROFILING_SAMPLE_RATE=1)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(memory.clear)
+        self.addCleanup(tracemalloc.stop)
+        memory.start()
+
+    def test_snapshot_diff(self):
+        baseline = memory.take_snapshot("before")
+        self.held = [f"held {i}" * 10 for i in range(10000)]
+        snapshot = memory.take_snapshot("after")
+
+        growth = memory.report(snapshot, baseline)[0]
+        self.assertEqual(growth.module, "app.tests")
+        self.assertGreater(growth.size_diff, 500000)
+        self.assertTrue(growth.sites[0][0].startswith("app/tests.py:"))
+
+    def test_view(self):
+        staff = User.objects.create_user(username="staff", password="staff", is_staff=True)
+        self.client.force_login(staff)
+
+        self.client.post("/metrics/memory/", {"action": "snapshot", "label": "first"})
+        self.client.post("/metrics/memory/", {"action": "snapshot", "label": "second"})
+        response = self.client.get("/metrics/memory/")
+
+        self.assertEqual([snapshot.label for snapshot in response.context["snapshots"]], ["first", "second"])
+        self.assertEqual(response.context["baseline"].label, "first")
+        self.assertTrue(response.context["groups"])
+        self.assertIn("memory-profile", [view for view, *_ in response.context["peaks"]])
+
+        self.client.force_login(benchmark.seed_benchmark_user(1))
+        self.assertEqual(self.client.get("/metrics/memory/").status_code, 403)
+
+
+@override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_SAMPLE_RATE=1, SLOW_QUERY_EXPLAIN="analyze")
+class SlowQueryLogTests(TestCase):
+    """
+    Checks that app.querylog records slow queries with where they came from and how the database ran them.
+    """
+
+    def setUp(self):
+        self.addCleanup(querylog.clear)
+        querylog.clear()
+        self.user = benchmark.seed_benchmark_user(10)
+        self.client.force_login(self.user)
+
+    def test_records(self):
+        with self.assertLogs("app.querylog", "WARNING") as logs:
+            self.client.get("/backlog/stats/")
+            self.client.get("/backlog/stats/")
+        self.assertIn('"view": "backlog-stats"', logs.output[-1])
+
+        records = [record for record in querylog.get_records() if "app_backlogstat" in record["sql"]]
+        self.assertEqual({record["view"] for record in records}, {"backlog-stats"})
+        self.assertTrue(all(record["source"].startswith("app/stats.py:") for record in records))
+        self.assertIn(self.user.id, records[-1]["params"])
+        # the same statement is only explained once per interval
+        self.assertTrue(records[-1]["plan"])
+        self.assertIsNone(records[0]["plan"])
+
+    def test_view(self):
+        with self.assertLogs("app.querylog", "WARNING"):
+            self.client.get("/backlog/stats/")
+            self.assertEqual(self.client.get("/metrics/queries/").status_code, 403)
+
+            User.objects.filter(id=self.user.id).update(is_staff=True)
+            response = self.client.get("/metrics/queries/", {"view": "backlog-stats"})
+        self.assertTrue(response.context["records"])
+        self.assertContains(response, "app_backlogstat")
+
+    def test_redaction(self):
+        session_key = self.client.cookies["sessionid"].value
+        with self.assertLogs("app.querylog", "WARNING") as logs:
+            self.client.get("/backlog/stats/")
+            querylog.record(connection, 'UPDATE "app_usertimezone" SET "timezone" = %s WHERE "user_id" = %s',
+                            ["Europe/Paris", self.user.id], 0.5)
+        self.assertNotIn(session_key, "\n".join(logs.output))
+        self.assertNotIn("Europe/Paris", "\n".join(logs.output))
+
+        records = querylog.get_records()
+        self.assertEqual(records[0]["params"], [querylog.REDACTED, querylog.REDACTED])
+        user_records = [record for record in records if '"auth_user"' in record["sql"]]
+        self.assertTrue(user_records)
+        self.assertTrue(all(set(record["params"]) == {querylog.REDACTED} and record["plan"] is None
+                            for record in user_records))
+        # other SELECTs are recorded as they were, but not the writes
+        stats_records = [record for record in records if "app_backlogstat" in record["sql"]]
+        reads = [record for record in stats_records if record["sql"].startswith("SELECT")]
+        writes = [record for record in stats_records if not record["sql"].startswith("SELECT")]
+        self.assertIn(self.user.id, reads[0]["params"])
+        self.assertEqual({param for record in writes for param in record["params"]}, {querylog.REDACTED})
+
+
+class BacklogStreamingTests(TestCase):
+    """
+    Checks that BacklogView with ?view=all streams the whole backlog, sending the page before reading the games.
+    """
+
+    def setUp(self):
+        self.user = benchmark.seed_benchmark_user(50)
+        self.client.force_login(self.user)
+
+    def read(self, data):
+        with mock.patch.object(views.BacklogView, "stream_chunk_size", 7):
+            response = self.client.get("/backlog/", {"view": "all", **data})
+            self.assertTrue(response.streaming)
+            chunks = [chunk.decode() for chunk in response.streaming_content]
+
+        return chunks, re.findall(r'name="entry_ids" value="(\d+)"', "".join(chunks))
+
+    def test_whole_backlog(self):
+        chunks, entry_ids = self.read({})
+
+        self.assertGreater(len(chunks), 50 // 7)
+        self.assertIn("bulkForm", chunks[0])
+        self.assertIn("Show pages", chunks[-1])
+        entries = models.BackloggedGame.objects.filter(user=self.user)
+        self.assertEqual(sorted(entry_ids), sorted(str(entry_id) for entry_id in
+                                                   entries.values_list("entry_id", flat=True)))
+        # the Now Playing games come first, in a row of their own
+        self.assertEqual(set(entry_ids[:5]), {str(entry_id) for entry_id in entries.filter(
+            status_id=models.BacklogStatus.NOW_PLAYING).values_list("entry_id", flat=True)})
+        self.assertEqual(sum(chunk.count('<div class="row"') for chunk in chunks[1:-1]), 1)
+
+    def test_search_and_sort(self):
+        _, entry_ids = self.read({"sort_option": "alphabetic"})
+        self.assertEqual(len(entry_ids), 50)
+
+        _, entry_ids = self.read({"query": "game 1"})
+        self.assertEqual(len(entry_ids), models.BackloggedGame.objects.filter(
+            user=self.user, game_name__icontains="game 1").count())
+
+    def test_page_comes_first(self):
+        response = self.client.get("/backlog/", {"view": "all"})
+        content = iter(response.streaming_content)
+
+        with CaptureQueriesContext(connection) as captured:
+            self.assertIn(b"bulkForm", next(content))
+        self.assertEqual(len(captured), 0)
+
+        with CaptureQueriesContext(connection) as captured:
+            list(content)
+        self.assertEqual(len(captured), 1)
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_SAMPLE_RATE=1)
+    def test_streamed_queries_are_recorded(self):
+        self.addCleanup(querylog.clear)
+        querylog.clear()
+        counts = metrics.HTTP_REQUEST_QUERIES.values
+        recorded = counts.get(("backlog",), [0])[-1]
+
+        with CaptureQueriesContext(connection) as captured, self.assertLogs("app.querylog", "WARNING"):
+            response = self.client.get("/backlog/", {"view": "all"})
+            content = iter(response.streaming_content)
+            next(content)
+            # recorded once the whole page has been sent
+            self.assertEqual(counts.get(("backlog",), [0])[-1], recorded)
+            list(content)
+            response.close()
+
+        self.assertEqual(counts[("backlog",)][-1] - recorded, len(captured))
+        # the games, read while the page was being sent
+        latest = querylog.get_records()[0]
+        self.assertTrue(latest["source"].startswith("app/views.py:"))
+        self.assertEqual((latest["view"], latest["path"]), ("backlog", "/backlog/"))
+
+
+class TransportTests(SimpleTestCase):
+    """
+    Checks that responses saved by app.transport's RecordingTransport are replayed without touching the network.
+    """
+
+    def setUp(self):
+        cassette_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cassette_dir.cleanup)
+        self.cassette_dir = cassette_dir.name
+
+        with benchmark.FakeIGDBServer() as upstream:
+            self.url = f"{upstream.url}/v4/games.pb"
+            self.recorded = transport.RecordingTransport(self.cassette_dir).request(
+                "POST", self.url, headers={"Authorization": "Bearer secret"}, data="fields name;where id = 3;")
+            self.num_requests = upstream.request_count
+
+    def test_replay(self):
+        replayed = transport.ReplayTransport(self.cassette_dir).request("POST", self.url,
+                                                                        data="fields name;where id = 3;")
+
+        self.assertEqual(self.num_requests, 1)
+        self.assertEqual((replayed.status_code, replayed.headers["Content-Type"], replayed.content),
+                         (200, "application/protobuf", self.recorded.content))
+        # credentials never end up on disk
+        for filename in os.listdir(self.cassette_dir):
+            with open(os.path.join(self.cassette_dir, filename)) as file:
+                self.assertNotIn("secret", file.read())
+
+    def test_not_recorded(self):
+        replay = transport.ReplayTransport(self.cassette_dir)
+
+        # a different body is a different request; callers see it as a connection failure
+        with self.assertRaises(transport.CassetteNotFound):
+            replay.request("POST", self.url, data="fields name;where id = 4;")
+        with self.assertRaises(transport.requests.ConnectionError):
+            replay.request("GET", self.url)
+
+    def test_latency(self):
+        path = transport.cassette_path(self.cassette_dir, "POST", self.url, "fields name;where id = 3;")
+        with open(path) as file:
+            cassette = json.load(file)
+        cassette["response"]["elapsed_ms"] = 100
+        with open(path, "w") as file:
+            json.dump(cassette, file)
+
+        for latency, expected_ms in ((None, 0), (50, 50), ("recorded", 100)):
+            start = time.perf_counter()
+            transport.ReplayTransport(self.cassette_dir, latency).request("POST", self.url,
+                                                                          data="fields name;where id = 3;")
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.assertGreaterEqual(elapsed_ms, expected_ms, latency)
+            self.assertLess(elapsed_ms, expected_ms + 200 * LATENCY_SCALE, latency)
+
+    def test_get_transport(self):
+        with override_settings(UPSTREAM_TRANSPORT="replay", UPSTREAM_CASSETTE_DIR=self.cassette_dir,
+                               UPSTREAM_REPLAY_LATENCY=None):
+            measured = transport.get_transport()
+            counts = metrics.UPSTREAM_REQUEST_DURATION.values.get(("127.0.0.1", "2xx"), [0])
+            before = sum(counts[:-1])
+
+            measured.request("POST", self.url, data="fields name;where id = 3;")
+            counts = metrics.UPSTREAM_REQUEST_DURATION.values[("127.0.0.1", "2xx")]
+        self.assertIsInstance(measured.transport, transport.ReplayTransport)
+        self.assertEqual(sum(counts[:-1]), before + 1)
+
+        with override_settings(UPSTREAM_TRANSPORT="mock"), self.assertRaises(ValueError):
+            transport.get_transport()
+
+
+class BacklogApiTests(TestCase):
+    """
+    Checks that the backlog API validates requests before changing anything, and holds to the Now Playing limit.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.upstream = benchmark.FakeIGDBServer().start()
+        cls.settings_override = override_settings(**cls.upstream.upstream_settings)
+        cls.settings_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        cls.upstream.stop()
+
+    def setUp(self):
+        self.user = benchmark.seed_benchmark_user(10)
+        self.client.force_login(self.user)
+
+    def test_invalid_fields(self):
+        response = self.client.post("/api/v1/backlog/?fields=game_id,password", {"game_id": 500, "platform_id": 6},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.BackloggedGame.objects.filter(user=self.user, igdb_id=500).exists())
+
+        response = self.client.patch("/api/v1/backlog/1/?fields=password", {"now_playing": False},
+                                     content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(models.BackloggedGame.objects.get(user=self.user, igdb_id=1).status_id,
+                         models.BacklogStatus.NOW_PLAYING)
+
+        # so retrying without the bad field works
+        response = self.client.post("/api/v1/backlog/?fields=game_id,platform_id", {"game_id": 500, "platform_id": 6},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {"game_id": "500", "platform_id": 6})
+
+    def test_invalid_platform(self):
+        custom_entry = models.BackloggedGame.objects.create(user=self.user, custom_id=uuid.uuid4(), game_name="My Game",
+                                                            platform_id=6, date_added="2022-01-01", is_custom=True)
+
+        for entry in (models.BackloggedGame.objects.get(user=self.user, igdb_id=1), custom_entry):
+            response = self.client.patch(f"/api/v1/backlog/{entry.game_id}/", {"platform_id": "abc"},
+                                         content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["error"], "platform_id must be an integer.")
+
+        response = self.client.patch(f"/api/v1/backlog/{custom_entry.game_id}/", {"platform_id": 48},
+                                     content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_now_playing_limit(self):
+        models.UserBacklogCounter.objects.filter(user_id=self.user.id).delete()
+        self.assertEqual(helpers.get_num_now_playing(self.user.id), 5)
+        helpers.bulk_update_backlog(self.user.id, list(models.BackloggedGame.objects.filter(
+            user=self.user, igdb_id__in=range(6, 10)).values_list("entry_id", flat=True)), "now_playing")
+
+        response = self.client.post("/api/v1/backlog/", {"game_id": 500, "platform_id": 6, "now_playing": True},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.patch("/api/v1/backlog/10/", {"now_playing": True},
+                                           content_type="application/json").status_code, 409)
+
+        # a request that checked while there was still room is stopped at the write
+        with mock.patch.object(api, "check_now_playing_limit"):
+            self.assertEqual(self.client.patch("/api/v1/backlog/10/", {"now_playing": True},
+                                               content_type="application/json").status_code, 409)
+            self.assertEqual(self.client.post("/api/v1/backlog/", {"game_id": 501, "platform_id": 6,
+                                                                   "now_playing": True},
+                                              content_type="application/json").status_code, 409)
+        self.assertFalse(models.BackloggedGame.objects.filter(user=self.user, igdb_id=501).exists())
+        self.assertEqual(helpers.get_num_now_playing(self.user.id), 10)
+        self.assertEqual(helpers.count_now_playing(self.user.id), 10)
+
+
+class NowPlayingLimitTests(TestCase):
+    """
+    Checks that the pages that add games or move them into Now Playing hold to the limit when they save, not only in
+    the form.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.upstream = benchmark.FakeIGDBServer().start()
+        cls.settings_override = override_settings(**cls.upstream.upstream_settings)
+        cls.settings_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        cls.upstream.stop()
+
+    def setUp(self):
+        self.user = benchmark.seed_benchmark_user(12)
+        self.client.force_login(self.user)
+        helpers.bulk_update_backlog(self.user.id, list(models.BackloggedGame.objects.filter(
+            user=self.user, igdb_id__in=range(6, 11)).values_list("entry_id", flat=True)), "now_playing")
+        self.assertEqual(helpers.get_num_now_playing(self.user.id), 10)
+
+    def assertRefused(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "You can only have up to 10 games in your Now Playing")
+        self.assertEqual(helpers.count_now_playing(self.user.id), 10)
+
+    def test_game_info(self):
+        self.assertRefused(self.client.post("/backlog/games/id=12/", {"update_mode": "move"}))
+        self.assertEqual(models.BackloggedGame.objects.get(user=self.user, igdb_id=12).status_id,
+                         models.BacklogStatus.BACKLOG)
+
+        self.assertRefused(self.client.post("/backlog/games/id=500/", {"update_mode": "add", "now_playing": "on",
+                                                                        "platform": "6,PC (Microsoft Windows)"}))
+        self.assertFalse(models.BackloggedGame.objects.filter(user=self.user, igdb_id=500).exists())
+
+        # moving out of Now Playing, and adding to the backlog, don't need room
+        self.assertRedirects(self.client.post("/backlog/games/id=1/", {"update_mode": "move"}), "/backlog/",
+                             fetch_redirect_response=False)
+        self.assertEqual(helpers.get_num_now_playing(self.user.id), 9)
+
+    def test_without_counter(self):
+        counters = models.UserBacklogCounter.objects.filter(user_id=self.user.id)
+        counters.delete()
+        with self.assertRaises(helpers.NowPlayingLimitError), helpers.now_playing_room(self.user.id):
+            self.fail("There's no room.")
+
+        models.BackloggedGame.objects.filter(user=self.user, igdb_id=1).update(status_id=models.BacklogStatus.BACKLOG)
+        counters.delete()
+        with helpers.now_playing_room(self.user.id):
+            self.assertEqual(counters.get().num_now_playing, 9)
+
+    def test_custom_game(self):
+        session = self.client.session
+        session["custom_game"] = {"status_id": models.BacklogStatus.NOW_PLAYING, "name": "My Game"}
+        session.save()
+
+        self.assertRefused(self.client.post("/backlog/games/add-game/custom/preview", {"submit": "true"}))
+        self.assertFalse(models.BackloggedGame.objects.filter(user=self.user, is_custom=True).exists())
+        # still there to try again
+        self.assertEqual(self.client.session["custom_game"]["name"], "My Game")
+
+
+class SyncApiTests(TestCase):
+    """
+    Checks that SyncApiView reports every change and deletion since a sync token exactly, and that prune_tombstones only
+    deletes the tombstones no token can reach.
+    """
+
+    def setUp(self):
+        self.user = benchmark.seed_benchmark_user(10)
+        self.client.force_login(self.user)
+        self.entries = models.BackloggedGame.objects.filter(user=self.user)
+        # older than the overlap between syncs, so that only what each test changes is reported
+        self.entries.update(updated_at=timezone.now() - datetime.timedelta(hours=1))
+
+    def sync(self, token: str = None, status: int = 200):
+        response = self.client.get("/api/v1/sync/", {"fields": "status_id", **({"token": token} if token else {})})
+        self.assertEqual(response.status_code, status, response.content)
+        return response.json()
+
+    def test_changes_since_token(self):
+        first = self.sync()
+        self.assertEqual(sorted(entry["entry_id"] for entry in first["changed"]),
+                         sorted(self.entries.values_list("entry_id", flat=True)))
+        self.assertEqual(first["deleted"], [])
+
+        moved, removed = self.entries.get(igdb_id=1), self.entries.get(igdb_id=2)
+        self.client.patch("/api/v1/backlog/1/", {"now_playing": False}, content_type="application/json")
+        self.client.delete("/api/v1/backlog/2/")
+
+        second = self.sync(first["token"])
+        self.assertEqual(second["changed"], [{"entry_id": moved.entry_id, "status_id": models.BacklogStatus.BACKLOG}])
+        self.assertEqual(second["deleted"], [removed.entry_id])
+        self.assertNotEqual(second["token"], first["token"])
+
+    def test_expired_token(self):
+        self.entries.get(igdb_id=2).delete()
+        old = timezone.now() - api.SYNC_RETENTION - datetime.timedelta(days=1)
+        models.BacklogTombstone.objects.filter(user_id=self.user.id).update(deleted_at=old)
+
+        self.assertIn("expired", self.sync(api.encode_sync_token(old), status=410)["error"])
+        self.sync("not a token", status=400)
+        self.assertTrue(models.BacklogTombstone.objects.filter(user_id=self.user.id).exists())
+        # syncs only read, so that they don't pin the client to the primary
+        self.sync()
+        self.assertTrue(models.BacklogTombstone.objects.filter(user_id=self.user.id).exists())
+
+        recent = self.entries.get(igdb_id=3)
+        recent_id = recent.entry_id
+        recent.delete()
+        call_command("prune_tombstones", stdout=open(os.devnull, "w"))
+        self.assertEqual(list(models.BacklogTombstone.objects.filter(user_id=self.user.id)
+                              .values_list("entry_id", flat=True)), [recent_id])
+
+
+class SessionTests(TestCase):
+    """
+    Checks that app.sessions skips writing unchanged sessions and refuses to store sessions over their size limits.
+    """
+
+    def setUp(self):
+        self.addCleanup(sessions.metrics.reset)
+        sessions.metrics.reset()
+
+        store = sessions.SessionStore()
+        store["theme"] = "dark"
+        store.create()
+        self.session_key = store.session_key
+
+    def test_unchanged_not_written(self):
+        store = sessions.SessionStore(self.session_key)
+        self.assertEqual(store["theme"], "dark")
+        with CaptureQueriesContext(connection) as captured:
+            store.save()
+        self.assertEqual(len(captured), 0)
+
+        store["theme"] = "light"
+        store.save()
+        self.assertEqual(sessions.SessionStore(self.session_key)["theme"], "light")
+
+        counters = sessions.metrics.snapshot()
+        self.assertEqual((counters["saves"], counters["skipped_saves"]), (2, 1))
+        self.assertIn("backlogged_session_payload_bytes_count 2", metrics.exposition(metrics.registry.snapshot()))
+
+    @override_settings(SESSION_MAX_VALUE_BYTES=100, SESSION_MAX_BYTES=300)
+    def test_size_limits(self):
+        store = sessions.SessionStore(self.session_key)
+        store["search"] = "x" * 200
+        with self.assertRaisesMessage(sessions.SessionTooLarge, 'Session key "search"'):
+            store.save()
+
+        store = sessions.SessionStore(self.session_key)
+        for i in range(5):
+            store[f"search {i}"] = "x" * 80
+        with self.assertRaisesMessage(sessions.SessionTooLarge, "the limit is 300"):
+            store.save()
+
+        self.assertEqual(dict(sessions.SessionStore(self.session_key).load()), {"theme": "dark"})
+        self.assertEqual(sessions.metrics.snapshot()["rejected_saves"], 2)
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    """
+    Checks that app.db.pool hands out, recycles and replaces connections, using SQLite as a stand-in for PostgreSQL.
+    """
+
+    def make_pool(self, **options):
+        database = tempfile.NamedTemporaryFile(suffix=".sqlite3")
+        self.addCleanup(database.close)
+
+        connection_pool = pool.ConnectionPool(lambda: sqlite3.connect(database.name, check_same_thread=False),
+                                              **{"max_size": 2, "timeout": 0.2, **options})
+        self.addCleanup(connection_pool.close_idle)
+        return connection_pool
+
+    def test_checkout_and_return(self):
+        connection_pool = self.make_pool()
+
+        first = connection_pool.acquire()
+        second = connection_pool.acquire()
+        self.assertIsNot(first, second)
+        connection_pool.release(first)
+        self.assertIs(connection_pool.acquire(), first)
+        connection_pool.release(second)
+        connection_pool.release(first, discard=True)
+
+        self.assertEqual({key: connection_pool.metrics()[key] for key in ("in_use", "idle", "created", "checkouts",
+                                                                          "closed_discarded")},
+                         {"in_use": 0, "idle": 1, "created": 2, "checkouts": 3, "closed_discarded": 1})
+
+    def test_exhaustion(self):
+        connection_pool = self.make_pool(max_size=1)
+        held = connection_pool.acquire()
+
+        with self.assertRaises(pool.PoolTimeout):
+            connection_pool.acquire()
+
+        # a connection returned while another thread waits goes to that thread
+        threading.Timer(0.05, connection_pool.release, [held]).start()
+        self.assertIs(connection_pool.acquire(), held)
+        self.assertEqual((connection_pool.stats["timeouts"], connection_pool.stats["waits"]), (1, 1))
+
+    def test_max_lifetime(self):
+        connection_pool = self.make_pool(max_lifetime=60)
+        old = connection_pool.acquire()
+        connection_pool.release(old)
+        connection_pool.idle[0].created_at -= 61
+
+        new = connection_pool.acquire()
+        self.assertIsNot(new, old)
+        # connections that expire while checked out are closed when they're returned
+        connection_pool.in_use[id(new)].created_at -= 61
+        connection_pool.release(new)
+        self.assertEqual((connection_pool.size, connection_pool.stats["closed_recycled"]), (0, 2))
+
+    def test_failed_health_check(self):
+        connection_pool = self.make_pool(health_check_interval=0)
+        broken = connection_pool.acquire()
+        connection_pool.release(broken)
+        broken.close()
+
+        replacement = connection_pool.acquire()
+        self.assertIsNot(replacement, broken)
+        self.assertTrue(pool.ping(replacement))
+        self.assertEqual(connection_pool.stats["health_check_failures"], 1)
+
+    def test_pools_per_process(self):
+        database = tempfile.NamedTemporaryFile(suffix=".sqlite3")
+        self.addCleanup(database.close)
+        self.addCleanup(pool.pools.clear)
+
+        def connect():
+            return sqlite3.connect(database.name, check_same_thread=False)
+
+        parent = pool.get_pool(("tests",), connect)
+        parent.release(parent.acquire())
+        self.assertIs(pool.get_pool(("tests",), connect), parent)
+
+        # a forked worker starts with a pool of its own, rather than using connections opened before the fork
+        with mock.patch.object(pool.os, "getpid", return_value=os.getpid() + 1):
+            child = pool.get_pool(("tests",), connect)
+            self.assertIsNot(child, parent)
+            self.assertEqual(pool.pool_metrics()["tests"]["idle"], 0)
+            connection = child.acquire()
+            self.assertIsNot(connection, parent.idle[0].connection)
+            child.release(connection, discard=True)
+        parent.close_idle()
+
+    def test_close_all(self):
+        database = tempfile.NamedTemporaryFile(suffix=".sqlite3")
+        self.addCleanup(database.close)
+        self.addCleanup(pool.pools.clear)
+        handler = ConnectionHandler({"default": {"ENGINE": "app.db.backends.sqlite3", "NAME": database.name,
+                                                 "POOL": {"MAX_SIZE": 2, "HEALTH_CHECK_INTERVAL": 0}}})
+
+        with handler["default"].cursor() as cursor:
+            cursor.execute("SELECT 1")
+        raw = handler["default"].connection
+        connection_pool = handler["default"].pool
+
+        # closing Django's connections only hands them back to the pool, still open
+        handler.close_all()
+        self.assertEqual(list(connection_pool.idle)[0].connection, raw)
+        self.assertTrue(pool.ping(raw))
+
+        pool.close_pools()
+        self.assertEqual(connection_pool.size, 0)
+        self.assertFalse(pool.ping(raw))
+
+
+class ReplicaRoutingTests(TestCase):
+    """
+    Checks that app.routers.ReplicaRouter and ReplicaRoutingMiddleware send reads to a replica only while the browser
+    hasn't just written, using a second SQLite database as the replica. The replica's copy of the backlog has a
+    different game name, to show which database each read went to.
+    """
+    # the replica is only added in setUpClass(), too late to be named here
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.remove_replica = add_test_database("test_replica")
+        cls.settings_override = override_settings(REPLICA_DATABASES=["test_replica"])
+        cls.settings_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        cls.remove_replica()
+
+    def setUp(self):
+        self.user = benchmark.seed_benchmark_user(5)
+        for model in (User, models.Platform, models.BackloggedGame):
+            model.objects.using("test_replica").bulk_create(model.objects.using("default").all())
+        models.BackloggedGame.objects.using("test_replica").filter(igdb_id=1).update(game_name="Lagging Game 1")
+
+        self.client.force_login(self.user)
+
+    def get_game_name(self):
+        response = self.client.get("/api/v1/backlog/1/", {"fields": "game_name"})
+        self.assertEqual(response.status_code, 200)
+        return response.json()["game_name"]
+
+    def test_reads_after_write(self):
+        self.assertEqual(self.get_game_name(), "Lagging Game 1")
+
+        response = self.client.patch("/api/v1/backlog/1/", {"now_playing": False}, content_type="application/json")
+        self.assertIn(ReplicaRoutingMiddleware.pin_cookie, response.cookies)
+        self.assertEqual(self.get_game_name(), "Benchmark Game 1")
+
+        self.client.cookies.pop(ReplicaRoutingMiddleware.pin_cookie)
+        self.assertEqual(self.get_game_name(), "Lagging Game 1")
+
+    def test_view_overrides(self):
+        # SyncApiView always reads from the primary
+        changed = self.client.get("/api/v1/sync/", {"fields": "game_name"}).json()["changed"]
+        self.assertIn("Benchmark Game 1", [entry["game_name"] for entry in changed])
+
+        self.client.cookies[ReplicaRoutingMiddleware.pin_cookie] = "1"
+        self.assertEqual(self.get_game_name(), "Benchmark Game 1")
+        with mock.patch.object(api.BacklogEntryApiView, "reads_from", "replica", create=True):
+            self.assertEqual(self.get_game_name(), "Lagging Game 1")
+
+    def test_relations_across_databases(self):
+        replica_entry = models.BackloggedGame.objects.using("test_replica").get(user=self.user, igdb_id=1)
+        primary_user = User.objects.using("default").get(id=self.user.id)
+
+        self.assertTrue(routers.ReplicaRouter().allow_relation(replica_entry, primary_user))
+        replica_entry.user = primary_user
+        self.assertEqual(replica_entry.user_id, self.user.id)
+
+
+class ShardingTests(TestCase):
+    """
+    Checks that app.sharding keeps each user's backlog in one shard and moves it between shards intact, using a second
+    SQLite database as the second shard.
+    """
+    # the shard is only added in setUpClass(), too late to be named here
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.settings_override = override_settings(BACKLOG_SHARDS=["default", "test_shard"])
+        cls.settings_override.enable()
+        # migrating the shard also runs the data migrations written before sharding against it
+        cls.remove_shard = add_test_database("test_shard")
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.remove_shard()
+        cls.settings_override.disable()
+
+    def setUp(self):
+        self.users = [benchmark.seed_benchmark_user(backlog_size) for backlog_size in (30, 12, 6)]
+        self.user = self.users[0]
+
+    def count_entries(self, user, shard: str):
+        return models.BackloggedGame.objects.using(shard).filter(user_id=user.id).count()
+
+    def test_requests_use_the_users_shard(self):
+        self.assertEqual(sharding.move_user(self.user.id, "test_shard"), 30)
+        self.assertEqual(self.count_entries(self.user, "default"), 0)
+        self.assertEqual(self.count_entries(self.user, "test_shard"), 30)
+
+        self.client.force_login(self.user)
+        response = self.client.get("/api/v1/backlog/", {"fields": "game_id", "limit": 100})
+        self.assertEqual(len(response.json()["results"]), 30)
+
+        response = self.client.patch("/api/v1/backlog/7/", {"now_playing": True}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        moved = models.BackloggedGame.objects.using("test_shard").get(user_id=self.user.id, igdb_id=7)
+        self.assertEqual(moved.status_id, models.BacklogStatus.NOW_PLAYING)
+        # entry IDs changed with the move, so delta sync clients are told to replace their copies
+        self.assertEqual(models.BacklogTombstone.objects.using("test_shard").filter(user_id=self.user.id).count(), 30)
+
+    def test_queries_outside_requests(self):
+        with self.assertRaises(sharding.ShardingError):
+            models.BackloggedGame.objects.filter(user_id=self.user.id).count()
+
+        sharding.move_user(self.user.id, "test_shard")
+        with sharding.using_shard_of(self.user.id):
+            self.assertEqual(models.BackloggedGame.objects.filter(user_id=self.user.id).count(), 30)
+
+    def test_rebalance(self):
+        call_command("rebalance_shards", "--dry-run", stdout=open(os.devnull, "w"))
+        self.assertEqual(sharding.shard_sizes(), {"default": 48, "test_shard": 0})
+
+        call_command("rebalance_shards", stdout=open(os.devnull, "w"))
+        sizes = sharding.shard_sizes()
+        self.assertEqual(sum(sizes.values()), 48)
+        self.assertLessEqual(max(sizes.values()), 30)
+        self.assertGreater(sizes["test_shard"], 0)
+        for user in self.users:
+            shard = sharding.shard_for_user(user.id)
+            self.assertEqual(self.count_entries(user, shard), int(user.username.split("-")[1]))
+
+        with self.assertRaises(CommandError):
+            call_command("rebalance_shards", "--user", self.user.id, "--to", "test_shard_2")
+
+    def test_admin(self):
+        sharding.move_user(self.user.id, "test_shard")
+        staff = User.objects.create_superuser(username="staff", password="staff")
+        self.client.force_login(staff)
+
+        changelist = reverse("admin:app_backloggedgame_changelist")
+        self.assertEqual(self.client.get(changelist, {"shard": "test_shard"}).context["cl"].result_count, 30)
+        self.assertEqual(self.client.get(changelist).context["cl"].result_count, 18)
+
+        # change pages opened from the shard's list look in that shard
+        entry = models.BackloggedGame.objects.using("test_shard").get(user_id=self.user.id, igdb_id=1)
+        response = self.client.get(reverse("admin:app_backloggedgame_change", args=[entry.entry_id]),
+                                   {"_changelist_filters": "shard=test_shard"})
+        self.assertContains(response, "Benchmark Game 1")
+
+
+class TypeaheadTests(TestCase):
+    """
+    Checks the typeahead index and that searches don't wait for it to be read from the backlogs.
+    """
+
+    def setUp(self):
+        self.index = typeahead.TitleIndex()
+
+    def test_add(self):
+        # a batch small enough to insert key by key, then one merged into the keys
+        self.index.add_many([(1, "The Legend of Zelda"), (2, "Zelda II: The Adventure of Link")])
+        self.index.add_many((game_id, f"Benchmark Game {game_id}") for game_id in range(3, 100))
+        self.index.add(100, "Super Mario Bros.")
+        self.index.add(101, "the legend of zelda")
+        self.assertEqual(self.index.keys, sorted(self.index.keys))
+        self.assertEqual(len(self.index), 100)
+
+        self.assertEqual(self.index.search("zel"), [(2, "Zelda II: The Adventure of Link"), (1, "The Legend of Zelda")])
+        self.assertEqual(self.index.search("legend of z"), [(1, "The Legend of Zelda")])
+        self.assertEqual(self.index.search("mario"), [(100, "Super Mario Bros.")])
+        self.assertEqual(len(self.index.search("benchmark game", limit=20)), 20)
+
+    def test_refresh(self):
+        user = benchmark.seed_benchmark_user(12)
+        self.assertEqual(self.index.refresh(), 12)
+        self.assertEqual(self.index.search("benchmark game 12"), [(12, "Benchmark Game 12")])
+
+        entry = models.BackloggedGame.objects.get(user_id=user.id, igdb_id=12)
+        entry.entry_id, entry.igdb_id, entry.game_name = None, 13, "Benchmark Game 13"
+        entry.save()
+        self.assertEqual(self.index.refresh(), 1)
+        self.assertFalse(self.index.is_stale())
+
+    def test_searches_dont_wait_for_refresh(self):
+        self.index.add(1, "The Legend of Zelda")
+        started, finish = threading.Event(), threading.Event()
+
+        def refresh():
+            started.set()
+            finish.wait(5)
+            self.index.refreshed_at = time.monotonic()
+
+        with mock.patch.object(typeahead, "index", self.index), mock.patch.object(self.index, "refresh", refresh):
+            self.assertEqual(typeahead.suggest("zel"), [(1, "The Legend of Zelda")])
+            self.assertTrue(started.wait(5))
+            # a refresh is already running
+            self.assertIsNone(self.index.refresh_in_background())
+
+            finish.set()
+            for _ in range(50):
+                if not self.index.refreshing:
+                    break
+                time.sleep(0.1)
+            self.assertFalse(self.index.refreshing)
+            self.assertIsNone(self.index.refresh_in_background())
+
+
+class MetricsTests(TestCase):
+    """
+    Checks that a scrape served by one worker reports the metrics of every worker, including those that have exited,
+    using forked processes as the other workers.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        settings_override = override_settings(METRICS_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.addCleanup(metrics.SLOW_QUERIES.values.pop, ("metrics-test", "default"), None)
+        self.addCleanup(metrics.UPSTREAM_CIRCUIT_STATE.values.pop, ("metrics-test", "closed"), None)
+        metrics.clear(self.directory)
+
+        staff = User.objects.create_user(username="staff", password="staff", is_staff=True)
+        self.client.force_login(staff)
+
+    def start_worker(self, slow_queries: int, reset: bool = False):
+        """
+        Forks a process that records some metrics, writes its snapshot and waits to be stopped. It's stopped at the end
+        of the test if it's still running then.
+        @param slow_queries: How many slow queries the process counts, on top of those counted before it was forked.
+        @param reset: Optional. Whether the process resets its metrics first, instead of starting with this process's.
+        @return: The process's ID, and a function that stops it.
+        """
+        ready_read, ready_write = os.pipe()
+        stop_read, stop_write = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if reset:
+                    metrics.reset()
+                metrics.SLOW_QUERIES.inc(slow_queries, view="metrics-test", database="default")
+                metrics.UPSTREAM_CIRCUIT_STATE.set(1, service="metrics-test", state="closed")
+                metrics.registry.flush(force=True)
+                os.write(ready_write, b"1")
+                os.read(stop_read, 1)
+            finally:
+                os._exit(0)
+
+        os.close(ready_write)
+        os.close(stop_read)
+        os.read(ready_read, 1)
+        os.close(ready_read)
+
+        def stop():
+            if stop_write in open_fds:
+                os.write(stop_write, b"1")
+                os.close(stop_write)
+                os.waitpid(pid, 0)
+                open_fds.remove(stop_write)
+
+        open_fds = {stop_write}
+        self.addCleanup(stop)
+        return pid, stop
+
+    def assertScraped(self, slow_queries: int, circuits_closed: int = None):
+        lines = self.client.get(reverse("metrics")).content.decode().splitlines()
+        self.assertIn(f'backlogged_slow_queries_total{{view="metrics-test",database="default"}} {slow_queries}', lines)
+        circuit = 'backlogged_upstream_circuit_state{service="metrics-test",state="closed"}'
+        if circuits_closed is None:
+            self.assertFalse([line for line in lines if line.startswith(circuit)])
+        else:
+            self.assertIn(f"{circuit} {circuits_closed}", lines)
+
+    def test_scrapes_add_up_every_process(self):
+        first_pid, stop_first = self.start_worker(2)
+        second_pid, stop_second = self.start_worker(3)
+        metrics.SLOW_QUERIES.inc(1, view="metrics-test", database="default")
+        self.assertScraped(6, circuits_closed=2)
+
+        # an exited worker's counters still count, but its gauges don't
+        stop_first()
+        self.assertScraped(6, circuits_closed=1)
+        metrics.archive_process(self.directory, first_pid)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, f"{first_pid}.json")))
+        self.assertScraped(6, circuits_closed=1)
+
+        stop_second()
+        metrics.archive_process(self.directory, second_pid)
+        self.assertEqual(sorted(os.listdir(self.directory)), [metrics.ARCHIVE_FILE])
+        self.assertScraped(6)
+
+        # this process's own metrics are read live, not from its file
+        metrics.SLOW_QUERIES.inc(1, view="metrics-test", database="default")
+        self.assertScraped(7)
+
+    def test_reset(self):
+        # what a preloaded master records before forking, e.g. while warming caches
+        metrics.SLOW_QUERIES.inc(4, view="metrics-test", database="default")
+
+        # as gunicorn's post_fork hook does in each worker
+        pid, stop = self.start_worker(2, reset=True)
+        stop()
+        metrics.archive_process(self.directory, pid)
+        self.assertScraped(6)
+
+    def test_access(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        with override_settings(METRICS_ALLOWED_IPS=["127.0.0.1"]):
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+
+
+class ResilienceTests(SimpleTestCase):
+    """
+    Checks app.resilience's circuit breakers, slow call counting and stale fallbacks, with a clock the tests move.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.Mock(monotonic=lambda: self.now, time=lambda: self.now, sleep=time.sleep)
+        patcher = mock.patch.object(resilience, "time", clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        policy = {"TIMEOUT": [2, 3], "FAILURE_THRESHOLD": 2, "SLOW_CALL_SECONDS": 1, "RESET_SECONDS": 30,
+                  "FRESH_SECONDS": 60, "STALE_SECONDS": 24 * 60 * 60}
+        settings_override = override_settings(UPSTREAM_POLICIES={"test": policy})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(resilience.breakers.pop, "test", None)
+        self.addCleanup(caches[settings.UPSTREAM_CACHE_ALIAS].clear)
+        for result in ("stale", "unavailable"):
+            self.addCleanup(metrics.UPSTREAM_FALLBACKS.values.pop, ("test", result), None)
+
+        self.calls = 0
+
+    def fetch(self, result=None, error: Exception = None, seconds: float = 0):
+        """
+        @return: A function that stands in for a call to the service, counting the calls made.
+        """
+        def fetch(timeout):
+            self.assertEqual(timeout, (2, 3))
+            self.calls += 1
+            self.now += seconds
+            if error:
+                raise error
+            return result
+
+        return fetch
+
+    def get_state(self):
+        metrics.registry.snapshot()
+        return [state for (service, state), value in metrics.UPSTREAM_CIRCUIT_STATE.values.items()
+                if service == "test" and value]
+
+    def test_breaker(self):
+        failing = self.fetch(error=requests.ConnectionError("connection refused"))
+        with self.assertLogs(resilience.logger, "INFO") as logs:
+            for _ in range(2):
+                with self.assertRaises(resilience.UpstreamUnavailable):
+                    resilience.call("test", failing)
+        self.assertEqual(self.get_state(), [resilience.OPEN])
+
+        # while open, the service isn't called at all
+        with self.assertRaisesMessage(resilience.UpstreamUnavailable, "circuit open"):
+            resilience.call("test", failing)
+        self.assertEqual(self.calls, 2)
+
+        # after RESET_SECONDS one trial call goes through, and its failure opens the breaker again
+        self.now += 30
+        breaker = resilience.get_breaker("test")
+        with self.assertLogs(resilience.logger, "INFO") as more_logs:
+            self.assertTrue(breaker.allow())
+            self.assertEqual(self.get_state(), [resilience.HALF_OPEN])
+            self.assertFalse(breaker.allow())
+            breaker.record_failure("ConnectionError")
+        self.assertEqual(self.get_state(), [resilience.OPEN])
+
+        self.now += 29
+        with self.assertRaises(resilience.UpstreamUnavailable):
+            resilience.call("test", failing)
+        self.assertEqual(self.calls, 2)
+
+        # a successful trial call closes it
+        self.now += 1
+        with self.assertLogs(resilience.logger, "INFO") as last_logs:
+            self.assertEqual(resilience.call("test", self.fetch("result")), "result")
+        self.assertEqual(self.get_state(), [resilience.CLOSED])
+        self.assertEqual(breaker.failures, 0)
+
+        records = logs.records + more_logs.records + last_logs.records
+        self.assertEqual([record.message.split(":")[0] for record in records],
+                         ["Circuit breaker for test closed -> open", "Circuit breaker for test open -> half_open",
+                          "Circuit breaker for test half_open -> open", "Circuit breaker for test open -> half_open",
+                          "Circuit breaker for test half_open -> closed"])
+
+    def http_error(self, status: int):
+        response = requests.Response()
+        response.status_code = status
+        return requests.HTTPError(f"{status} error", response=response)
+
+    def test_errors_that_arent_outages(self):
+        breaker = resilience.get_breaker("test")
+        breaker.record_failure("ConnectionError")
+
+        # the service answered, so the caller sees the error and the failures before it stop being consecutive
+        for error in (ValueError("not JSON"), self.http_error(404), self.http_error(429)):
+            with self.assertRaises(type(error)):
+                resilience.call("test", self.fetch(error=error), key="query")
+            self.assertEqual(breaker.failures, 0)
+        self.assertFalse([key for key in metrics.UPSTREAM_FALLBACKS.values if key[0] == "test"])
+
+        with self.assertLogs(resilience.logger, "WARNING"):
+            for _ in range(2):
+                with self.assertRaises(resilience.UpstreamUnavailable):
+                    resilience.call("test", self.fetch(error=self.http_error(503)))
+        self.assertEqual(self.get_state(), [resilience.OPEN])
+
+    def test_interrupted_trial_call(self):
+        breaker = resilience.get_breaker("test")
+        with self.assertLogs(resilience.logger, "INFO") as logs:
+            for _ in range(2):
+                breaker.record_failure("ConnectionError")
+            self.now += 30
+
+            # e.g. a worker timeout during the trial call, which would otherwise leave the breaker half-open for good
+            with self.assertRaises(KeyboardInterrupt):
+                resilience.call("test", self.fetch(error=KeyboardInterrupt()))
+        self.assertEqual(self.get_state(), [resilience.OPEN])
+        self.assertIn("trial call failed (interrupted)", logs.output[-1])
+
+    def test_slow_calls(self):
+        # a slow call still returns its result, but counts towards opening the breaker
+        self.assertEqual(resilience.call("test", self.fetch("slow", seconds=1.5)), "slow")
+        self.assertEqual(resilience.get_breaker("test").failures, 1)
+
+        # only consecutive failures count
+        self.assertEqual(resilience.call("test", self.fetch("fast", seconds=0.5)), "fast")
+        self.assertEqual(resilience.get_breaker("test").failures, 0)
+
+        with self.assertLogs(resilience.logger, "WARNING") as logs:
+            for _ in range(2):
+                resilience.call("test", self.fetch("slow", seconds=1.5))
+        self.assertIn("the last one took 1.5s", logs.output[0])
+        self.assertEqual(self.get_state(), [resilience.OPEN])
+
+    def test_fallback(self):
+        fallbacks = metrics.UPSTREAM_FALLBACKS.values
+        self.assertEqual(resilience.call("test", self.fetch("first"), key="query"), "first")
+        # reused while fresh
+        self.assertEqual(resilience.call("test", self.fetch("second"), key="query"), "first")
+        self.assertEqual(self.calls, 1)
+        self.now += 60
+        self.assertEqual(resilience.call("test", self.fetch("second"), key="query"), "second")
+
+        # once it's no longer fresh, the last good result stands in for a failed call or an open breaker
+        self.now += 60
+        failing = self.fetch(error=requests.Timeout("read timed out"))
+        with self.assertLogs(resilience.logger, "WARNING"):
+            for _ in range(3):
+                self.assertEqual(resilience.call("test", failing, key="query"), "second")
+        self.assertEqual(self.calls, 4)
+        self.assertEqual(fallbacks[("test", "stale")], 3)
+
+        # with nothing cached for the request, there's nothing to fall back on
+        with self.assertRaises(resilience.UpstreamUnavailable):
+            resilience.call("test", failing, key="another query")
+        self.assertEqual(fallbacks[("test", "unavailable")], 1)
+
+
+class CacheWarmingTests(SimpleTestCase):
+    """
+    Checks that cache warming keeps to its rate and gives up on time.
+    """
+
+    def test_time_limit(self):
+        started = []
+        tasks = [(f"task {i}", lambda i=i: started.append(i) or f"warmed {i}") for i in range(8)]
+
+        # started every 0.25s, so the fourth would start after the time limit
+        results = warmup.warm(tasks, workers=2, rate=4, max_seconds=0.6)
+        self.assertEqual(started, [0, 1, 2])
+        self.assertEqual([result.detail for result in results[:3]], ["warmed 0", "warmed 1", "warmed 2"])
+        self.assertEqual({result.error for result in results[3:]}, {"skipped after 0.6s"})
+
+    def test_failures(self):
+        def fail():
+            raise ValueError("not JSON")
+
+        results = warmup.warm([("ok", lambda: "fine"), ("broken", fail)], workers=2, rate=100, max_seconds=10)
+        self.assertEqual([(result.name, result.detail, result.error) for result in results],
+                         [("ok", "fine", None), ("broken", None, "ValueError: not JSON")])
@@ -0,0 +1,170 @@
+"""
+Pluggable HTTP transports for Backlogged's outbound integrations (IGDB, GitHub and ipwhois).
+
+settings.UPSTREAM_TRANSPORT selects the transport:
+    "live" sends requests to the real services.
+    "record" sends requests to the real services and saves each response to settings.UPSTREAM_CASSETTE_DIR.
+    "replay" answers requests from saved responses without touching the network.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import time
+import urllib.parse
+
+import requests
+from django.conf import settings
+
+import app.metrics as metrics
+
+
+class CassetteNotFound(requests.ConnectionError):
+    """
+    Raised by ReplayTransport when no response has been recorded for a request.
+    """
+
+
+class LiveTransport:
+    """
+    Sends requests to the real services.
+    """
+
+    def request(self, method: str, url: str, headers: dict = None, data: str = None, timeout=None):
+        """
+        Sends an HTTP request.
+        @param method: The HTTP method to use.
+        @param url: The URL to send the request to.
+        @param headers: Optional. A dictionary of request headers.
+        @param data: Optional. The body of the request.
+        @param timeout: Optional. Seconds to wait for the connection and for the response, as a number or a (connect,
+        read) pair.
+        @return: A requests.Response object.
+        """
+        return requests.request(method, url, headers=headers, data=data, timeout=timeout)
+
+
+class RecordingTransport(LiveTransport):
+    """
+    Sends requests to the real services and saves each response to disk for ReplayTransport.
+    """
+
+    def __init__(self, cassette_dir: str):
+        self.cassette_dir = cassette_dir
+
+    def request(self, method: str, url: str, headers: dict = None, data: str = None, timeout=None):
+        start = time.perf_counter()
+        response = super().request(method, url, headers=headers, data=data, timeout=timeout)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        os.makedirs(self.cassette_dir, exist_ok=True)
+
+        # request headers are deliberately left out; they carry API credentials
+        cassette = {
+            "request": {"method": method, "url": url, "body": data},
+            "response": {
+                "status_code": response.status_code,
+                "content_type": response.headers.get("Content-Type", ""),
+                "body": base64.b64encode(response.content).decode("ascii"),
+                "elapsed_ms": round(elapsed_ms, 2),
+            },
+        }
+
+        with open(cassette_path(self.cassette_dir, method, url, data), "w") as file:
+            json.dump(cassette, file, indent=2)
+
+        return response
+
+
+class ReplayTransport:
+    """
+    Answers requests from responses saved by RecordingTransport, optionally after a delay.
+    """
+
+    def __init__(self, cassette_dir: str, latency=None):
+        """
+        @param cassette_dir: The directory containing saved responses.
+        @param latency: Optional. Milliseconds to wait before answering each request, or "recorded" to wait as long as
+        the real service took when the response was recorded.
+        """
+        self.cassette_dir = cassette_dir
+        self.latency = latency
+
+    def request(self, method: str, url: str, headers: dict = None, data: str = None, timeout=None):
+        path = cassette_path(self.cassette_dir, method, url, data)
+
+        try:
+            with open(path) as file:
+                recorded = json.load(file)["response"]
+        except FileNotFoundError:
+            raise CassetteNotFound(f"No recorded response for {method} {url} (expected {path}).")
+
+        if self.latency == "recorded":
+            time.sleep(recorded["elapsed_ms"] / 1000)
+        elif self.latency:
+            time.sleep(float(self.latency) / 1000)
+
+        response = requests.Response()
+        response.status_code = recorded["status_code"]
+        response.headers["Content-Type"] = recorded["content_type"]
+        response._content = base64.b64decode(recorded["body"])
+        response.url = url
+        response.encoding = "utf-8"
+
+        return response
+
+
+class MeasuredTransport:
+    """
+    Wraps another transport and records the duration and outcome of every request in app.metrics.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def request(self, method: str, url: str, headers: dict = None, data: str = None, timeout=None):
+        service = urllib.parse.urlsplit(url).hostname or "unknown"
+        outcome = "error"
+        start = time.perf_counter()
+
+        try:
+            response = self.transport.request(method, url, headers=headers, data=data, timeout=timeout)
+            outcome = f"{response.status_code // 100}xx"
+            return response
+        finally:
+            metrics.UPSTREAM_REQUEST_DURATION.observe(time.perf_counter() - start, service=service, outcome=outcome)
+
+
+def cassette_path(cassette_dir: str, method: str, url: str, data: str = None):
+    """
+    Determines where the response to a request is saved. Identical requests always map to the same file.
+    @param cassette_dir: The directory containing saved responses.
+    @param method: The HTTP method of the request.
+    @param url: The URL of the request.
+    @param data: Optional. The body of the request.
+    @return: The path to the file the response is saved in.
+    """
+    digest = hashlib.sha256(f"{method.upper()} {url}\n{data or ''}".encode()).hexdigest()[:16]
+    host = urllib.parse.urlsplit(url).hostname or "unknown"
+
+    return os.path.join(cassette_dir, f"{host}-{digest}.json")
+
+
+def get_transport():
+    """
+    Gets the transport selected by settings.UPSTREAM_TRANSPORT, with its requests measured.
+    @return: A MeasuredTransport wrapping a LiveTransport, RecordingTransport or ReplayTransport object.
+    """
+    mode = settings.UPSTREAM_TRANSPORT
+
+    if mode == "live":
+        transport = LiveTransport()
+    elif mode == "record":
+        transport = RecordingTransport(settings.UPSTREAM_CASSETTE_DIR)
+    elif mode == "replay":
+        transport = ReplayTransport(settings.UPSTREAM_CASSETTE_DIR, latency=settings.UPSTREAM_REPLAY_LATENCY)
+    else:
+        raise ValueError(f'Unknown UPSTREAM_TRANSPORT "{mode}"; expected "live", "record" or "replay".')
+
+    return MeasuredTransport(transport)
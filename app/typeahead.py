@@ -0,0 +1,212 @@
+"""
+Typeahead suggestions for the game search, answered from a local index of game titles instead of IGDB.
+
+The index holds every IGDB title the process has seen: those in users' backlogs (read from each shard, then topped up
+incrementally every settings.TYPEAHEAD_REFRESH_SECONDS) and those in IGDB responses (added as they arrive). Custom games
+are never indexed, since their titles are private to their owners. Backlogs are read in a background thread, started
+when a gunicorn worker starts (see gunicorn.conf.py) and whenever a search finds the index stale, so no search waits on
+the database; until the first read finishes, searches are answered from the titles indexed so far.
+
+Titles are stored as a sorted list of keys, one per word of each normalized title, so that a prefix query is a binary
+search followed by a short scan and both "zel" and "legend of z" find "The Legend of Zelda".
+"""
+
+import bisect
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.db import connections
+
+import app.models as models
+
+logger = logging.getLogger(__name__)
+
+# the most matching keys looked at per query, which bounds the cost of very short prefixes
+MAX_SCAN = 500
+# the most new keys inserted one by one; larger batches are merged into the sorted keys in a single pass
+MAX_INSORT = 64
+
+
+def normalize(text: str):
+    """
+    Folds a title or query into the form used for matching: lowercase ASCII words separated by single spaces.
+    @param text: A game title or search query.
+    @return: A normalized string.
+    """
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+
+class TitleIndex:
+    """
+    A prefix index of game titles. Safe to share between threads.
+    """
+
+    def __init__(self):
+        # (key, word number, title number) tuples in sorted order, where key is a normalized title from one of its
+        # words onwards
+        self.keys = []
+        # [game ID, title] by title number
+        self.titles = []
+        # title number by normalized title, so that each title is only indexed once
+        self.numbers = {}
+        # the highest entry ID read from each shard by refresh()
+        self.last_entry_ids = {}
+        self.refreshed_at = None
+        # whether a background refresh has been started and hasn't finished yet
+        self.refreshing = False
+        self.lock = threading.RLock()
+        # held while reading backlogs, so that searches aren't blocked on the database
+        self.refresh_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.titles)
+
+    def register(self, game_id, title: str):
+        """
+        Records a title that isn't in the index yet. Must be called with the lock held.
+        @param game_id: The IGDB ID of the game.
+        @param title: The game's title.
+        @return: The title's keys, which the caller must insert into self.keys.
+        """
+        normalized = normalize(title)
+        if not normalized or normalized in self.numbers:
+            return []
+
+        number = len(self.titles)
+        self.titles.append([game_id, title])
+        self.numbers[normalized] = number
+
+        keys = []
+        start = 0
+        for word_number, word in enumerate(normalized.split(" ")):
+            keys.append((normalized[start:], word_number, number))
+            start += len(word) + 1
+
+        return keys
+
+    def add(self, game_id, title: str):
+        """
+        Adds a title to the index. Titles already in it are ignored.
+        @param game_id: The IGDB ID of the game.
+        @param title: The game's title.
+        """
+        with self.lock:
+            for key in self.register(game_id, title):
+                bisect.insort(self.keys, key)
+
+    def add_many(self, games):
+        """
+        Adds titles to the index in one go, which is much faster than adding them one at a time.
+        @param games: An iterable of (game ID, title) pairs.
+        """
+        with self.lock:
+            keys = sorted(key for game_id, title in games for key in self.register(game_id, title))
+            if len(keys) <= MAX_INSORT:
+                for key in keys:
+                    bisect.insort(self.keys, key)
+            else:
+                self.keys = list(heapq.merge(self.keys, keys))
+
+    def search(self, query: str, limit: int = 10):
+        """
+        Finds the titles with a word starting with the query. Titles that start with the query come first, then
+        shorter titles.
+        @param query: What the user has typed so far.
+        @param limit: The most suggestions to return.
+        @return: A list of (game ID, title) pairs.
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+
+        with self.lock:
+            matches = {}
+            position = bisect.bisect_left(self.keys, (prefix,))
+            for key, word_number, number in self.keys[position:position + MAX_SCAN]:
+                if not key.startswith(prefix):
+                    break
+                matches[number] = matches.get(number, False) or word_number == 0
+
+            ranked = sorted(matches, key=lambda number: (not matches[number], len(self.titles[number][1]),
+                                                         self.titles[number][1]))
+            return [tuple(self.titles[number]) for number in ranked[:limit]]
+
+    def refresh(self):
+        """
+        Adds the IGDB games added to any backlog since the last refresh. The first refresh reads every backlog.
+        @return: The number of backlog entries read.
+        """
+        read = 0
+
+        with self.refresh_lock:
+            for shard in settings.BACKLOG_SHARDS:
+                last_entry_id = self.last_entry_ids.get(shard, 0)
+                rows = (models.BackloggedGame.objects.using(shard)
+                        .filter(entry_id__gt=last_entry_id, is_custom=False)
+                        .order_by("entry_id").values_list("entry_id", "igdb_id", "game_name"))
+
+                games = []
+                for entry_id, igdb_id, game_name in rows.iterator():
+                    games.append((igdb_id, game_name))
+                    last_entry_id = entry_id
+
+                self.add_many(games)
+                self.last_entry_ids[shard] = last_entry_id
+                read += len(games)
+
+            self.refreshed_at = time.monotonic()
+
+        return read
+
+    def is_stale(self):
+        """
+        @return: Whether the index has never been refreshed, or not within settings.TYPEAHEAD_REFRESH_SECONDS.
+        """
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at >= settings.TYPEAHEAD_REFRESH_SECONDS
+
+    def refresh_in_background(self):
+        """
+        Starts refreshing the index in a background thread if it's stale and no refresh is running already.
+        @return: The thread, or None if no refresh was started.
+        """
+        with self.lock:
+            if self.refreshing or not self.is_stale():
+                return None
+            self.refreshing = True
+
+        thread = threading.Thread(target=self.run_refresh, name="typeahead-refresh", daemon=True)
+        thread.start()
+        return thread
+
+    def run_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            # tried again by the next search
+            logger.exception("Couldn't refresh the typeahead index")
+        finally:
+            # the thread's own connections, which would otherwise stay open until the process exits
+            connections.close_all()
+            with self.lock:
+                self.refreshing = False
+
+
+# the process-wide index
+index = TitleIndex()
+
+
+def suggest(query: str, limit: int = 10):
+    """
+    Gets typeahead suggestions for a game search.
+    @param query: What the user has typed so far.
+    @param limit: The most suggestions to return.
+    @return: A list of (game ID, title) pairs.
+    """
+    index.refresh_in_background()
+    return index.search(query, limit)
@@ -2,27 +2,55 @@
 Views.
 """
 
+import contextlib
+import itertools
 import json
 import os
 import uuid
 
-import arrow
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import logout
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.auth.views import LoginView, PasswordChangeView
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import redirect, render
+from django.template.loader import get_template, render_to_string
+from django.utils.safestring import mark_safe
+from django.views import View
 from django.views.generic import CreateView, UpdateView, FormView, TemplateView, ListView
 
+import app.deletion as deletion
 import app.helpers as helpers
+import app.memory as memory
+import app.metrics as metrics
 import app.models as models
-from app.forms import *
+import app.querylog as querylog
+import app.stats as stats
+from app.forms import BacklogBulkActionForm, BacklogFilterForm, BacklogSearchForm, CustomGameForm, CustomGameSubmit, \
+    GameSearchForm, GameUpdateForm, PasswordCheckForm, TimezoneUpdateForm
+from app.lazy import lazy_import
+
+arrow = lazy_import("arrow")
 
 backlog = models.BackloggedGame.objects
 custom = models.CustomGame.objects
 timezones = models.UserTimezone.objects
 
 
+def now_playing_room(user_id: int, needed: bool):
+    """
+    Holds a place in the user's Now Playing for a game a form moves there, while it's saved in a with block (see
+    helpers.now_playing_room()). The form's own check can pass for two requests at once; this can't.
+    @param user_id: The ID of a user.
+    @param needed: False if the block doesn't move a game into Now Playing, so there's nothing to hold.
+    @return: A context manager that raises helpers.NowPlayingLimitError if there's no room.
+    """
+    return helpers.now_playing_room(user_id) if needed else contextlib.nullcontext()
+
+
 class HomePageView(TemplateView):
     """
     The home page.
@@ -58,7 +86,12 @@ class BacklogView(LoginRequiredMixin, ListView):
     """
     login_url = "/login"
     template_name = "games/view-edit/backlog.html"
+    cards_template_name = "games/view-edit/backlog-cards.html"
     paginate_by = 30
+    # with ?view=all, the games rendered and sent at a time
+    stream_chunk_size = 200
+    # where the streamed games go in the rendered page
+    stream_marker = "<!--backlog games-->"
 
     def __init__(self):
         super().__init__()
@@ -66,6 +99,56 @@ class BacklogView(LoginRequiredMixin, ListView):
         self.is_filtering = False
         self.search_query = None
         self.filter_mode = None
+        self.view_all = False
+
+    def get(self, request, *args, **kwargs):
+        self.view_all = request.GET.get("view") == "all"
+        if not self.view_all:
+            return super().get(request, *args, **kwargs)
+
+        self.object_list = self.get_queryset()
+        context = self.get_context_data()
+        page = render_to_string(self.template_name, context, request)
+        # routed now, since the request's routing state (see app.sharding) is gone by the time the games are read
+        games = self.object_list.using(self.object_list.db)
+
+        response = StreamingHttpResponse(self.stream(page, context, games), content_type="text/html; charset=utf-8")
+        # so that proxies pass each chunk on as it comes instead of waiting for the whole page
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def stream(self, page: str, context: dict, games):
+        """
+        Sends the page around the games first, then the games a chunk at a time as they're read from the database, so
+        that the first ones reach the browser while the rest are still being fetched. The games are read with
+        QuerySet.iterator() (a server-side cursor where the database supports it), so a large backlog never sits in
+        memory whole.
+        @param page: The rendered page, with stream_marker where the games go.
+        @param context: The page's context.
+        @param games: A QuerySet of the games to show, bound to a database.
+        @return: A generator of HTML strings.
+        """
+        head, marker, tail = page.partition(self.stream_marker)
+        yield head
+        if not marker:
+            return
+
+        cards = get_template(self.cards_template_name)
+        games = games.iterator(chunk_size=self.stream_chunk_size)
+        now_playing = None
+
+        for chunk in iter(lambda: list(itertools.islice(games, self.stream_chunk_size)), []):
+            # Now Playing games come first, in a row of their own, unless the backlog is searched or sorted
+            for is_now_playing, group in itertools.groupby(chunk, key=lambda game: game.status_id == 2):
+                group = list(group)
+                new_row = now_playing is True and not is_now_playing and context["now_playing_row"]
+                now_playing = is_now_playing
+                yield cards.render({**context, "games": group, "new_row": new_row}, self.request)
+
+        yield tail
+
+    def get_paginate_by(self, queryset):
+        return None if self.view_all else self.paginate_by
 
     def get_queryset(self):
         user_id = self.request.user.id
@@ -93,8 +176,7 @@ class BacklogView(LoginRequiredMixin, ListView):
                     queryset = queryset.order_by("-date_added")
             else:
                 filter_platform_id = int(filter_data["sort_option"])
-                filter_platform_name = \
-                    backlog.filter(platform_id=filter_platform_id).values_list("platform_name", flat=True).distinct()[0]
+                filter_platform_name = models.Platform.objects.get_name(filter_platform_id)
                 self.filter_mode = filter_platform_name if len(filter_platform_name) <= 26 \
                     else filter_platform_name[:23] + "..."
                 queryset = queryset.filter(platform_id=filter_platform_id).order_by("game_name")
@@ -103,7 +185,7 @@ class BacklogView(LoginRequiredMixin, ListView):
             self.search_query = self.request.GET
             self.is_searching = True
             search_data = search_form.cleaned_data
-            search_query = "\W*".join(search_data["query"])
+            search_query = helpers.backlog_search_regex(search_data["query"])
             queryset = backlog.filter(user_id=user_id, game_name__iregex=search_query).order_by("game_name")
 
         return queryset
@@ -139,6 +221,24 @@ class BacklogView(LoginRequiredMixin, ListView):
                 "filter_mode": self.filter_mode,
             })
 
+        user_platforms = self.get_user_platforms()
+        context.update({
+            "user_platforms": user_platforms,
+            "bulk_form": BacklogBulkActionForm(user_platforms=user_platforms),
+        })
+
+        if self.view_all:
+            # the games themselves are streamed in by stream()
+            context.update({
+                "view_all": True,
+                "object_list": None,
+                "has_games": self.object_list.exists(),
+                "now_playing_row": not (self.is_searching or self.is_filtering),
+                "stream_marker": mark_safe(self.stream_marker),
+                "url_parameters": helpers.request_constructor(self.request.GET, excluded=["page", "view"]),
+            })
+            return context
+
         page_obj = context["page_obj"]
         last_page = page_obj.paginator.num_pages
         page_range = helpers.pagination_helper(page_obj.number, last_page)
@@ -148,7 +248,7 @@ class BacklogView(LoginRequiredMixin, ListView):
             "last_page": last_page
         })
 
-        num_now_playing = backlog.filter(user_id=user_id, status_id=2).count()
+        num_now_playing = helpers.get_num_now_playing(user_id)
 
         if page_obj.number == 1 and not (self.is_searching or self.is_filtering):
             game_slice = f"0:{num_now_playing}"
@@ -157,19 +257,61 @@ class BacklogView(LoginRequiredMixin, ListView):
         else:
             game_slice = ":"
 
-        user_platforms = backlog.filter(user_id=user_id).values(
-            "platform_id", "platform_name").distinct().order_by("platform_name")
-
         url_parameters = helpers.request_constructor(self.request.GET, excluded=["page"])
+        view_all_parameters = helpers.request_constructor({**self.request.GET.dict(), "view": "all"},
+                                                          excluded=["page"])
 
         context.update({
             "game_slice": game_slice,
-            "user_platforms": user_platforms,
-            "url_parameters": url_parameters
+            "url_parameters": url_parameters,
+            "view_all_parameters": view_all_parameters,
         })
 
         return context
 
+    def get_user_platforms(self):
+        return sorted(
+            ({"platform_id": platform_id, "platform_name": models.Platform.objects.get_name(platform_id)}
+             for platform_id in backlog.filter(user_id=self.request.user.id)
+             .values_list("platform_id", flat=True).distinct()),
+            key=lambda platform: platform["platform_name"]
+        )
+
+    def post(self, request, *args, **kwargs):
+        bulk_form = BacklogBulkActionForm(request.POST, user_platforms=self.get_user_platforms())
+
+        if bulk_form.is_valid():
+            bulk_data = bulk_form.cleaned_data
+            try:
+                num_changed = helpers.bulk_update_backlog(request.user.id, bulk_data["entry_ids"],
+                                                          bulk_data["action"], bulk_data["platform"])
+            except helpers.NowPlayingLimitError as error:
+                messages.error(request, str(error))
+            else:
+                verb = "Removed" if bulk_data["action"] == "remove" else "Updated"
+                messages.success(request, f"{verb} {num_changed} game{'' if num_changed == 1 else 's'}.")
+        else:
+            for errors in bulk_form.errors.values():
+                messages.error(request, errors[0])
+
+        # back to the same page, search and sort
+        return redirect(request.get_full_path())
+
+
+class BacklogStatsView(LoginRequiredMixin, TemplateView):
+    """
+    Shows statistics about the user's backlog: counts by status and platform, games added per month, and how many are
+    custom games. Read from the user's aggregates in app.stats, so the page costs the same however large their backlog
+    is.
+    """
+    template_name = "games/view-edit/stats.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["stats"] = stats.get_user_stats(self.request.user.id)
+        context["months_max"] = max((num_entries for _, num_entries in context["stats"]["months"]), default=0)
+        return context
+
 
 class AddGameView(LoginRequiredMixin, FormView):
     """
@@ -198,7 +340,7 @@ class AddGameSearchView(LoginRequiredMixin, TemplateView):
         user_id = self.request.user.id
 
         if search_form.is_valid():
-            self.request.session["request_data"] = self.request.GET
+            self.request.session["request_data"] = {"query": search_form.cleaned_data["query"]}
         else:
             search_form = GameSearchForm(self.request.session["request_data"])
             if search_form.is_valid():
@@ -236,13 +378,14 @@ class AddCustomGameView(LoginRequiredMixin, FormView):
 
     def get_form_kwargs(self):
         form_kwargs = super().get_form_kwargs()
-        form_kwargs["num_now_playing"] = backlog.filter(user_id=self.request.user.id, status_id=2).count()
+        self.num_now_playing = helpers.get_num_now_playing(self.request.user.id)
+        form_kwargs["num_now_playing"] = self.num_now_playing
 
         return form_kwargs
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["num_now_playing"] = backlog.filter(user_id=self.request.user.id, status_id=2).count()
+        context["num_now_playing"] = self.num_now_playing
         context["now_playing_message"] = "You can only have up to 10 games in your Now Playing at a time. " \
                                          "Remove some games from your Now Playing before adding this one."
 
@@ -271,27 +414,36 @@ class CustomGamePreviewView(LoginRequiredMixin, FormView):
 
     def form_valid(self, form):
         user = self.request.user
-        game_dict = self.request.session.pop("custom_game")
-        game_dict["game_id"] = f"custom-{uuid.uuid4()}"
-        cover_img = helpers.create_custom_cover_file(game_dict["cover_img"],
-                                                     f"{user.username}-{user.id}-{game_dict['game_id']}")
-
-        backlogged = backlog.create(user_id=user.id,
-                                    game_id=game_dict["game_id"], game_name=game_dict["name"],
-                                    platform_id=game_dict["recorded_platform_id"],
-                                    platform_name=game_dict["recorded_platform_name"],
-                                    status_id=game_dict["status_id"], status_name=game_dict["status_name"],
-                                    cover_url=cover_img,
-                                    date_added=arrow.now().date(),
-                                    is_custom=True)
-
-        custom.create(user_id=user.id,
-                      backlogged=backlogged,
-                      cover_img=cover_img,
-                      involved_companies=game_dict["involved_companies"],
-                      summary=game_dict["full_summary"])
-
-        backlogged.cover_url = backlogged.custom_data.cover_img.url
+        game_dict = self.request.session["custom_game"]
+        custom_id = uuid.uuid4()
+
+        try:
+            # the place in Now Playing is held from before the cover is stored, so that a game that can't be added
+            # doesn't leave one behind
+            with now_playing_room(user.id, needed=game_dict["status_id"] == models.BacklogStatus.NOW_PLAYING):
+                cover_img = helpers.create_custom_cover_file(game_dict["cover_img"],
+                                                             f"{user.username}-{user.id}-custom-{custom_id}")
+
+                backlogged = backlog.create(user_id=user.id,
+                                            custom_id=custom_id, game_name=game_dict["name"],
+                                            platform_id=models.Platform.objects.register(
+                                                game_dict["recorded_platform_id"], game_dict["recorded_platform_name"]),
+                                            status_id=game_dict["status_id"],
+                                            custom_cover_url=cover_img,
+                                            date_added=arrow.now().date(),
+                                            is_custom=True)
+
+                custom.create(user_id=user.id,
+                              backlogged=backlogged,
+                              cover_img=cover_img,
+                              involved_companies=game_dict["involved_companies"],
+                              summary=game_dict["full_summary"])
+        except helpers.NowPlayingLimitError as error:
+            form.add_error(None, str(error))
+            return self.form_invalid(form)
+
+        del self.request.session["custom_game"]
+        backlogged.custom_cover_url = backlogged.custom_data.cover_img.url
         backlogged.save()
 
         return redirect("backlog")
@@ -307,7 +459,7 @@ class EditCustomGameView(LoginRequiredMixin, FormView):
     def get_initial(self):
         initial = super().get_initial()
         game_id = self.kwargs.get("game_id")
-        backlogged = backlog.get(game_id=game_id)
+        backlogged = helpers.get_entry_cache(self.request).get(game_id)
         initial.update({
             "game_name": backlogged.game_name,
             "involved_companies": backlogged.custom_data.involved_companies,
@@ -320,7 +472,7 @@ class EditCustomGameView(LoginRequiredMixin, FormView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         game_id = self.kwargs.get("game_id")
-        context["game"] = backlog.get(game_id=game_id)
+        context["game"] = helpers.get_entry_cache(self.request).get(game_id)
 
         return context
 
@@ -329,11 +481,11 @@ class EditCustomGameView(LoginRequiredMixin, FormView):
 
         game_id = self.kwargs.get("game_id")
 
-        backlogged = backlog.get(game_id=game_id)
-        custom_game = custom.get(backlogged__game_id=game_id)
+        backlogged = helpers.get_entry_cache(self.request).get(game_id)
+        custom_game = backlogged.custom_data
 
         backlogged.game_name = form_data["game_name"]
-        backlogged.platform_id, backlogged.platform_name = form_data["platform"].split(sep=",")
+        backlogged.platform_id = models.Platform.objects.register(*form_data["platform"].split(sep=","))
 
         custom_game.involved_companies, custom_game.summary = form_data["involved_companies"], form_data["summary"]
 
@@ -344,7 +496,7 @@ class EditCustomGameView(LoginRequiredMixin, FormView):
             custom_game.cover_img = cover_img
             custom_game.save()
 
-            backlogged.cover_url = backlogged.custom_data.cover_img.url
+            backlogged.custom_cover_url = backlogged.custom_data.cover_img.url
 
         backlogged.save()
         custom_game.save()
@@ -371,11 +523,14 @@ class GameInfoView(LoginRequiredMixin, FormView):
         else:
             mode = "igdb"
 
-        self.kwargs["game_dict"] = helpers.get_game_info_dict(game_id, mode=mode, user_id=user_id)
+        self.entries = helpers.get_entry_cache(self.request)
+        self.num_now_playing = helpers.get_num_now_playing(user_id)
+        self.kwargs["game_dict"] = helpers.get_game_info_dict(game_id, mode=mode, user_id=user_id,
+                                                              entries=self.entries)
 
         form_kwargs.update({
             "game_dict": self.kwargs.get("game_dict"),
-            "num_now_playing": backlog.filter(status_name="Now Playing", user_id=user_id).count()
+            "num_now_playing": self.num_now_playing
         })
 
         return form_kwargs
@@ -386,16 +541,13 @@ class GameInfoView(LoginRequiredMixin, FormView):
 
         context.update({
             "game": game_dict,
-            "num_now_playing": backlog.filter(status_name="Now Playing", user_id=self.request.user.id).count(),
+            "num_now_playing": self.num_now_playing,
             "now_playing_message": "You can only have up to 10 games in your Now Playing at a time. "
                                    "Remove some games from your Now Playing before adding this one."
         })
 
-        try:
-            backlogged = backlog.get(game_id=game_dict["id"], user_id=self.request.user.id)
-        except models.BackloggedGame.DoesNotExist:
-            pass
-        else:
+        backlogged = self.entries.get(game_dict["id"])
+        if backlogged:
             recorded_status, recorded_platform_name = backlogged.status_name, backlogged.platform_name
 
             context.update({
@@ -415,7 +567,7 @@ class GameInfoView(LoginRequiredMixin, FormView):
         form_data = form.cleaned_data
         user_id = self.request.user.id
         game_dict = self.kwargs.get("game_dict")
-        game_id, game_name, cover_url = game_dict["id"], game_dict["name"], game_dict["cover_url"]
+        game_id, game_name, cover_image_id = game_dict["id"], game_dict["name"], game_dict["cover_image_id"]
 
         update_mode = form_data["update_mode"]
 
@@ -423,32 +575,42 @@ class GameInfoView(LoginRequiredMixin, FormView):
             return redirect('game-info', game_id=game_id)
 
         if update_mode == "add":
-            status_name = "Now Playing" if form_data["now_playing"] else "backlog"
-            status_id = 2 if status_name == "Now Playing" else 1
-            platform_id, platform_name = form_data["platform"].split(sep=",")
-
-            backlog.create(user_id=user_id,
-                           game_id=game_id, game_name=game_name,
-                           cover_url=cover_url,
-                           platform_id=platform_id, platform_name=platform_name,
-                           status_name=status_name, status_id=status_id,
-                           date_added=arrow.now().date())
+            status_id = models.BacklogStatus.NOW_PLAYING if form_data["now_playing"] else models.BacklogStatus.BACKLOG
+            platform_id = models.Platform.objects.register(*form_data["platform"].split(sep=","))
+
+            try:
+                with now_playing_room(user_id, needed=form_data["now_playing"]):
+                    backlog.create(user_id=user_id,
+                                   igdb_id=game_id, game_name=game_name,
+                                   cover_image_id=cover_image_id,
+                                   platform_id=platform_id, status_id=status_id,
+                                   date_added=arrow.now().date())
+            except helpers.NowPlayingLimitError as error:
+                form.add_error(None, str(error))
+                return self.form_invalid(form)
         else:
-            backlogged = backlog.get(game_id=game_id, user_id=user_id)
+            backlogged = self.entries.get(game_id)
 
             if update_mode == "move":
-                new_status_name = "Now Playing" if backlogged.status_name == "backlog" else "backlog"
-                new_status_id = 2 if new_status_name == "Now Playing" else 1
-                backlogged.status_name, backlogged.status_id = new_status_name, new_status_id
-                backlogged.save()
+                if backlogged.status_id == models.BacklogStatus.BACKLOG:
+                    backlogged.status_id = models.BacklogStatus.NOW_PLAYING
+                else:
+                    backlogged.status_id = models.BacklogStatus.BACKLOG
+
+                try:
+                    with now_playing_room(user_id, needed=backlogged.status_id == models.BacklogStatus.NOW_PLAYING):
+                        backlogged.save()
+                except helpers.NowPlayingLimitError as error:
+                    backlogged.status_id = models.BacklogStatus.BACKLOG
+                    form.add_error(None, str(error))
+                    return self.form_invalid(form)
 
             elif update_mode == "change_platform":
                 self.request.session["changing_platform"] = True
                 return redirect("game-info", game_id=game_id)
 
             elif update_mode == "platform_update":
-                new_platform_id, new_platform_name = form_data["platform"].split(sep=",")
-                backlogged.platform_id, backlogged.platform_name = new_platform_id, new_platform_name
+                backlogged.platform_id = models.Platform.objects.register(*form_data["platform"].split(sep=","))
                 backlogged.save()
 
             elif update_mode == "edit_custom":
@@ -525,7 +687,10 @@ class DeleteAccountView(LoginRequiredMixin, FormView):
         return form_kwargs
 
     def form_valid(self, form):
-        self.request.user.delete()
+        # the account is deactivated now and deleted in the background (see app.deletion), since deleting a large
+        # backlog and its cover files can take longer than a request may
+        deletion.request_deletion(self.request.user)
+        logout(self.request)
 
         return redirect("home")
 
@@ -542,6 +707,99 @@ class AdminRedirectView(LoginRequiredMixin, TemplateView):
             return render(request, template_name="meta/adminredirect.html")
 
 
+class MetricsView(View):
+    """
+    Exports the metrics of every worker process in the Prometheus text format, to staff users and to scrapers
+    connecting from settings.METRICS_ALLOWED_IPS.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not (request.user.is_staff or request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS):
+            return HttpResponseForbidden()
+
+        snapshot = metrics.merge(metrics.read_snapshots())
+        return HttpResponse(metrics.exposition(snapshot), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class MemoryProfileView(View):
+    """
+    Lets staff look into the memory use of the worker process serving them while settings.MEMORY_PROFILING is on:
+    heap snapshots grouped by module, how they changed between snapshots, and the peak memory of sampled requests.
+    """
+    template_name = "meta/memory.html"
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        snapshots = {snapshot.label: snapshot for snapshot in memory.get_snapshots()}
+        labels = list(snapshots)
+
+        # by default, the latest snapshot compared with the one before it
+        snapshot = snapshots.get(request.GET.get("snapshot")) or (snapshots[labels[-1]] if labels else None)
+        baseline = snapshots.get(request.GET.get("baseline"))
+        if "baseline" not in request.GET and len(labels) > 1 and snapshot.label != labels[0]:
+            baseline = snapshots[labels[labels.index(snapshot.label) - 1]]
+
+        context = {
+            **memory.get_status(),
+            "enabled": settings.MEMORY_PROFILING,
+            "pid": os.getpid(),
+            "snapshots": list(snapshots.values()),
+            "snapshot": snapshot,
+            "baseline": baseline,
+            "groups": memory.report(snapshot, baseline) if snapshot else [],
+            "peaks": memory.get_peaks(),
+        }
+
+        return render(request, self.template_name, context)
+
+    def post(self, request, *args, **kwargs):
+        if request.POST.get("action") == "clear":
+            memory.clear()
+        elif memory.is_tracing():
+            memory.take_snapshot(request.POST.get("label", "").strip()[:50] or None)
+
+        return redirect("memory-profile")
+
+
+class SlowQueryLogView(View):
+    """
+    Lets staff look through the slow queries recorded by the worker process serving them (see app.querylog).
+    """
+    template_name = "meta/queries.html"
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        records = querylog.get_records()
+        view = request.GET.get("view")
+        if view:
+            records = [record for record in records if record["view"] == view]
+
+        context = {
+            "enabled": settings.SLOW_QUERY_LOG,
+            "pid": os.getpid(),
+            "threshold_ms": settings.SLOW_QUERY_THRESHOLD_MS,
+            "records": records,
+            "view": view,
+        }
+
+        return render(request, self.template_name, context)
+
+    def post(self, request, *args, **kwargs):
+        querylog.clear()
+
+        return redirect("slow-query-log")
+
+
 class AboutView(TemplateView):
     """
     Displays information about Backlogged.
@@ -0,0 +1,163 @@
+"""
+Cache warming, so that the first users after a deploy don't wait on cold upstream requests.
+
+warm_caches() fills the upstream response cache (see app.resilience) with what most pages need: the platform list behind
+CustomGameForm, the latest GitHub release shown in every page's footer, and the IGDB data for the games and searches
+that are popular in recent backlog activity. It's run by the warm_caches management command (e.g. as a release step,
+into a shared cache), or once by gunicorn's master process before it forks workers (see gunicorn.conf.py). Either way
+it's done once per deploy rather than once per worker, which would multiply the requests made to IGDB, and it gives up
+on whatever it hasn't started within settings.WARM_CACHES_MAX_SECONDS.
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import functools
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+
+import app.helpers as helpers
+import app.models as models
+import app.typeahead as typeahead
+from app.templatetags import custom_tags
+
+# the result of warming one cache entry
+Result = collections.namedtuple("Result", ["name", "seconds", "detail", "error"])
+
+
+def get_popular_games(limit: int, days: int):
+    """
+    Finds the IGDB games added to or moved around in the most backlogs recently.
+    @param limit: The most games to return.
+    @param days: How many days of backlog activity to look at.
+    @return: A list of (game ID, title) pairs, most popular first.
+    """
+    since = timezone.now() - datetime.timedelta(days=days)
+    counts = collections.Counter()
+    names = {}
+
+    for shard in settings.BACKLOG_SHARDS:
+        rows = (models.BackloggedGame.objects.using(shard)
+                .filter(is_custom=False, updated_at__gte=since)
+                .values("igdb_id").annotate(num_entries=Count("entry_id"), name=Max("game_name"))
+                .order_by("-num_entries")[:limit])
+
+        for row in rows:
+            counts[row["igdb_id"]] += row["num_entries"]
+            names[row["igdb_id"]] = row["name"]
+
+    return [(game_id, names[game_id]) for game_id, _ in counts.most_common(limit)]
+
+
+def get_popular_searches(games, limit: int):
+    """
+    Lists the searches to warm: settings.WARM_CACHES_SEARCHES, then the normalized titles of popular games, which is
+    what most people searching for them type.
+    @param games: A list of (game ID, title) pairs, most popular first.
+    @param limit: The most searches to return.
+    @return: A list of search queries.
+    """
+    searches = list(settings.WARM_CACHES_SEARCHES)
+    for _, title in games:
+        search = typeahead.normalize(title)
+        if search and search not in searches:
+            searches.append(search)
+
+    return searches[:limit]
+
+
+def get_tasks(game_ids, searches):
+    """
+    Lists the cache entries to warm.
+    @param game_ids: The IGDB IDs of the games to warm game pages for.
+    @param searches: The searches to warm the first two pages of results for, as AddGameSearchView requests them.
+    @return: A list of (name, function) pairs. Each function fetches one cache entry and returns a short description
+    of it.
+    """
+    def warm_platforms():
+        return f"{len(helpers.platform_getter())} platforms"
+
+    def warm_release():
+        return custom_tags.get_latest_github_release("tag") or "no release (or GitHub unavailable)"
+
+    def warm_game(game_id):
+        games = helpers.igdb_request(helpers.get_game_info_query(game_id)).games
+        typeahead.index.add_many((game.id, game.name) for game in games)
+        return games[0].name if games else "not found"
+
+    def warm_search(search, offset):
+        games = helpers.igdb_request(helpers.get_search_query(search, offset)).games
+        typeahead.index.add_many((game.id, game.name) for game in games)
+        return f"{len(games)} results"
+
+    tasks = [("platforms", warm_platforms), ("github release", warm_release)]
+    tasks.extend((f"game {game_id}", functools.partial(warm_game, game_id)) for game_id in game_ids)
+    tasks.extend((f'search "{search}" offset {offset}', functools.partial(warm_search, search, offset))
+                 for search in searches for offset in (0, 50))
+
+    return tasks
+
+
+def warm(tasks, workers: int, rate: float, max_seconds: float):
+    """
+    Runs warming tasks in parallel. A failed task is reported rather than raised.
+    @param tasks: A list of (name, function) pairs, from get_tasks().
+    @param workers: The most tasks to run at once.
+    @param rate: The most tasks to start per second, which keeps warming within IGDB's rate limit.
+    @param max_seconds: How long to keep starting tasks for. Tasks that would start later are skipped and reported as
+    failed; those already running finish within their upstream timeouts.
+    @return: A list of Result objects, in the order of tasks.
+    """
+    lock = threading.Lock()
+    next_start = time.monotonic()
+    deadline = next_start + max_seconds
+
+    def run(name, function):
+        nonlocal next_start
+
+        with lock:
+            delay = next_start - time.monotonic()
+            if time.monotonic() + max(delay, 0) >= deadline:
+                return Result(name, 0, None, f"skipped after {max_seconds:g}s")
+            next_start = max(next_start, time.monotonic()) + 1 / rate
+        if delay > 0:
+            time.sleep(delay)
+
+        start = time.perf_counter()
+        try:
+            detail, error = function(), None
+        except Exception as exception:
+            detail, error = None, f"{type(exception).__name__}: {exception}"
+
+        return Result(name, time.perf_counter() - start, detail, error)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda task: run(*task), tasks))
+
+
+def warm_caches(num_games: int = None, num_searches: int = None, days: int = None, workers: int = None,
+                rate: float = None, max_seconds: float = None):
+    """
+    Warms the caches with the popular games and searches from recent backlog activity. Arguments default to the
+    WARM_CACHES_* settings.
+    @param num_games: Optional. How many popular games to warm.
+    @param num_searches: Optional. How many searches to warm.
+    @param days: Optional. How many days of backlog activity to look at.
+    @param workers: Optional. The most requests to make at once.
+    @param rate: Optional. The most requests to start per second.
+    @param max_seconds: Optional. How long to keep starting requests for.
+    @return: A list of Result objects.
+    """
+    num_games = settings.WARM_CACHES_GAMES if num_games is None else num_games
+    num_searches = settings.WARM_CACHES_NUM_SEARCHES if num_searches is None else num_searches
+    days = settings.WARM_CACHES_DAYS if days is None else days
+
+    games = get_popular_games(max(num_games, num_searches), days)
+    tasks = get_tasks([game_id for game_id, _ in games[:num_games]], get_popular_searches(games, num_searches))
+
+    return warm(tasks, workers or settings.WARM_CACHES_WORKERS, rate or settings.WARM_CACHES_RATE,
+                settings.WARM_CACHES_MAX_SECONDS if max_seconds is None else max_seconds)
@@ -40,21 +40,27 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'cloudinary_storage',
     'cloudinary',
-    'app',
+    'app.apps.AppConfig',
     'app.templatetags',
     'crispy_forms',
 ]
 
 MIDDLEWARE = [
+    'app.middleware.MetricsMiddleware',
+    'app.middleware.MemoryProfilingMiddleware',
+    'app.middleware.SlowQueryLogMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'app.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'app.middleware.ShardRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'app.middleware.HerokuRedirectMiddleware',
+    'app.middleware.UpstreamUnavailableMiddleware',
 ]
 
 ROOT_URLCONF = 'backlogger.urls'
@@ -81,7 +87,46 @@ WSGI_APPLICATION = 'backlogger.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {"default": dj_database_url.config(conn_max_age=600, ssl_require=True)}
+# DATABASE_POOL=off falls back to one persistent connection per worker
+DATABASE_POOL = os.getenv("DATABASE_POOL", "on") == "on"
+POOLED_ENGINES = {
+    'django.db.backends.postgresql': 'app.db.backends.postgresql',
+    'django.db.backends.postgresql_psycopg2': 'app.db.backends.postgresql',
+    'django.db.backends.sqlite3': 'app.db.backends.sqlite3',
+}
+
+DATABASES = {"default": dj_database_url.config(conn_max_age=0 if DATABASE_POOL else 600, ssl_require=True)}
+
+# comma-separated URLs of read replicas of the default database; see app.routers
+REPLICA_DATABASES = []
+for i, replica_url in enumerate(filter(None, os.getenv("REPLICA_DATABASE_URLS", "").split(","))):
+    REPLICA_DATABASES.append(f"replica_{i + 1}")
+    DATABASES[REPLICA_DATABASES[-1]] = {
+        **dj_database_url.parse(replica_url.strip(), conn_max_age=0 if DATABASE_POOL else 600, ssl_require=True),
+        "TEST": {"MIRROR": "default"},
+    }
+
+# comma-separated URLs of additional databases to spread users' backlogs across; see app.sharding
+BACKLOG_SHARDS = ["default"]
+for i, shard_url in enumerate(filter(None, os.getenv("SHARD_DATABASE_URLS", "").split(","))):
+    BACKLOG_SHARDS.append(f"shard_{i + 1}")
+    DATABASES[BACKLOG_SHARDS[-1]] = dj_database_url.parse(shard_url.strip(), conn_max_age=0 if DATABASE_POOL else 600,
+                                                          ssl_require=True)
+
+DATABASE_ROUTERS = ['app.routers.ShardRouter', 'app.routers.ReplicaRouter']
+# seconds that a browser's reads stay on the primary after it writes
+REPLICA_PIN_SECONDS = int(os.getenv("REPLICA_PIN_SECONDS", 10))
+
+for database in DATABASES.values():
+    if DATABASE_POOL and database.get("ENGINE") in POOLED_ENGINES:
+        database["ENGINE"] = POOLED_ENGINES[database["ENGINE"]]
+        # see app.db.pool for what each option does
+        database["POOL"] = {
+            "MAX_SIZE": int(os.getenv("DATABASE_POOL_MAX_SIZE", 10)),
+            "MAX_LIFETIME": int(os.getenv("DATABASE_POOL_MAX_LIFETIME", 1800)),
+            "HEALTH_CHECK_INTERVAL": int(os.getenv("DATABASE_POOL_HEALTH_CHECK_INTERVAL", 30)),
+            "TIMEOUT": int(os.getenv("DATABASE_POOL_TIMEOUT", 10)),
+        }
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -160,6 +205,143 @@ NPM_ROOT_PATH = BASE_DIR
 
 DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.RawMediaCloudinaryStorage'
 
+# Upstream APIs
+
+IGDB_API_URL = os.getenv("IGDB_API_URL", "https://api.igdb.com/v4/")
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+IPWHOIS_API_URL = os.getenv("IPWHOIS_API_URL", "http://ipwhois.app/json/")
+
+# "live", "record" (live, saving responses to UPSTREAM_CASSETTE_DIR) or "replay" (offline, from saved responses)
+UPSTREAM_TRANSPORT = os.getenv("UPSTREAM_TRANSPORT", "live")
+UPSTREAM_CASSETTE_DIR = os.getenv("UPSTREAM_CASSETTE_DIR", os.path.join(BASE_DIR, "cassettes"))
+# milliseconds to wait before each replayed response, or "recorded" to reproduce the recorded latency
+UPSTREAM_REPLAY_LATENCY = os.getenv("UPSTREAM_REPLAY_LATENCY")
+
+# per-service timeouts, circuit breakers and response caching (see app.resilience), each overridable with
+# <SERVICE>_<SETTING>, e.g. IGDB_TIMEOUT="3.05,5" (connect and read timeouts in seconds) or GITHUB_RESET_SECONDS=600
+UPSTREAM_POLICIES = {
+    "igdb": {"TIMEOUT": "3.05,5", "FAILURE_THRESHOLD": 5, "SLOW_CALL_SECONDS": 3, "RESET_SECONDS": 30,
+             "FRESH_SECONDS": 60 * 60, "STALE_SECONDS": 24 * 60 * 60},
+    "github": {"TIMEOUT": "3.05,3", "FAILURE_THRESHOLD": 3, "SLOW_CALL_SECONDS": 2, "RESET_SECONDS": 300,
+               "FRESH_SECONDS": 10 * 60, "STALE_SECONDS": 7 * 24 * 60 * 60},
+    "ipwhois": {"TIMEOUT": "2,2", "FAILURE_THRESHOLD": 3, "SLOW_CALL_SECONDS": 1, "RESET_SECONDS": 60,
+                "FRESH_SECONDS": 0, "STALE_SECONDS": 24 * 60 * 60},
+}
+for service, policy in UPSTREAM_POLICIES.items():
+    for name, default in policy.items():
+        value = os.getenv(f"{service.upper()}_{name}", str(default))
+        policy[name] = [float(seconds) for seconds in value.split(",")] if name == "TIMEOUT" else float(value)
+
+# the cache holding upstream responses
+UPSTREAM_CACHE_ALIAS = 'upstream'
+
+# Sessions
+
+SESSION_ENGINE = 'app.sessions'
+SESSION_CACHE_ALIAS = 'sessions'
+# serialized size limits, in bytes, for a single session key and for a whole session
+SESSION_MAX_VALUE_BYTES = int(os.getenv("SESSION_MAX_VALUE_BYTES", 2 * 1024 * 1024))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 3 * 1024 * 1024))
+
+# Caches
+
+# an in-process cache is only coherent with a single worker, so with WEB_CONCURRENCY above 1 the session cache is off
+# (every session is read from the database) unless SESSION_CACHE_BACKEND and SESSION_CACHE_LOCATION point at a cache
+# shared by every worker of every instance, such as memcached or Redis; unchanged sessions are still never written
+# back, and the size limits still apply
+SESSION_CACHE_BACKEND = os.getenv(
+    "SESSION_CACHE_BACKEND",
+    'django.core.cache.backends.locmem.LocMemCache' if os.getenv("WEB_CONCURRENCY", "1") == "1"
+    else 'django.core.cache.backends.dummy.DummyCache'
+)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'sessions': {
+        'BACKEND': SESSION_CACHE_BACKEND,
+        'LOCATION': os.getenv("SESSION_CACHE_LOCATION", 'sessions'),
+    },
+    # upstream responses, reused while fresh and served while a service is unavailable (see app.resilience)
+    'upstream': {
+        'BACKEND': os.getenv("UPSTREAM_CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv("UPSTREAM_CACHE_LOCATION", 'upstream'),
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+
+# Typeahead
+
+# seconds between checks for titles added to backlogs by other processes
+TYPEAHEAD_REFRESH_SECONDS = int(os.getenv("TYPEAHEAD_REFRESH_SECONDS", 60))
+
+# Cache Warming
+
+# whether gunicorn warms caches (see app.warmup) once, in the master process before it forks workers; only with
+# GUNICORN_PRELOAD=on. Otherwise, run `manage.py warm_caches` as a release step against a shared UPSTREAM_CACHE_BACKEND
+WARM_CACHES_ON_START = os.getenv("WARM_CACHES_ON_START", "off") == "on"
+# the most seconds warming may take; whatever hasn't started by then is skipped
+WARM_CACHES_MAX_SECONDS = float(os.getenv("WARM_CACHES_MAX_SECONDS", 30))
+# how many of the games most active in backlogs over the last WARM_CACHES_DAYS days to warm game pages for
+WARM_CACHES_GAMES = int(os.getenv("WARM_CACHES_GAMES", 50))
+WARM_CACHES_DAYS = int(os.getenv("WARM_CACHES_DAYS", 30))
+# searches to always warm (comma-separated), topped up with the titles of popular games to WARM_CACHES_NUM_SEARCHES
+WARM_CACHES_SEARCHES = [search for search in os.getenv("WARM_CACHES_SEARCHES", "").split(",") if search]
+WARM_CACHES_NUM_SEARCHES = int(os.getenv("WARM_CACHES_NUM_SEARCHES", 20))
+# concurrent requests, and requests started per second (IGDB allows 4 per second)
+WARM_CACHES_WORKERS = int(os.getenv("WARM_CACHES_WORKERS", 4))
+WARM_CACHES_RATE = float(os.getenv("WARM_CACHES_RATE", 4))
+
+# Account Deletion
+
+# backlog entries deleted per batch by the process_account_deletions worker (see app.deletion)
+ACCOUNT_DELETION_BATCH_SIZE = int(os.getenv("ACCOUNT_DELETION_BATCH_SIZE", 500))
+# seconds without progress after which a running deletion is taken to have died with its worker and is picked up again
+ACCOUNT_DELETION_STALE_SECONDS = int(os.getenv("ACCOUNT_DELETION_STALE_SECONDS", 300))
+# attempts after which a deletion that keeps failing is left for staff to look at
+ACCOUNT_DELETION_MAX_ATTEMPTS = int(os.getenv("ACCOUNT_DELETION_MAX_ATTEMPTS", 5))
+# seconds the worker sleeps when there's nothing to delete
+ACCOUNT_DELETION_POLL_SECONDS = int(os.getenv("ACCOUNT_DELETION_POLL_SECONDS", 10))
+
+# Metrics
+
+# a directory (ideally on tmpfs) where each worker process writes its metrics, so that a scrape served by any worker
+# reports them all; required when running more than one worker
+METRICS_DIR = os.getenv("METRICS_DIR")
+# the most seconds a worker's metrics may lag behind in a scrape served by another worker
+METRICS_FLUSH_SECONDS = int(os.getenv("METRICS_FLUSH_SECONDS", 5))
+# addresses allowed to scrape /metrics without signing in as staff (comma-separated); none by default, since behind a
+# reverse proxy on the same host every request comes from 127.0.0.1
+METRICS_ALLOWED_IPS = [ip for ip in os.getenv("METRICS_ALLOWED_IPS", "").split(",") if ip]
+
+# Slow Query Log
+
+# whether queries slower than SLOW_QUERY_THRESHOLD_MS are recorded, with their plan, for staff (see app.querylog)
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "on") == "on"
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 200))
+# the fraction of requests whose queries are timed
+SLOW_QUERY_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_SAMPLE_RATE", 1))
+# "on" to record the plans of slow SELECTs, "analyze" to also run them again to record what they actually did, or "off"
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "on")
+# seconds before the same statement is explained again
+SLOW_QUERY_EXPLAIN_INTERVAL = int(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", 300))
+# slow queries kept per worker for staff to look at
+SLOW_QUERY_BUFFER_SIZE = int(os.getenv("SLOW_QUERY_BUFFER_SIZE", 100))
+
+# Memory Profiling
+
+# "on" traces every allocation with tracemalloc so that staff can look into workers' memory use (see app.memory); it
+# slows workers down, so only turn it on while investigating
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "off") == "on"
+# frames kept per allocation: enough to reach from library code back into the app's, at the cost of more overhead
+MEMORY_PROFILING_FRAMES = int(os.getenv("MEMORY_PROFILING_FRAMES", 25))
+# the fraction of requests whose peak memory is measured
+MEMORY_PROFILING_SAMPLE_RATE = float(os.getenv("MEMORY_PROFILING_SAMPLE_RATE", 0.1))
+# heap snapshots kept per worker, and modules listed per report
+MEMORY_PROFILING_SNAPSHOTS = int(os.getenv("MEMORY_PROFILING_SNAPSHOTS", 3))
+MEMORY_PROFILING_TOP = int(os.getenv("MEMORY_PROFILING_TOP", 25))
+
 # Crispy Forms
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
@@ -15,10 +15,14 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.contrib.auth.views import LogoutView
-from django.urls import path
+from django.urls import path, register_converter
 
+import app.api as api
+from app.converters import GameIdConverter
 from app.views import *
 
+register_converter(GameIdConverter, "game_id")
+
 urlpatterns = [
 
     # Meta
@@ -28,6 +32,9 @@ urlpatterns = [
     path('about/', AboutView.as_view(), name='about'),
     path('about/changelog', ChangelogView.as_view(), name='changelog'),
     path('about/licenses/', SoftwareLicensesView.as_view(), name='licenses'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
+    path('metrics/memory/', MemoryProfileView.as_view(), name='memory-profile'),
+    path('metrics/queries/', SlowQueryLogView.as_view(), name='slow-query-log'),
 
     # Account Registratiosn
     path('signup/', SignUpView.as_view(), name='signup'),
@@ -43,8 +50,9 @@ urlpatterns = [
 
     # Viewing/Editing Games
     path('backlog/', BacklogView.as_view(), name='backlog'),
-    path('backlog/games/id=<str:game_id>/', GameInfoView.as_view(), name='game-info'),
-    path('backlog/games/edit-custom-game/id=<str:game_id>', EditCustomGameView.as_view(), name='edit-custom-game'),
+    path('backlog/stats/', BacklogStatsView.as_view(), name='backlog-stats'),
+    path('backlog/games/id=<game_id:game_id>/', GameInfoView.as_view(), name='game-info'),
+    path('backlog/games/edit-custom-game/id=<game_id:game_id>', EditCustomGameView.as_view(), name='edit-custom-game'),
 
     # Adding Games
     path('backlog/games/add-game/search/', AddGameSearchView.as_view(), name='add-game-search'),
@@ -52,6 +60,12 @@ urlpatterns = [
     path('backlog/games/add-game/', AddGameView.as_view(), name='add-game'),
     path('backlog/games/add-game/custom/', AddCustomGameView.as_view(), name='add-custom-game'),
     path('backlog/games/add-game/custom/preview', CustomGamePreviewView.as_view(),
-         name='custom-game-preview')
+         name='custom-game-preview'),
+
+    # JSON API
+    path('api/v1/backlog/', api.BacklogCollectionApiView.as_view(), name='api-backlog'),
+    path('api/v1/backlog/<game_id:game_id>/', api.BacklogEntryApiView.as_view(), name='api-backlog-entry'),
+    path('api/v1/sync/', api.SyncApiView.as_view(), name='api-sync'),
+    path('api/v1/typeahead/', api.TypeaheadApiView.as_view(), name='api-typeahead'),
 
 ]
@@ -0,0 +1,86 @@
+"""
+Gunicorn configuration. Gunicorn reads this file automatically when started from the project root.
+"""
+
+import os
+import time
+
+# GUNICORN_PRELOAD=on imports the whole application once in the master process, so that forked workers share its
+# memory copy-on-write instead of each importing it themselves
+preload_app = os.getenv("GUNICORN_PRELOAD", "off") == "on"
+
+
+def when_ready(server):
+    if preload_app:
+        import app.lazy
+
+        # warmed once, in the master process, so that every worker forked from it starts with the same warm caches
+        warm_caches(server.log)
+        loaded = app.lazy.preload()
+        server.log.info("Preloaded %s", ", ".join(loaded))
+    elif os.getenv("WARM_CACHES_ON_START") == "on":
+        # warming in each worker would delay its first heartbeat and multiply the requests made to IGDB
+        server.log.warning("WARM_CACHES_ON_START only applies with GUNICORN_PRELOAD=on; run manage.py warm_caches "
+                           "as a release step instead")
+
+
+def post_fork(server, worker):
+    # a worker forked from a preloaded master starts with the metrics it recorded, e.g. while warming caches
+    if preload_app:
+        import app.metrics
+
+        app.metrics.reset()
+
+
+def post_worker_init(worker):
+    import app.typeahead
+
+    # each worker has its own index, read from the backlogs in the background so that it doesn't delay taking traffic
+    app.typeahead.index.refresh_in_background()
+
+
+def warm_caches(log):
+    from django.conf import settings
+    from django.db import connections
+
+    if not settings.WARM_CACHES_ON_START:
+        return
+
+    import app.db.pool
+    import app.warmup
+
+    start = time.perf_counter()
+    results = app.warmup.warm_caches()
+    failed = [result for result in results if result.error]
+    for result in failed:
+        log.warning("Couldn't warm %s: %s", result.name, result.error)
+    log.info("Warmed %d of %d cache entries in %.1fs", len(results) - len(failed), len(results),
+             time.perf_counter() - start)
+
+    # the connections used to find popular games mustn't be shared with forked workers; with a pooled engine,
+    # close_all() only returns them to the pool, so the pool is emptied too
+    connections.close_all()
+    app.db.pool.close_pools()
+
+
+def on_starting(server):
+    # counters restart from zero with the server, so leftovers from its previous run would be counted twice
+    if os.getenv("METRICS_DIR"):
+        import app.metrics
+
+        app.metrics.clear(os.getenv("METRICS_DIR"))
+
+
+def worker_exit(server, worker):
+    # runs in the exiting worker, before child_exit() archives what it wrote
+    if os.getenv("METRICS_DIR"):
+        import app.metrics
+
+        app.metrics.registry.flush(force=True)
+
+
+def child_exit(server, worker):
+    if os.getenv("METRICS_DIR"):
+        import app.metrics
+
+        app.metrics.archive_process(os.getenv("METRICS_DIR"), worker.pid)